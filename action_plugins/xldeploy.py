@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+from ansible.errors import AnsibleError
+from ansible.parsing.mod_args import ModuleArgsParser
+from ansible.plugins.action import ActionBase
+
+# the options describing the CIs, everything else is shared by all the hosts
+ITEM_OPTIONS = ('id', 'type', 'properties', 'state', 'update_mode')
+
+
+def merge_properties(id, properties, other):
+    merged = dict(properties)
+    for key, value in other.items():
+        if key not in merged or merged[key] == value:
+            merged[key] = value
+        elif isinstance(merged[key], list) and isinstance(value, list):
+            merged[key] = merged[key] + [v for v in value if v not in merged[key]]
+        elif isinstance(merged[key], dict) and isinstance(value, dict):
+            merged[key] = merge_properties(id, merged[key], value)
+        else:
+            raise AnsibleError("Conflicting values for '{}' of {}: {} and {}".format(
+                key, id, merged[key], value))
+    return merged
+
+
+def merge_items(definitions):
+    """ merges the (host, item) definitions into one item per CI id and
+    returns the items with, for each host, the indexes of its items"""
+    items = []
+    index_of = {}
+    owners = {}
+    for host, item in definitions:
+        id = item.get('id')
+        if id not in index_of:
+            index_of[id] = len(items)
+            items.append(dict(item, properties=dict(item.get('properties') or {})))
+        else:
+            merged = items[index_of[id]]
+            for option in ('type', 'state', 'update_mode'):
+                if merged.get(option) != item.get(option):
+                    raise AnsibleError("Conflicting {} for {}: {} and {}".format(
+                        option, id, merged.get(option), item.get(option)))
+            merged['properties'] = merge_properties(
+                id, merged['properties'], item.get('properties') or {})
+        owners.setdefault(host, []).append(index_of[id])
+    return items, owners
+
+
+class ActionModule(ActionBase):
+    """ Runs xldeploy once for all the hosts of the play batch when 'aggregate'
+    is set on a run_once task: the CI definitions of every host are templated
+    on the controller, shared CIs are merged and all of them are sent to the
+    module in batch mode."""
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        task_vars = task_vars or {}
+        args = dict(self._task.args)
+        aggregate = args.pop('aggregate', False)
+
+        if not aggregate:
+            result.update(self._execute_module(
+                module_name='xldeploy', module_args=args, task_vars=task_vars))
+            return result
+
+        if not self._task.run_once:
+            result.update(failed=True, msg="aggregate requires 'run_once: true' on the task")
+            return result
+
+        try:
+            items, owners = merge_items(self._definitions(task_vars))
+        except AnsibleError as e:
+            result.update(failed=True, msg=str(e))
+            return result
+
+        module_args = dict((k, v) for k, v in args.items()
+                           if k not in ITEM_OPTIONS + ('items',))
+        module_args['items'] = items
+        module_result = self._execute_module(
+            module_name='xldeploy', module_args=module_args, task_vars=task_vars)
+        result.update(module_result)
+
+        results = module_result.get('results') or []
+        if len(results) == len(items):
+            hosts = {}
+            for host, indexes in owners.items():
+                host_results = [results[i] for i in indexes]
+                hosts[host] = dict(
+                    changed=any(r.get('changed') for r in host_results),
+                    failed=any(r.get('failed') for r in host_results),
+                    results=host_results)
+            result['hosts'] = hosts
+        return result
+
+    def _definitions(self, task_vars):
+        """ yields a (host, item) pair for each CI defined by each host of the batch"""
+        raw_args = ModuleArgsParser(self._task.get_ds()).parse()[1]
+        hostvars = task_vars.get('hostvars', {})
+        for host in task_vars.get('ansible_play_batch', []):
+            variables = dict(task_vars)
+            if host in hostvars:
+                # a plain dict: the templar does not accept HostVarsVars in a ChainMap
+                variables.update(hostvars[host].items())
+            host_args = self._template(raw_args, variables)
+            defaults = dict(state=host_args.get('state', 'present'),
+                            update_mode=host_args.get('update_mode', 'replace'))
+            if host_args.get('items') is not None:
+                for item in host_args['items']:
+                    definition = dict(defaults, type=host_args.get('type'))
+                    definition.update(item)
+                    yield host, definition
+            else:
+                yield host, dict(defaults, **dict(
+                    (k, host_args.get(k)) for k in ITEM_OPTIONS if k in host_args))
+
+    def _template(self, data, variables):
+        if hasattr(self._templar, 'copy_with_new_env'):
+            return self._templar.copy_with_new_env(available_variables=variables).template(data)
+        saved = self._templar.available_variables
+        self._templar.available_variables = variables
+        try:
+            return self._templar.template(data)
+        finally:
+            self._templar.available_variables = saved
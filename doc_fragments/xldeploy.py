@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+
+class ModuleDocFragment(object):
+
+    # The options of the XL Deploy client shared by the xldeploy modules
+    DOCUMENTATION = r'''
+options:
+    retries:
+        description:
+            - How many times a request is retried when XL Deploy is overloaded or the connection fails
+        required: false
+        default: 3
+    trace_file:
+        description:
+            - Append the verb, path, status, size and timings of every request to this JSON-lines file
+        required: false
+    stats_hooks:
+        description:
+            - "'package.module:function' callables importable on the target, called with the record of every request"
+        required: false
+    session_cache:
+        description:
+            - Where the session cookies are kept between runs so that XL Deploy authenticates the user once, '' to keep them in memory only
+        required: false
+        default: ~/.ansible/xldeploy/sessions
+    compress_requests:
+        description:
+            - Gzip the request bodies larger than this many bytes, 0 to never; the server has to accept Content-Encoding gzip
+        required: false
+        default: 0
+'''
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = '''
+---
+lookup: xldeploy
+
+short_description: Query the XLDeploy from Xebialabs repository
+
+description:
+    - "Without terms, lists the CIs matching the type, parent, ancestor and name_pattern filters page by page with /repository/query"
+    - "With terms, reads the CIs whose ids are given"
+    - "With full, returns the CIs with their properties, read by batches with /repository/cis/read"
+
+options:
+    _terms:
+        description:
+            - The ids of the CIs to read
+        required: false
+    type:
+        description:
+            - Only return the CIs of this type
+    parent:
+        description:
+            - Only return the direct children of this CI
+    ancestor:
+        description:
+            - Only return the CIs below this CI
+    name_pattern:
+        description:
+            - Only return the CIs whose name matches this pattern, '%' matching any characters
+    full:
+        description:
+            - Also read the properties of the matching CIs
+        default: false
+    page_size:
+        description:
+            - The number of CIs listed per query request
+        default: 100
+    batch_size:
+        description:
+            - The number of CIs read per request when full is set
+        default: 100
+    endpoint:
+        description:
+            - The name of the enpoint
+        default: http://localhost:4516
+    username:
+        description:
+            - The name of the user for the endpoint
+        default: admin
+    password:
+        description:
+            - The password of the user for the endpoint
+        default: admin
+    validate_certs:
+        description:
+            - SSL/TLS Certificate Validation Flag
+        default: true
+'''
+
+EXAMPLES = '''
+- name: Deploy on every tomcat environment
+  debug:
+    msg: "{{ item.id }}"
+  loop: "{{ lookup('xldeploy', type='udm.Environment', parent='Environments/others', name_pattern='tomcat%',
+                   endpoint='http://localhost:4516', username='admin', password='password', wantlist=True) }}"
+
+- name: Read the members of an environment
+  debug:
+    msg: "{{ lookup('xldeploy', 'Environments/others/tomcat-test', full=True)['properties']['members'] }}"
+'''
+
+RETURN = '''
+_raw:
+    description: The CIs, as dicts with their id and type, and their properties when full is set
+    type: list
+'''
+
+import importlib.util
+
+from ansible.errors import AnsibleError
+from ansible.plugins.loader import module_utils_loader
+from ansible.plugins.lookup import LookupBase
+from ansible.utils.display import Display
+
+display = Display()
+
+
+def xldeploy_client():
+    """ the shared client, found among the module_utils when it is not importable"""
+    try:
+        from ansible.module_utils import xldeploy
+        return xldeploy
+    except ImportError:
+        path = module_utils_loader.find_plugin('xldeploy', '.py')
+        if path is None:
+            raise AnsibleError("module_utils/xldeploy.py not found")
+        spec = importlib.util.spec_from_file_location('ansible_xldeploy_client', path)
+        xldeploy = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(xldeploy)
+        return xldeploy
+
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, **kwargs):
+        xldeploy = xldeploy_client()
+        communicator = xldeploy.XLDeployCommunicator(
+            kwargs.get('endpoint', 'http://localhost:4516'),
+            kwargs.get('username', 'admin'), kwargs.get('password', 'admin'),
+            kwargs.get('validate_certs', True))
+        repository = xldeploy.RepositoryService(communicator)
+        batch_size = int(kwargs.get('batch_size', 100))
+        try:
+            if terms:
+                return [ci.to_dict() for ci in repository.read_all(terms, batch_size)]
+            refs = repository.query(kwargs.get('type'), kwargs.get('parent'),
+                                    kwargs.get('ancestor'), kwargs.get('name_pattern'),
+                                    int(kwargs.get('page_size', 100)))
+            if not kwargs.get('full'):
+                return [dict(id=id, type=type) for id, type in refs]
+            return [ci.to_dict() for ci in
+                    repository.read_all((id for id, _ in refs), batch_size)]
+        except Exception as e:
+            raise AnsibleError("Failed to query XLD {} on {}".format(e, communicator))
+        finally:
+            communicator.close()
+            display.vvv("xldeploy lookup: {}".format(communicator.stats.summary()))
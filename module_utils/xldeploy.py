@@ -0,0 +1,1735 @@
+# -*- coding: utf-8 -*-
+"""
+Shared XL Deploy REST client used by the xldeploy modules.
+
+The XML, HTTP and TLS libraries are only imported when a request is actually
+sent or a document decoded, which keeps the module start-up cheap.
+"""
+
+import base64
+import hashlib
+import importlib
+import itertools
+import json
+import os
+import random
+import select
+import socket
+import threading
+import time
+import zlib
+
+# python 2 workaround
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from collections.abc import Mapping, MutableMapping, Sequence, Set
+except ImportError:
+    from collections import Mapping, MutableMapping, Sequence, Set
+
+try:
+    from urllib.parse import quote, urlencode, urlparse
+except ImportError:
+    from urllib import quote, urlencode
+    from urlparse import urlparse
+
+
+class LazyModule:
+    """ Imports the first of the given modules on first attribute access"""
+
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            for name in self._names:
+                try:
+                    self._module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    if name == self._names[-1]:
+                        raise
+        return getattr(self._module, attr)
+
+
+ET = LazyModule('xml.etree.ElementTree')
+ssl = LazyModule('ssl')
+http_client = LazyModule('http.client', 'httplib')
+
+
+def xldeploy_argument_spec(**kwargs):
+    """ the connection options shared by all the xldeploy modules"""
+    spec = dict(
+        username=dict(default='admin'),
+        password=dict(default='admin', no_log=True),
+        endpoint=dict(default='http://localhost:4516'),
+        validate_certs=dict(required=False, type='bool', default=True),
+        retries=dict(type='int', default=3),
+        trace_file=dict(type='path', required=False),
+        stats_hooks=dict(type='list', required=False),
+        session_cache=dict(type='path', default='~/.ansible/xldeploy/sessions'),
+        compress_requests=dict(type='int', default=0),
+    )
+    spec.update(kwargs)
+    return spec
+
+
+class XLDeployException(Exception):
+    """ XL Deploy answered with an unexpected HTTP status"""
+
+    def __init__(self, status, reason, retry_after=None):
+        Exception.__init__(
+            self, "Error when requesting XL Deploy Server [{}]:{}".format(status, reason))
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class SessionExpired(XLDeployException):
+    """ XL Deploy refused the session cookie, the request was not processed"""
+
+
+class AdaptiveLimiter:
+    """ AIMD limit on the requests in flight: one more slot per window of
+    successful requests, half as many when the server reports overload.
+
+    A thread holding a slot keeps it for the requests it sends meanwhile, as
+    when decoding a response fetches the descriptor of a type: waiting for
+    another slot could wait for its own. The asyncio engines cap their own
+    requests in flight in proportion to the limit, and adjust it too."""
+
+    def __init__(self, maximum=4, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._held = threading.local()
+
+    def resize(self, maximum):
+        with self._condition:
+            self.maximum = maximum
+            self.limit = float(maximum)
+            self._condition.notify_all()
+
+    def acquire(self):
+        held = getattr(self._held, 'depth', 0)
+        self._held.depth = held + 1
+        if held:
+            return
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, overloaded=False):
+        self._held.depth -= 1
+        with self._condition:
+            if not self._held.depth:
+                self.in_flight -= 1
+            self.adjust(overloaded)
+
+    def adjust(self, overloaded=False):
+        """ the AIMD step of a request done"""
+        with self._condition:
+            if overloaded:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class ConnectionPool:
+    """ Keep-alive HTTP/1.1 connections to a single XL Deploy endpoint"""
+
+    def __init__(self, endpoint, validate_certs=True, maxsize=4):
+        parsed_url = urlparse(endpoint)
+        self.scheme = parsed_url.scheme
+        self.hostname = parsed_url.hostname
+        self.port = parsed_url.port
+        self.maxsize = maxsize
+        self.ssl_context = None
+        if self.scheme == "https" and not validate_certs:
+            self.ssl_context = ssl._create_unverified_context()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """ opens the socket ahead of http_client to time the name resolution,
+        the TCP and the TLS handshakes, kept in the timings of the connection"""
+        if self.scheme == "https":
+            conn = http_client.HTTPSConnection(
+                self.hostname, self.port, context=self.ssl_context)
+            context = self.ssl_context or ssl.create_default_context()
+        else:
+            conn = http_client.HTTPConnection(self.hostname, self.port)
+        port = self.port or (443 if self.scheme == "https" else 80)
+        started = time.time()
+        try:
+            addresses = socket.getaddrinfo(self.hostname, port, 0, socket.SOCK_STREAM)
+            resolved = time.time()
+            error = None
+            for family, socktype, proto, _, address in addresses:
+                sock = socket.socket(family, socktype, proto)
+                try:
+                    sock.connect(address)
+                except socket.error as e:
+                    sock.close()
+                    error = e
+                    continue
+                break
+            else:
+                raise error
+        except socket.error as e:
+            # no answer from the server, which is not a sign of its overload
+            e.connecting = True
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connected = time.time()
+        if self.scheme == "https":
+            sock = context.wrap_socket(sock, server_hostname=self.hostname)
+        conn.sock = sock
+        conn.timings = dict(dns=resolved - started,
+                            connect=connected - resolved,
+                            tls=time.time() - connected)
+        return conn
+
+    def acquire(self, fresh=False):
+        """ returns a (connection, reused) tuple, skipping the idle connections
+        the server already closed"""
+        with self._lock:
+            while self._idle and not fresh:
+                conn = self._idle.pop()
+                if closed_by_peer(conn.sock):
+                    self.discarded += 1
+                    conn.close()
+                    continue
+                self.reused += 1
+                return conn, True
+            self.created += 1
+        return self._connect(), False
+
+    def release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, conn):
+        with self._lock:
+            self.discarded += 1
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        return dict(created=self.created, reused=self.reused,
+                    discarded=self.discarded)
+
+def closed_by_peer(sock):
+    """ an idle connection is readable only once the server closed it"""
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (ValueError, socket.error):
+        return True
+
+
+def write_entry(path, target, entry):
+    """ atomically replaces the target JSON file of a cache directory"""
+    tmp = "{}.{}.tmp".format(target, os.getpid())
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, target)
+    except (IOError, OSError):
+        # the caches are an optimization only, never fail the task on them
+        pass
+
+
+class MetadataCache:
+    """ Type metadata kept in memory and on disk, keyed by endpoint and type"""
+
+    def __init__(self, endpoint, path=None, ttl=86400):
+        self.endpoint = endpoint
+        self.path = path and os.path.expanduser(path)
+        self.ttl = ttl
+        self._memo = {}
+
+    def _file(self, typename):
+        key = hashlib.sha1('{}|{}'.format(self.endpoint, typename).encode())
+        return os.path.join(self.path, "{}.json".format(key.hexdigest()))
+
+    def get(self, typename):
+        if typename in self._memo:
+            return self._memo[typename]
+        if not self.path:
+            return None
+        try:
+            with open(self._file(typename)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('endpoint') != self.endpoint or entry.get('type') != typename:
+            return None
+        if time.time() - entry.get('stored', 0) > self.ttl:
+            return None
+        self._memo[typename] = entry['descriptors']
+        return entry['descriptors']
+
+    def put(self, typename, descriptors):
+        self._memo[typename] = descriptors
+        if not self.path:
+            return
+        entry = dict(endpoint=self.endpoint, type=typename,
+                     stored=time.time(), descriptors=descriptors)
+        write_entry(self.path, self._file(typename), entry)
+
+    def invalidate(self, typename=None):
+        """ drops one type, or every type of this endpoint when typename is None"""
+        if typename is None:
+            self._memo.clear()
+        else:
+            self._memo.pop(typename, None)
+        if not self.path or not os.path.isdir(self.path):
+            return
+        if typename is not None:
+            files = [self._file(typename)]
+        else:
+            files = [os.path.join(self.path, name)
+                     for name in os.listdir(self.path) if name.endswith('.json')]
+        for name in files:
+            try:
+                if typename is None:
+                    with open(name) as f:
+                        if json.load(f).get('endpoint') != self.endpoint:
+                            continue
+                os.remove(name)
+            except (IOError, OSError, ValueError):
+                pass
+
+
+class FingerprintStore:
+    """ The fingerprint of the desired state last applied to each CI, with the
+    token the server gave the CI then, on disk and keyed by endpoint and id"""
+
+    def __init__(self, endpoint, path=None):
+        self.endpoint = endpoint
+        self.path = path and os.path.expanduser(path)
+
+    @staticmethod
+    def fingerprint(*desired):
+        return hashlib.sha256(json.dumps(desired, sort_keys=True).encode()).hexdigest()
+
+    def _file(self, id):
+        key = hashlib.sha1('{}|{}'.format(self.endpoint, id).encode())
+        return os.path.join(self.path, "{}.json".format(key.hexdigest()))
+
+    def get(self, id):
+        """ returns the (fingerprint, token) stored for the CI, None if unknown"""
+        if not self.path:
+            return None
+        try:
+            with open(self._file(id)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('endpoint') != self.endpoint or entry.get('id') != id:
+            return None
+        return entry.get('fingerprint'), entry.get('token')
+
+    def put(self, id, fingerprint, token):
+        if not self.path:
+            return
+        if token is None:
+            self.invalidate(id)
+            return
+        entry = dict(endpoint=self.endpoint, id=id, fingerprint=fingerprint,
+                     token=token)
+        write_entry(self.path, self._file(id), entry)
+
+    def invalidate(self, id):
+        if not self.path:
+            return
+        try:
+            os.remove(self._file(id))
+        except (IOError, OSError):
+            pass
+
+
+class SessionCache:
+    """ The session cookies XL Deploy set for a user, on disk so that the next
+    module runs do not authenticate again, keyed by endpoint and credentials"""
+
+    def __init__(self, endpoint, username, password, path=None):
+        self.path = path and os.path.expanduser(path)
+        self.key = hashlib.sha256('{}|{}|{}'.format(
+            endpoint, username, password).encode()).hexdigest()
+
+    def _file(self):
+        return os.path.join(self.path, "{}.json".format(self.key))
+
+    def get(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self._file()) as f:
+                return json.load(f).get('cookies') or {}
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def put(self, cookies):
+        if not self.path:
+            return
+        if not cookies:
+            self.invalidate()
+            return
+        write_entry(self.path, self._file(), dict(cookies=cookies, stored=time.time()))
+
+    def invalidate(self):
+        if not self.path:
+            return
+        try:
+            os.remove(self._file())
+        except (IOError, OSError):
+            pass
+
+
+def set_cookies(response):
+    """ the name=value pairs of the Set-Cookie headers of a response"""
+    get_all = getattr(response.msg, 'get_all', None)
+    headers = get_all('Set-Cookie') if get_all else response.msg.getheaders('Set-Cookie')
+    return parse_cookies(headers or [])
+
+
+def parse_cookies(headers):
+    """ the name=value pairs of Set-Cookie header values"""
+    cookies = {}
+    for header in headers:
+        name, _, value = header.split(';', 1)[0].partition('=')
+        cookies[name.strip()] = value.strip()
+    return cookies
+
+
+PATH_TEMPLATES = (
+    ('repository/ci/', 'repository/ci/{id}'),
+    ('repository/exists/', 'repository/exists/{id}'),
+    ('metadata/type/', 'metadata/type/{type}'),
+    ('security/role/principals', 'security/role/principals'),
+    ('security/role/', 'security/role/{role}'),
+    ('security/granted-permissions/', 'security/granted-permissions/{role}'),
+    ('security/permission/', 'security/permission/{permission}/{role}/{id}'),
+)
+
+
+def path_template(path):
+    """ the path of a request without its ids, to aggregate alike requests"""
+    path = path.split('?', 1)[0]
+    for prefix, template in PATH_TEMPLATES:
+        if path.startswith(prefix):
+            return template
+    return path
+
+
+def load_hook(spec):
+    """ resolves a 'package.module:function' statistics hook"""
+    module_name, _, function = spec.partition(':')
+    if not function:
+        raise ValueError("'{}' is not a 'module:function' hook".format(spec))
+    return getattr(importlib.import_module(module_name), function)
+
+
+class CountingReader:
+    """ Counts the bytes read from a response"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size=None):
+        data = self.stream.read(size) if size is not None else self.stream.read()
+        self.count += len(data)
+        return data
+
+
+class DecompressingReader:
+    """ Inflates a gzip or deflate encoded response while it is read"""
+
+    def __init__(self, stream, encoding):
+        self.stream = stream
+        self.count = 0
+        self._raw_deflate = encoding == 'deflate'
+        self._inflater = zlib.decompressobj(
+            16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+        self._started = False
+        self._buffer = b''
+        self._eof = False
+
+    def _inflate(self, data):
+        try:
+            inflated = self._inflater.decompress(data)
+        except zlib.error:
+            # some servers send raw deflate data, without the zlib header
+            if not self._raw_deflate or self._started:
+                raise
+            self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            inflated = self._inflater.decompress(data)
+        self._started = True
+        return inflated
+
+    def read(self, size=None):
+        chunks = [self._buffer]
+        buffered = len(self._buffer)
+        while not self._eof and (size is None or buffered < size):
+            data = self.stream.read(size or 16 * 1024)
+            if data:
+                data = self._inflate(data)
+            else:
+                data = self._inflater.flush()
+                self._eof = True
+            chunks.append(data)
+            buffered += len(data)
+        data = b''.join(chunks)
+        if size is not None:
+            data, self._buffer = data[:size], data[size:]
+        else:
+            self._buffer = b''
+        self.count += len(data)
+        return data
+
+
+def compress(doc):
+    deflater = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return deflater.compress(doc) + deflater.flush()
+
+
+class RequestStats:
+    """ Aggregates the timings of the requests sent to XL Deploy, writes them
+    to a JSON-lines trace file and passes them to the hooks when given"""
+
+    TIMINGS = ('dns', 'connect', 'tls', 'server', 'transfer', 'total')
+
+    def __init__(self, trace_file=None, hooks=None):
+        self.trace_file = trace_file
+        self.hooks = [hook if callable(hook) else load_hook(hook)
+                      for hook in hooks or []]
+        self.requests = 0
+        self.errors = 0
+        self.reused = 0
+        self.hook_errors = 0
+        self.basic_auth = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.content_in = 0
+        self.content_out = 0
+        self.time = dict((timing, 0.0) for timing in self.TIMINGS)
+        self.paths = {}
+        self._trace = None
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """ hook is called with the record of every request, from the sending thread"""
+        self.hooks.append(hook)
+
+    def record(self, record):
+        with self._lock:
+            failed = record['status'] not in (200, 204)
+            self.requests += 1
+            self.errors += failed
+            self.reused += record['reused']
+            self.basic_auth += record['auth'] == 'basic'
+            self.bytes_in += record['bytes_in']
+            self.bytes_out += record['bytes_out']
+            self.content_in += record['content_in']
+            self.content_out += record['content_out']
+            for timing in self.TIMINGS:
+                self.time[timing] += record[timing]
+            key = "{} {}".format(record['verb'], record['path'])
+            path = self.paths.setdefault(key, dict(
+                count=0, errors=0, time=0.0, max_time=0.0, bytes_in=0, bytes_out=0))
+            path['count'] += 1
+            path['errors'] += failed
+            path['time'] += record['total']
+            path['max_time'] = max(path['max_time'], record['total'])
+            path['bytes_in'] += record['bytes_in']
+            path['bytes_out'] += record['bytes_out']
+            if self.trace_file is not None:
+                if self._trace is None:
+                    self._trace = open(os.path.expanduser(self.trace_file), 'a')
+                self._trace.write(json.dumps(record, sort_keys=True) + "\n")
+                self._trace.flush()
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception:
+                with self._lock:
+                    self.hook_errors += 1
+
+    def summary(self):
+        with self._lock:
+            paths = dict((key, dict(path, time=round(path['time'], 4),
+                                    max_time=round(path['max_time'], 4)))
+                         for key, path in self.paths.items())
+            return dict(requests=self.requests, errors=self.errors,
+                        reused=self.reused, hook_errors=self.hook_errors,
+                        basic_auth=self.basic_auth,
+                        bytes_in=self.bytes_in, bytes_out=self.bytes_out,
+                        content_in=self.content_in, content_out=self.content_out,
+                        time=dict((timing, round(value, 4))
+                                  for timing, value in self.time.items()),
+                        paths=paths)
+
+    def close(self):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+
+class XLDeployCommunicator:
+    """ XL Deploy Communicator using http & XML"""
+
+    # TODO Manage 'context'
+
+    def __init__(self,
+                 endpoint='http://localhost:4516',
+                 username='admin',
+                 password='admin',
+                 validate_certs=True,
+                 context='deployit',
+                 metadata_cache=None,
+                 retries=3,
+                 concurrency=4,
+                 trace_file=None,
+                 hooks=None,
+                 session_cache=None,
+                 compress_requests=0):
+        self.endpoint = endpoint
+        self.username = username
+        self.password = password
+        self.validate_certs = validate_certs
+        self.context = context
+        self.pool = ConnectionPool(endpoint, validate_certs, concurrency)
+        # the pools of the asyncio engines opened over this communicator
+        self.pools = [self.pool]
+        self.limiter = AdaptiveLimiter(concurrency)
+        self.retries = retries
+        self.backoff = 0.5
+        self.backoff_max = 30
+        self.metadata_cache = metadata_cache or MetadataCache(endpoint)
+        self.stats = RequestStats(trace_file, hooks)
+        self._codecs = {}
+        self.auth = base64.b64encode(('{}:{}'.format(
+            username, password)).encode()).decode()
+        self.sessions = SessionCache(endpoint, username, password, session_cache)
+        self.compress_requests = compress_requests
+        self.cookies = self.sessions.get()
+
+    def do_get(self, path, decoder=None):
+        return self.do_it("GET", path, "", decoder=decoder)
+
+    def do_put(self, path, doc="", decoder=None):
+        return self.do_it("PUT", path, doc, decoder=decoder)
+
+    def do_post(self, path, doc, parse_response=True, decoder=None,
+                idempotent=False):
+        return self.do_it("POST", path, doc, parse_response, decoder,
+                          idempotent)
+
+    def do_delete(self, path):
+        return self.do_it("DELETE", path, "", False)
+
+    IDEMPOTENT_VERBS = ('GET', 'HEAD', 'PUT', 'DELETE')
+    RETRY_STATUSES = (429, 502, 503, 504)
+    OVERLOAD_STATUSES = (429, 503)
+    DRAIN_LIMIT = 64 * 1024
+
+    def set_concurrency(self, concurrency):
+        self.pool.maxsize = max(self.pool.maxsize, concurrency)
+        self.limiter.resize(concurrency)
+
+    def delay(self, attempt, retry_after=None):
+        """ the Retry-After of the server, or a full-jitter exponential backoff"""
+        if retry_after is not None:
+            try:
+                return min(self.backoff_max, max(0, float(retry_after)))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def do_it(self, verb, path, doc, parse_response=True, decoder=None,
+              idempotent=None):
+        """ decoder, when given, consumes the response stream as it arrives
+        and its result is returned instead of the parsed document.
+        Idempotent requests are retried on overload and connection errors."""
+        if idempotent is None:
+            idempotent = verb in self.IDEMPOTENT_VERBS
+        attempt = 0
+        while True:
+            overloaded = False
+            self.limiter.acquire()
+            try:
+                return self.send(verb, path, doc, parse_response, decoder, idempotent)
+            except SessionExpired:
+                # replayed with Basic auth, which opens a new session
+                continue
+            except (XLDeployException, http_client.HTTPException, socket.error) as e:
+                delay, overloaded = self.retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise
+            finally:
+                self.limiter.release(overloaded)
+            time.sleep(delay)
+            attempt += 1
+
+    def retry_delay(self, error, attempt, idempotent):
+        """ the (delay, overloaded) of a request that failed with error, the
+        delay None when it is not sent again. A failed TLS handshake fails
+        the same way again, and a connection that could not be opened is no
+        sign of overload."""
+        if isinstance(error, XLDeployException):
+            overloaded = error.status in self.OVERLOAD_STATUSES
+            if not idempotent or attempt >= self.retries or \
+                    error.status not in self.RETRY_STATUSES:
+                return None, overloaded
+            return self.delay(attempt, error.retry_after), overloaded
+        if isinstance(error, (ssl.SSLError, ssl.CertificateError)):
+            return None, False
+        overloaded = not getattr(error, 'connecting', False)
+        if not idempotent or attempt >= self.retries:
+            return None, overloaded
+        return self.delay(attempt), overloaded
+
+    def prepare(self, verb, path, doc):
+        """ the headers, the body, the session cookies and the statistics
+        record of a request"""
+        headers = {
+            "Content-type": "application/xml",
+            "Accept": "application/xml",
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive"
+        }
+        content_out = len(doc)
+        if self.compress_requests and content_out > self.compress_requests:
+            if not isinstance(doc, bytes):
+                doc = doc.encode('utf-8')
+            doc = compress(doc)
+            headers["Content-Encoding"] = "gzip"
+        cookies = self.cookies
+        if cookies:
+            headers["Cookie"] = "; ".join(
+                "{}={}".format(k, v) for k, v in sorted(cookies.items()))
+        else:
+            headers["Authorization"] = "Basic {}".format(self.auth)
+        record = dict(verb=verb, path=path_template(path), status=None,
+                      auth='session' if cookies else 'basic',
+                      bytes_out=len(doc), bytes_in=0, content_out=content_out,
+                      content_in=0, reused=False,
+                      dns=0.0, connect=0.0, tls=0.0, server=0.0, transfer=0.0,
+                      started=time.time())
+        return headers, doc, cookies, record
+
+    def check_response(self, status, reason, cookies, received, retry_after=None):
+        """ keeps the session cookies received, raises the error of the response"""
+        if status == 401 and cookies:
+            self.drop_session(cookies)
+            raise SessionExpired(status, reason)
+        self.keep_session(received)
+        if status != 200 and status != 204:
+            raise XLDeployException(status, reason, retry_after)
+
+    def replayable(self, pool, conn, reused, written, idempotent):
+        """ discards conn, whose request failed, and tells whether the request
+        is to be sent again on a fresh connection"""
+        # the server closed an idle keep-alive connection: the other idle
+        # ones are likely stale too, start over on a fresh one. Once written,
+        # the request may have been processed before the connection dropped:
+        # only idempotent ones are sent again.
+        pool.discard(conn)
+        if not reused or (written and not idempotent):
+            return False
+        pool.clear()
+        return True
+
+    def receive(self, response, conn, reused, sent, record, decoder=None,
+                parse_response=True):
+        """ reads the response, recording its timings and sizes, and returns
+        its (result, reusable): the decoded or parsed document, and whether
+        the connection can take another request"""
+        received = time.time()
+        record.update(status=response.status, reused=reused, server=received - sent)
+        if not reused:
+            record.update(conn.timings)
+
+        reusable = True
+        counter = stream = CountingReader(response)
+        encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            stream = DecompressingReader(counter, 'deflate' if encoding == 'deflate' else 'gzip')
+        result = None
+        if response.status != 200 and response.status != 204:
+            stream.read()
+        elif decoder is not None:
+            result = decoder(stream)
+            # drain what the decoder left so the connection can be reused,
+            # unless opening a new one is cheaper than reading the rest
+            if response.isclosed() or (response.length is not None and
+                                       response.length <= self.DRAIN_LIMIT):
+                stream.read()
+            else:
+                reusable = False
+        elif parse_response:
+            body = stream.read()
+            if body:
+                result = ET.fromstring(body)
+        else:
+            stream.read()
+        record.update(bytes_in=counter.count, content_in=stream.count,
+                      transfer=time.time() - received)
+        return result, reusable
+
+    def send(self, verb, path, doc, parse_response=True, decoder=None,
+             idempotent=None):
+        if idempotent is None:
+            idempotent = verb in self.IDEMPOTENT_VERBS
+        headers, doc, cookies, record = self.prepare(verb, path, doc)
+        conn, reused = self.pool.acquire()
+        written = False
+        try:
+            try:
+                sent = time.time()
+                conn.request(verb, "/deployit/{}".format(path), doc, headers)
+                written = True
+                response = conn.getresponse()
+            except (http_client.BadStatusLine, socket.error):
+                if not self.replayable(self.pool, conn, reused, written, idempotent):
+                    raise
+                conn, reused = self.pool.acquire(fresh=True)
+                sent = time.time()
+                conn.request(verb, "/deployit/{}".format(path), doc, headers)
+                response = conn.getresponse()
+            result, reusable = self.receive(response, conn, reused, sent, record,
+                                            decoder, parse_response)
+        except Exception:
+            self.pool.discard(conn)
+            raise
+        finally:
+            record['total'] = time.time() - record['started']
+            self.stats.record(record)
+
+        if response.will_close or not reusable:
+            self.pool.discard(conn)
+        else:
+            self.pool.release(conn)
+
+        self.check_response(response.status, response.reason, cookies,
+                            set_cookies(response), response.getheader('Retry-After'))
+        return result
+
+    def keep_session(self, received):
+        cookies = dict(self.cookies)
+        cookies.update(received)
+        cookies = dict((k, v) for k, v in cookies.items() if v)
+        if cookies != self.cookies:
+            self.cookies = cookies
+            self.sessions.put(cookies)
+
+    def drop_session(self, cookies):
+        # another thread may already have opened a new session
+        if self.cookies is cookies:
+            self.cookies = {}
+            self.sessions.invalidate()
+
+    def report(self):
+        """ the connection and request statistics returned by the modules"""
+        connections = dict(created=0, reused=0, discarded=0)
+        for pool in self.pools:
+            for key, value in pool.stats().items():
+                connections[key] += value
+        return dict(connections=connections, xld_stats=self.stats.summary())
+
+    def close(self):
+        self.pool.clear()
+        self.stats.close()
+
+    def type_descriptor(self, typename):
+        descriptors = self.metadata_cache.get(typename)
+        if descriptors is None:
+            doc = self.do_get("metadata/type/{}".format(typename))
+            descriptors = dict((pd.attrib['name'], dict(pd.attrib))
+                               for pd in doc.iter('property-descriptor'))
+            self.metadata_cache.put(typename, descriptors)
+        return descriptors
+
+    def property_descriptors(self, typename):
+        return dict((name, pd['kind'])
+                    for name, pd in self.type_descriptor(typename).items())
+
+    def codec(self, typename):
+        codec = self._codecs.get(typename)
+        if codec is None:
+            codec = self._codecs[typename] = TypeCodec(
+                typename, self.property_descriptors(typename))
+        return codec
+
+    def __str__(self):
+        return "[endpoint={}, username={}]".format(self.endpoint, self.username)
+
+
+def async_engine(communicator, concurrency=16):
+    """ the asyncio engine over communicator, None where the python of the
+    target has no asyncio coroutines (before 3.5)"""
+    try:
+        from ansible.module_utils.xldeploy_async import AsyncCommunicator
+    except (ImportError, SyntaxError):
+        return None
+    return AsyncCommunicator(communicator, concurrency)
+
+
+class RepositoryService:
+    """ Access to the repository REST service"""
+
+    def __init__(self, communicator=None):
+        self.communicator = communicator
+
+    def decode(self, stream):
+        return ConfigurationItem.from_stream(stream, self.communicator)
+
+    def decode_list(self, stream):
+        return list(ConfigurationItem.iter_stream(stream, self.communicator, 2))
+
+    def read(self, id):
+        return self.communicator.do_get('repository/ci/{}'.format(id),
+                                        self.decode)
+
+    def read_if_exists(self, id):
+        """ reads the CI in a single request, None if it does not exist"""
+        try:
+            return self.communicator.do_get('repository/ci/{}'.format(id),
+                                            self.decode)
+        except XLDeployException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def read_token(self, id):
+        """ the token of the CI, None if it does not exist; the CI itself is
+        neither decoded nor, beyond its first bytes, downloaded"""
+        try:
+            return self.communicator.do_get('repository/ci/{}'.format(id),
+                                            ConfigurationItem.token_from_stream)
+        except XLDeployException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def exists(self, id):
+        doc = self.communicator.do_get('repository/exists/{}'.format(id))
+        return "true" in doc.text
+
+    def read_each(self, ids, engine=None):
+        """ {id: CI or None}, one request per id; all in flight at once over
+        the asyncio engine when one is given"""
+        if engine is not None:
+            return engine.repository().read_each(ids)
+        return dict((id, self.read_if_exists(id)) for id in ids)
+
+    def exists_each(self, ids, engine=None):
+        """ {id: bool}, one request per id; all in flight at once over the
+        asyncio engine when one is given"""
+        if engine is not None:
+            return engine.repository().exists_each(ids)
+        return dict((id, self.exists(id)) for id in ids)
+
+    def update(self, ci):
+        doc = ConfigurationItem.to_xml(ci, self.communicator)
+        return self.communicator.do_put('repository/ci/{}'.format(ci.id), doc,
+                                        self.decode)
+
+    def create(self, ci):
+        doc = ConfigurationItem.to_xml(ci, self.communicator)
+        return self.communicator.do_post('repository/ci/{}'.format(ci.id), doc,
+                                         decoder=self.decode)
+
+    def delete(self, id):
+        self.communicator.do_delete("repository/ci/{}".format(id))
+
+    def read_many(self, ids):
+        return self.communicator.do_post('repository/cis/read',
+                                         ConfigurationItem.refs_to_xml(ids),
+                                         decoder=self.decode_list,
+                                         idempotent=True)
+
+    def update_many(self, cis):
+        doc = ConfigurationItem.list_to_xml(cis, self.communicator)
+        return self.communicator.do_put('repository/cis', doc, self.decode_list)
+
+    def create_many(self, cis):
+        doc = ConfigurationItem.list_to_xml(cis, self.communicator)
+        return self.communicator.do_post('repository/cis', doc,
+                                         decoder=self.decode_list)
+
+    def delete_many(self, ids):
+        self.communicator.do_post('repository/cis/delete',
+                                  ConfigurationItem.refs_to_xml(ids), False)
+
+    def query(self, type=None, parent=None, ancestor=None, name_pattern=None,
+              page_size=100):
+        """ yields the (id, type) of the matching CIs, one page at a time"""
+        criteria = [('type', type), ('parent', parent), ('ancestor', ancestor),
+                    ('namePattern', name_pattern)]
+        criteria = [(k, v) for k, v in criteria if v is not None]
+        page = 0
+        while True:
+            doc = self.communicator.do_get('repository/query?{}'.format(urlencode(
+                criteria + [('page', page), ('resultsPerPage', page_size)])))
+            refs = [(ci.attrib['ref'], ci.attrib.get('type')) for ci in doc]
+            for ref in refs:
+                yield ref
+            if len(refs) < page_size:
+                return
+            page += 1
+
+    def read_all(self, ids, batch_size=100):
+        """ yields the full CIs, reading them batch_size at a time"""
+        batch = []
+        for id in ids:
+            batch.append(id)
+            if len(batch) == batch_size:
+                for ci in self.read_many(batch):
+                    yield ci
+                batch = []
+        if batch:
+            for ci in self.read_many(batch):
+                yield ci
+
+
+XML_PROLOG = '<?xml version="1.0" encoding="UTF-8"?>'
+
+
+def escape_text(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def escape_attribute(text):
+    return escape_text(text).replace('"', '&quot;')
+
+
+def encode_text(write, key, value):
+    write('<{0}>{1}</{0}>'.format(key, escape_text(str(value))))
+
+
+def join_escaped(values, escape, separator):
+    """ the values escaped one by one and joined with separator; values with
+    nothing to escape, the usual case, are joined as they are"""
+    text = ''.join(values)
+    if '&' in text or '<' in text or '>' in text or '"' in text:
+        values = map(escape, values)
+    return separator.join(values)
+
+
+def encode_strings(write, key, value):
+    write('<{}>'.format(key))
+    if value:
+        write('<value>{}</value>'.format(join_escaped(value, escape_text, '</value><value>')))
+    write('</{}>'.format(key))
+
+
+def encode_refs(write, key, value):
+    write('<{}>'.format(key))
+    if value:
+        write('<ci ref="{}"/>'.format(join_escaped(value, escape_attribute, '"/><ci ref="')))
+    write('</{}>'.format(key))
+
+
+def encode_map(write, key, value):
+    if isinstance(value, Mapping):
+        value = value.items()
+    write('<{}>'.format(key))
+    write(''.join(['<entry key="{}">{}</entry>'.format(escape_attribute(k), escape_text(v))
+                   for k, v in value]))
+    write('</{}>'.format(key))
+
+
+def encode_ref(write, key, value):
+    write('<{} ref="{}"/>'.format(key, escape_attribute(value)))
+
+
+def decode_text(xml):
+    return xml.text
+
+
+NO_ITEM_DECODER = (None, None)
+
+
+class TypeCodec:
+    """ The encoder and decoders of every property of a CI type, compiled once
+    from its descriptors: encoding writes escaped XML text straight to the
+    given write function, decoding is a lookup by property name"""
+
+    ENCODERS = {
+        'SET_OF_STRING': encode_strings,
+        'LIST_OF_STRING': encode_strings,
+        'SET_OF_CI': encode_refs,
+        'LIST_OF_CI': encode_refs,
+        'MAP_STRING_STRING': encode_map,
+        'CI': encode_ref
+    }
+
+    def __init__(self, typename, kinds):
+        self.typename = typename
+        self.kinds = kinds
+        self.encoders = dict((name, self.ENCODERS.get(kind, encode_text))
+                             for name, kind in kinds.items())
+        self.decoders = dict((name, ConfigurationItem.DECODERS.get(kind, decode_text))
+                             for name, kind in kinds.items())
+        self.item_decoders = dict((name, (ConfigurationItem.ITEM_DECODERS.get(kind),
+                                          ConfigurationItem.BUILDERS.get(kind)))
+                                  for name, kind in kinds.items())
+
+    def decode(self, xml):
+        return self.decoders.get(xml.tag, decode_text)(xml)
+
+    def encode(self, item, write):
+        encoders = self.encoders
+        write('<{} id="{}">'.format(self.typename, escape_attribute(item.id)))
+        for key, value in item.properties.raw_items():
+            encoder = encoders.get(key)
+            if encoder is None:
+                raise Exception("'{}' is not a property of '{}'".format(key, self.typename))
+            encoder(write, key, value)
+        write('</{}>'.format(self.typename))
+
+
+class RootAttributes:
+    """ XMLParser target keeping the attributes of the root element"""
+
+    def __init__(self):
+        self.attrib = None
+
+    def start(self, tag, attrib):
+        if self.attrib is None:
+            self.attrib = attrib
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self.attrib
+
+
+def plain(value):
+    """ the list, dict or scalar form of a property value"""
+    if isinstance(value, Set):
+        return sorted(value)
+    if isinstance(value, Mapping):
+        return dict(value)
+    if isinstance(value, (tuple, MergedList)):
+        return list(value)
+    return value
+
+
+class MergedSet(Set):
+    """ A set extended with new members, sharing the original set. The added
+    members are known not to be in it already."""
+
+    __slots__ = ('base', 'added')
+
+    def __init__(self, base, added):
+        self.base = base
+        self.added = frozenset(added)
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return frozenset(iterable)
+
+    def __contains__(self, value):
+        return value in self.added or value in self.base
+
+    def __iter__(self):
+        return itertools.chain(self.base, self.added)
+
+    def __len__(self):
+        return len(self.base) + len(self.added)
+
+
+class MergedList(Sequence):
+    """ A list extended with the values it does not hold yet, sharing the
+    original list. The added values are known not to be in it already."""
+
+    __slots__ = ('base', 'added')
+
+    def __init__(self, base, added):
+        self.base = base
+        self.added = tuple(added)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('MergedList index out of range')
+        if index < len(self.base):
+            return self.base[index]
+        return self.added[index - len(self.base)]
+
+    def __iter__(self):
+        return itertools.chain(self.base, self.added)
+
+    def __len__(self):
+        return len(self.base) + len(self.added)
+
+
+class MergedMap(Mapping):
+    """ A map with some entries added or replaced, sharing the original map"""
+
+    __slots__ = ('base', 'changed', '_size')
+
+    def __init__(self, base, changed):
+        self.base = base
+        self.changed = dict(changed)
+        self._size = len(base) + sum(1 for k in self.changed if k not in base)
+
+    def __getitem__(self, key):
+        if key in self.changed:
+            return self.changed[key]
+        return self.base[key]
+
+    def __iter__(self):
+        return itertools.chain(self.base, (k for k in self.changed if k not in self.base))
+
+    def __len__(self):
+        return self._size
+
+
+class Properties(MutableMapping):
+    """ The properties of a CI. Decoded collections are kept as the list of
+    their items and only built into a value when first accessed."""
+
+    __slots__ = ('_values', '_raw')
+
+    def __init__(self, values=None):
+        self._values = dict(values or {})
+        self._raw = {}
+
+    def set_raw(self, key, build, items):
+        self._values.pop(key, None)
+        self._raw[key] = (build, items)
+
+    def raw_items(self):
+        """ yields the (key, value) pairs, the collections not accessed yet as their items"""
+        for item in self._values.items():
+            yield item
+        for key, (_, items) in self._raw.items():
+            yield key, items
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        build, items = self._raw.pop(key)
+        value = self._values[key] = build(items)
+        return value
+
+    def __setitem__(self, key, value):
+        self._raw.pop(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key in self._raw:
+            del self._raw[key]
+        else:
+            del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values or key in self._raw
+
+    def __iter__(self):
+        return itertools.chain(list(self._values), list(self._raw))
+
+    def __len__(self):
+        return len(self._values) + len(self._raw)
+
+    def __repr__(self):
+        return repr(dict((k, plain(v)) for k, v in self.items()))
+
+
+class ConfigurationItem(object):
+    """ an XL Deploy Configuration item"""
+
+    __slots__ = ('id', 'type', 'properties', 'token')
+
+    def __init__(self, type, id, properties, token=None):
+        self.id = id
+        self.type = type
+        self.properties = properties if isinstance(properties, Properties) else Properties(properties)
+        self.token = token
+
+    def __str__(self):
+        return "{} {} {}".format(
+            self.id, self.type,
+            dict((k, "********" if k == "password" else plain(v))
+                 for k, v in self.properties.items()))
+
+    def __eq__(self, other):
+        return self.id == other.id and self.type == other.type and self.properties == other.properties
+
+    def to_dict(self):
+        return dict(id=self.id, type=self.type,
+                    properties=dict((k, plain(v)) for k, v in self.properties.items()))
+
+    DECODERS = {
+        'SET_OF_STRING': lambda xml: frozenset(e.text for e in xml),
+        'LIST_OF_STRING': lambda xml: tuple(e.text for e in xml),
+        'SET_OF_CI': lambda xml: frozenset(e.attrib['ref'] for e in xml),
+        'LIST_OF_CI': lambda xml: tuple(e.attrib['ref'] for e in xml),
+        'MAP_STRING_STRING': lambda xml: dict((child.attrib['key'], child.text) for child in xml),
+        'CI': lambda xml: xml.attrib['ref']
+    }
+
+    ITEM_DECODERS = {
+        'SET_OF_STRING': lambda e: e.text,
+        'LIST_OF_STRING': lambda e: e.text,
+        'SET_OF_CI': lambda e: e.attrib['ref'],
+        'LIST_OF_CI': lambda e: e.attrib['ref'],
+        'MAP_STRING_STRING': lambda e: (e.attrib['key'], e.text)
+    }
+
+    BUILDERS = {
+        'SET_OF_STRING': frozenset,
+        'LIST_OF_STRING': tuple,
+        'SET_OF_CI': frozenset,
+        'LIST_OF_CI': tuple,
+        'MAP_STRING_STRING': dict
+    }
+
+    @staticmethod
+    def token_of(attrib):
+        """ the version the server gives a CI, changed by every modification"""
+        return attrib.get('token') or attrib.get('last-modified-at')
+
+    @staticmethod
+    def token_from_stream(stream, size=1024):
+        """ reads the stream until the start tag of the CI only"""
+        target = RootAttributes()
+        parser = ET.XMLParser(target=target)
+        while target.attrib is None:
+            data = stream.read(size)
+            if not data:
+                return None
+            parser.feed(data)
+        return ConfigurationItem.token_of(target.attrib)
+
+    @staticmethod
+    def from_stream(stream, communicator):
+        for ci in ConfigurationItem.iter_stream(stream, communicator, 1):
+            return ci
+
+    @staticmethod
+    def iter_stream(stream, communicator, level):
+        """ decodes the CIs found at the given depth of an XML stream while it
+        is read: collection items are decoded and dropped one by one, so no
+        full document tree is ever built"""
+        depth = 0
+        for event, xml in ET.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == level:
+                    ci = ConfigurationItem(xml.tag, xml.attrib['id'], {},
+                                           ConfigurationItem.token_of(xml.attrib))
+                    codec = communicator.codec(xml.tag)
+                elif depth == level + 1:
+                    prop = xml
+                    item_decoder, build = codec.item_decoders.get(xml.tag, NO_ITEM_DECODER)
+                    values = []
+                continue
+            depth -= 1
+            if depth == level + 1 and item_decoder is not None:
+                values.append(item_decoder(xml))
+                prop.remove(xml)
+            elif depth == level:
+                if item_decoder is None:
+                    ci.properties[xml.tag] = codec.decode(xml)
+                else:
+                    ci.properties.set_raw(xml.tag, build, values)
+                xml.clear()
+            elif depth == level - 1:
+                xml.clear()
+                yield ci
+            elif depth < level - 1:
+                xml.clear()
+
+    @staticmethod
+    def to_xml(item, communicator):
+        out = [XML_PROLOG]
+        communicator.codec(item.type).encode(item, out.append)
+        return ''.join(out).encode('utf-8')
+
+    @staticmethod
+    def list_to_xml(items, communicator):
+        out = [XML_PROLOG, '<list>']
+        for item in items:
+            communicator.codec(item.type).encode(item, out.append)
+        out.append('</list>')
+        return ''.join(out).encode('utf-8')
+
+    @staticmethod
+    def refs_to_xml(ids):
+        out = [XML_PROLOG, '<list>']
+        out.extend('<ci ref="{}"/>'.format(escape_attribute(id)) for id in ids)
+        out.append('</list>')
+        return ''.join(out).encode('utf-8')
+
+    @staticmethod
+    def check(item, communicator):
+        descriptors = communicator.property_descriptors(item.type)
+        for key in item.properties:
+            if not key in descriptors:
+                raise Exception("'{}' is not a property of '{}'".format(key,
+                                                                    item.type))
+        return descriptors
+
+
+class PropertyDiff:
+    """ Structural comparison of CI properties, driven by the type descriptors
+
+    Values are normalized per kind before being compared: sets and lists of
+    strings or CI references, string maps, CI references and scalars. In 'add'
+    mode collections and maps only need to contain the desired values: the
+    desired values are looked up in the existing set, or an index of the
+    existing list built once, and the change is the existing value extended
+    with the missing ones, without copying it. Encrypted password values can
+    not be compared: they count as changed only when update_password is
+    'always'. In 'replace' mode the existing properties the desired CI omits
+    count as changed too, unless they are empty or have their default value,
+    as writing the CI back resets them."""
+
+    ENCRYPTED_PREFIXES = ('{b64}', '{aes:')
+
+    def __init__(self, descriptors, update_mode='replace', update_password='always'):
+        self.descriptors = descriptors
+        self.update_mode = update_mode
+        self.update_password = update_password
+
+    def kind(self, key):
+        return self.descriptors.get(key, {}).get('kind')
+
+    def is_password(self, key):
+        return self.descriptors.get(key, {}).get('password') == 'true'
+
+    def normalize(self, key, value):
+        kind = self.kind(key)
+        if kind in ('SET_OF_STRING', 'SET_OF_CI'):
+            if isinstance(value, frozenset):
+                return value
+            return frozenset(str(v) for v in value or [])
+        if kind in ('LIST_OF_STRING', 'LIST_OF_CI'):
+            if isinstance(value, tuple):
+                return value
+            return tuple(str(v) for v in value or [])
+        if kind == 'MAP_STRING_STRING':
+            return dict((str(k), '' if v is None else str(v))
+                        for k, v in (value or {}).items())
+        if value is None:
+            return ''
+        if kind == 'BOOLEAN':
+            return str(value).lower()
+        return str(value)
+
+    def default(self, key):
+        """ the normalized value a property omitted from a written CI takes"""
+        empty = self.normalize(key, None)
+        value = self.descriptors.get(key, {}).get('default')
+        if value is None or not isinstance(empty, str):
+            return empty
+        return self.normalize(key, value)
+
+    def missing(self, existing, desired):
+        """ the desired values of a collection or map that existing lacks, in
+        their desired order for lists"""
+        if isinstance(desired, dict):
+            return dict((k, v) for k, v in desired.items() if existing.get(k) != v)
+        index = existing if isinstance(existing, Set) else frozenset(existing)
+        missing = []
+        seen = set()
+        for value in desired:
+            if value not in index and value not in seen:
+                seen.add(value)
+                missing.append(value)
+        return tuple(missing) if isinstance(desired, tuple) else frozenset(missing)
+
+    def merged(self, existing, missing):
+        """ the value an 'add' update leaves on the server, sharing existing"""
+        if isinstance(missing, dict):
+            return MergedMap(existing, missing)
+        if isinstance(missing, tuple):
+            return MergedList(existing, missing)
+        if isinstance(missing, frozenset):
+            return MergedSet(existing, missing)
+        return missing
+
+    def compare(self, existing_ci, desired_ci):
+        """ returns {key: (before, after)} for the properties that differ"""
+        changes = {}
+        if existing_ci.type != desired_ci.type:
+            changes['type'] = (existing_ci.type, desired_ci.type)
+        for key, value in desired_ci.properties.items():
+            before = self.normalize(key, existing_ci.properties.get(key))
+            after = self.normalize(key, value)
+            if self.is_password(key) and before.startswith(self.ENCRYPTED_PREFIXES):
+                if self.update_password == 'always':
+                    changes[key] = (before, after)
+            elif self.update_mode == 'add' and isinstance(after, (frozenset, tuple, dict)):
+                missing = self.missing(before, after)
+                if missing:
+                    changes[key] = (before, self.merged(before, missing))
+            elif before != after:
+                changes[key] = (before, after)
+        if self.update_mode == 'replace':
+            for key, value in existing_ci.properties.items():
+                if key not in desired_ci.properties:
+                    before = self.normalize(key, value)
+                    after = self.default(key)
+                    if before and before != after:
+                        changes[key] = (before, after)
+        return changes
+
+    def kept_passwords(self, existing_ci, desired_ci):
+        """ the encrypted values of the desired passwords that update_password
+        leaves as they are, to send back in place of the desired ones"""
+        kept = {}
+        if self.update_password == 'always':
+            return kept
+        for key in desired_ci.properties:
+            if self.is_password(key):
+                before = existing_ci.properties.get(key)
+                if self.normalize(key, before).startswith(self.ENCRYPTED_PREFIXES):
+                    kept[key] = before
+        return kept
+
+    def as_diff(self, id, changes):
+        """ the before/after dicts reported by --diff"""
+        def show(key, value):
+            if self.is_password(key):
+                return "********"
+            return plain(value)
+        return dict(
+            before_header=id, after_header=id,
+            before=dict((k, show(k, v[0])) for k, v in changes.items()),
+            after=dict((k, show(k, v[1])) for k, v in changes.items()))
+
+
+class ReconciliationScheduler:
+    """ Applies CI changes on a bounded thread pool, parents before children
+
+    Creates and updates wait for their closest planned ancestor, deletes wait
+    for all their planned descendants. When a change fails, the changes that
+    depend on it are skipped."""
+
+    def __init__(self, repository, concurrency=4):
+        self.repository = repository
+        self.concurrency = max(1, concurrency)
+
+    def _apply(self, action, ci):
+        if action == 'create':
+            self.repository.create(ci)
+        elif action == 'update':
+            self.repository.update(ci)
+        else:
+            self.repository.delete(ci.id)
+
+    def run(self, changes):
+        """ changes is a list of (action, ci), returns the list of errors (None on success)"""
+        errors = [None] * len(changes)
+        upserts = [i for i, (action, _) in enumerate(changes) if action != 'delete']
+        deletes = [i for i, (action, _) in enumerate(changes) if action == 'delete']
+        self._run_phase(changes, upserts, False, errors)
+        self._run_phase(changes, deletes, True, errors)
+        return errors
+
+    def _run_phase(self, changes, indexes, children_first, errors):
+        if not indexes:
+            return
+        by_id = dict((changes[i][1].id, i) for i in indexes)
+        waits_for = dict((i, set()) for i in indexes)
+        unblocks = dict((i, []) for i in indexes)
+        for i in indexes:
+            parent = changes[i][1].id
+            while '/' in parent:
+                parent = parent.rsplit('/', 1)[0]
+                if parent in by_id:
+                    before, after = by_id[parent], i
+                    if children_first:
+                        before, after = after, before
+                    waits_for[after].add(before)
+                    unblocks[before].append(after)
+                    # a delete waits for every descendant, a create for its closest ancestor
+                    if not children_first:
+                        break
+
+        lock = threading.Lock()
+        ready = queue.Queue()
+        remaining = [len(indexes)]
+        done = threading.Event()
+
+        def finish(i, error):
+            # called with the lock held
+            errors[i] = error
+            remaining[0] -= 1
+            for j in unblocks[i]:
+                if j not in waits_for:
+                    continue
+                waits_for[j].discard(i)
+                if error is not None and errors[j] is None:
+                    del waits_for[j]
+                    finish(j, "skipped, {} failed".format(changes[i][1].id))
+                elif not waits_for[j]:
+                    del waits_for[j]
+                    ready.put(j)
+            if not remaining[0]:
+                done.set()
+
+        def worker():
+            while True:
+                i = ready.get()
+                if i is None:
+                    return
+                action, ci = changes[i]
+                try:
+                    self._apply(action, ci)
+                    error = None
+                except Exception as e:
+                    error = str(e)
+                with lock:
+                    finish(i, error)
+
+        with lock:
+            for i in sorted(indexes):
+                if not waits_for[i]:
+                    del waits_for[i]
+                    ready.put(i)
+
+        workers = [threading.Thread(target=worker)
+                   for _ in range(min(self.concurrency, len(indexes)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        done.wait()
+        for _ in workers:
+            ready.put(None)
+        for thread in workers:
+            thread.join()
+
+
+def reconcile(ci, existing_ci, state, update_mode, communicator,
+              update_password='always', diff=True):
+    """ returns the (action, ci, msg, diff) bringing existing_ci to the desired ci,
+    the diff being None unless asked for"""
+    if state == 'absent':
+        if existing_ci is None:
+            return None, None, "{} already absent".format(ci.id), None
+        return 'delete', ci, "Delete {}".format(ci), None
+    differ = PropertyDiff(communicator.type_descriptor(ci.type), update_mode,
+                          update_password)
+    if existing_ci is None:
+        if not diff:
+            return 'create', ci, "Create {}".format(ci), None
+        changes = dict((key, (differ.normalize(key, None), differ.normalize(key, value)))
+                       for key, value in ci.properties.items())
+        return 'create', ci, "Create {}".format(ci), differ.as_diff(ci.id, changes)
+    changes = differ.compare(existing_ci, ci)
+    if not changes:
+        return None, None, "{} already up to date".format(ci.id), None
+    diff = differ.as_diff(ci.id, changes) if diff else None
+    if update_mode == 'replace':
+        # the whole CI is sent: the passwords set on creation only go back encrypted
+        kept = differ.kept_passwords(existing_ci, ci)
+        if kept:
+            properties = dict(ci.properties)
+            properties.update(kept)
+            ci = ConfigurationItem(ci.type, ci.id, properties, ci.token)
+        return 'update', ci, "[REPLACE] Update {}, previous {}".format(
+            ci, existing_ci), diff
+    # the existing CI takes the changed values only, its collections and maps
+    # extended without being copied; it keeps its own type
+    for key, (_, after) in changes.items():
+        if key != 'type':
+            existing_ci.properties[key] = after
+    msg = "[ADD] Update {}, changed {}".format(ci, ", ".join(sorted(changes)))
+    return 'update', existing_ci, msg, diff
+
+
+def apply_planned(repository, planned, batch_size=100, concurrency=1):
+    """ applies the planned {'create'|'update'|'delete': [(key, ci)]} changes
+    and returns {key: error} for those that failed. Parents are created
+    before their children and deleted after them. A batch the server
+    rejects, which it applies none of, is applied again one CI at a time to
+    tell the failing CIs from the others."""
+    errors = {}
+    if concurrency > 1:
+        keys = []
+        changes = []
+        for action in ('create', 'update', 'delete'):
+            for key, target in planned.get(action, []):
+                keys.append(key)
+                changes.append((action, target))
+        repository.communicator.set_concurrency(concurrency)
+        for key, error in zip(keys, ReconciliationScheduler(repository, concurrency).run(changes)):
+            if error is not None:
+                errors[key] = error
+        return errors
+
+    apply = dict(
+        create=repository.create_many,
+        update=repository.update_many,
+        delete=lambda cis: repository.delete_many([ci.id for ci in cis]))
+    order = dict(create=lambda t: depth(t[1].id), update=None,
+                 delete=lambda t: -depth(t[1].id))
+    for action in ('create', 'update', 'delete'):
+        changes = planned.get(action, [])
+        if order[action] is not None:
+            changes = sorted(changes, key=order[action])
+        for batch in chunks(changes, batch_size):
+            try:
+                apply[action]([target for _, target in batch])
+            except XLDeployException as e:
+                if len(batch) == 1 or not 400 <= e.status < 500:
+                    for key, _ in batch:
+                        errors[key] = e
+                    continue
+                for key, target in batch:
+                    try:
+                        apply[action]([target])
+                    except Exception as e:
+                        errors[key] = e
+            except Exception as e:
+                for key, _ in batch:
+                    errors[key] = e
+    return errors
+
+
+def depth(id):
+    return id.count('/')
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio engine for the XL Deploy REST client.
+
+It has the do_get/do_put/do_post/do_delete surface of XLDeployCommunicator,
+whose credentials, session, statistics, AIMD limit and type codecs it shares,
+and keeps hundreds of existence checks, permission checks or CI reads in
+flight at once over a small pool of keep-alive connections. It needs python 3.5 or later:
+the modules get it through xldeploy.async_engine, which returns None elsewhere.
+"""
+
+import asyncio
+import collections
+import io
+import socket
+import time
+
+from ansible.module_utils.xldeploy import (
+    ConfigurationItem, SessionExpired, XLDeployException, http_client, parse_cookies,
+    ssl, urlparse)
+
+
+class AsyncConnection:
+    """ A keep-alive HTTP/1.1 connection, with the timings of its opening"""
+
+    def __init__(self, reader, writer, timings):
+        self.reader = reader
+        self.writer = writer
+        self.timings = timings
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncConnectionPool:
+    """ Keep-alive connections to a single XL Deploy endpoint, for one event loop"""
+
+    def __init__(self, endpoint, validate_certs=True, maxsize=16):
+        parsed_url = urlparse(endpoint)
+        self.scheme = parsed_url.scheme
+        self.hostname = parsed_url.hostname
+        self.port = parsed_url.port or (443 if self.scheme == "https" else 80)
+        self.host = parsed_url.netloc.rpartition('@')[2]
+        self.validate_certs = validate_certs
+        self.maxsize = maxsize
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self._idle = []
+        self._ssl_context = None
+
+    async def _connect(self):
+        """ the TLS handshake is counted in the connect timing"""
+        context = None
+        if self.scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = (ssl.create_default_context() if self.validate_certs
+                                     else ssl._create_unverified_context())
+            context = self._ssl_context
+        loop = asyncio.get_event_loop()
+        started = time.time()
+        addresses = await loop.getaddrinfo(self.hostname, self.port,
+                                           type=socket.SOCK_STREAM)
+        resolved = time.time()
+        error = None
+        for family, socktype, proto, _, address in addresses:
+            try:
+                reader, writer = await asyncio.open_connection(
+                    address[0], address[1], ssl=context, family=family, proto=proto,
+                    server_hostname=self.hostname if context else None)
+            except OSError as e:
+                error = e
+                continue
+            break
+        else:
+            # no answer from the server, which is not a sign of its overload
+            error.connecting = True
+            raise error
+        return AsyncConnection(reader, writer, dict(
+            dns=resolved - started, connect=time.time() - resolved, tls=0.0))
+
+    async def acquire(self, fresh=False):
+        """ returns a (connection, reused) tuple, skipping the idle connections
+        the server already closed"""
+        while self._idle and not fresh:
+            conn = self._idle.pop()
+            if conn.reader.at_eof():
+                self.discard(conn)
+                continue
+            self.reused += 1
+            return conn, True
+        self.created += 1
+        return await self._connect(), False
+
+    def release(self, conn):
+        if len(self._idle) < self.maxsize:
+            self._idle.append(conn)
+        else:
+            conn.close()
+
+    def discard(self, conn):
+        self.discarded += 1
+        conn.close()
+
+    def clear(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        return dict(created=self.created, reused=self.reused,
+                    discarded=self.discarded)
+
+
+class AsyncLimiter:
+    """ The cap of the requests in flight of an asyncio engine, following the
+    AIMD limit of the communicator: the engine keeps the share of its
+    concurrency the limit leaves to the blocking requests, and its requests
+    move the limit the same way."""
+
+    def __init__(self, limiter, concurrency):
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self._waiters = collections.deque()
+
+    def cap(self):
+        return max(1, int(self.concurrency * self.limiter.limit / self.limiter.maximum))
+
+    async def acquire(self):
+        while self.in_flight >= self.cap():
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+
+    def release(self, overloaded=False):
+        self.in_flight -= 1
+        self.limiter.adjust(overloaded)
+        free = self.cap() - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class AsyncResponse:
+    """ The status, headers and whole body of an HTTP/1.1 response, read like
+    the responses of http.client"""
+
+    def __init__(self, status, reason, headers, body, will_close):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.will_close = will_close
+        self._stream = None
+
+    def read(self, size=None):
+        if self._stream is None:
+            self._stream = io.BytesIO(self.body)
+        return self._stream.read(size)
+
+    def isclosed(self):
+        # the whole body is off the connection already
+        return True
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key == name:
+                return value
+        return default
+
+    def getheaders(self, name):
+        name = name.lower()
+        return [value for key, value in self.headers if key == name]
+
+
+async def read_response(reader, verb):
+    """ reads a response off the connection, with a Content-Length or chunked
+    body, or one delimited by the closing of the connection"""
+    try:
+        line = await reader.readline()
+        if not line:
+            raise http_client.BadStatusLine(line)
+        version, _, rest = line.decode('latin-1').strip().partition(' ')
+        status, _, reason = rest.partition(' ')
+        if not version.startswith('HTTP/') or not status.isdigit():
+            raise http_client.BadStatusLine(line)
+        headers = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.append((name.strip().lower(), value.strip()))
+        response = AsyncResponse(int(status), reason, headers, b'', False)
+        connection = (response.getheader('Connection') or '').lower()
+        response.will_close = connection == 'close' or (
+            version == 'HTTP/1.0' and connection != 'keep-alive')
+
+        if verb == 'HEAD' or response.status in (204, 304) or response.status < 200:
+            return response
+        if 'chunked' in (response.getheader('Transfer-Encoding') or '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            response.body = b''.join(chunks)
+        elif response.getheader('Content-Length') is not None:
+            response.body = await reader.readexactly(int(response.getheader('Content-Length')))
+        else:
+            response.body = await reader.read()
+            response.will_close = True
+        return response
+    except asyncio.IncompleteReadError as e:
+        raise http_client.IncompleteRead(e.partial)
+
+
+class AsyncCommunicator:
+    """ XL Deploy Communicator over asyncio, sharing the credentials, the
+    session, the statistics and the codecs of an XLDeployCommunicator.
+
+    Its coroutines run under a cap of up to concurrency requests in flight,
+    which follows the AIMD limiter of the communicator; run and map call them
+    from synchronous code, on an event loop of their own."""
+
+    def __init__(self, communicator, concurrency=16):
+        self.communicator = communicator
+        self.concurrency = concurrency
+        self.pool = AsyncConnectionPool(communicator.endpoint,
+                                        communicator.validate_certs, concurrency)
+        communicator.pools.append(self.pool)
+        self._limit = None
+
+    async def do_get(self, path, decoder=None):
+        return await self.do_it("GET", path, "", decoder=decoder)
+
+    async def do_put(self, path, doc="", decoder=None):
+        return await self.do_it("PUT", path, doc, decoder=decoder)
+
+    async def do_post(self, path, doc, parse_response=True, decoder=None,
+                      idempotent=False):
+        return await self.do_it("POST", path, doc, parse_response, decoder,
+                                idempotent)
+
+    async def do_delete(self, path):
+        return await self.do_it("DELETE", path, "", False)
+
+    async def do_it(self, verb, path, doc, parse_response=True, decoder=None,
+                    idempotent=None):
+        """ the retries of XLDeployCommunicator.do_it, waiting without
+        blocking the other requests in flight"""
+        communicator = self.communicator
+        if idempotent is None:
+            idempotent = verb in communicator.IDEMPOTENT_VERBS
+        if self._limit is None:
+            self._limit = AsyncLimiter(communicator.limiter, self.concurrency)
+        attempt = 0
+        while True:
+            overloaded = False
+            await self._limit.acquire()
+            try:
+                return await self.send(verb, path, doc, parse_response, decoder,
+                                       idempotent)
+            except SessionExpired:
+                # replayed with Basic auth, which opens a new session
+                continue
+            except (XLDeployException, http_client.HTTPException, OSError) as e:
+                delay, overloaded = communicator.retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise
+            finally:
+                self._limit.release(overloaded)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def write(self, conn, verb, path, doc, headers):
+        head = ["{} /deployit/{} HTTP/1.1".format(verb, path),
+                "Host: {}".format(self.pool.host),
+                "Content-Length: {}".format(len(doc))]
+        head.extend("{}: {}".format(k, v) for k, v in headers.items())
+        conn.writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + doc)
+        await conn.writer.drain()
+
+    async def send(self, verb, path, doc, parse_response=True, decoder=None,
+                   idempotent=None):
+        communicator = self.communicator
+        if idempotent is None:
+            idempotent = verb in communicator.IDEMPOTENT_VERBS
+        if not isinstance(doc, bytes):
+            doc = doc.encode('utf-8')
+        headers, doc, cookies, record = communicator.prepare(verb, path, doc)
+        conn, reused = await self.pool.acquire()
+        written = False
+        try:
+            try:
+                sent = time.time()
+                await self.write(conn, verb, path, doc, headers)
+                written = True
+                response = await read_response(conn.reader, verb)
+            except (http_client.BadStatusLine, http_client.IncompleteRead, OSError):
+                if not communicator.replayable(self.pool, conn, reused, written, idempotent):
+                    raise
+                conn, reused = await self.pool.acquire(fresh=True)
+                sent = time.time()
+                await self.write(conn, verb, path, doc, headers)
+                response = await read_response(conn.reader, verb)
+            result, _ = communicator.receive(response, conn, reused, sent, record,
+                                             decoder, parse_response)
+        except Exception:
+            self.pool.discard(conn)
+            raise
+        finally:
+            record['total'] = time.time() - record['started']
+            communicator.stats.record(record)
+
+        if response.will_close:
+            self.pool.discard(conn)
+        else:
+            self.pool.release(conn)
+
+        communicator.check_response(response.status, response.reason, cookies,
+                                    parse_cookies(response.getheaders('Set-Cookie')),
+                                    response.getheader('Retry-After'))
+        return result
+
+    def run(self, coroutine):
+        """ runs coroutine to completion from synchronous code, on an event
+        loop of its own whose connections are closed when it is done"""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._run(coroutine))
+        finally:
+            loop.close()
+
+    async def _run(self, coroutine):
+        try:
+            return await coroutine
+        finally:
+            self.pool.clear()
+            self._limit = None
+
+    def map(self, function, items):
+        """ [function(item) for item in items] from synchronous code, the
+        coroutines all in flight at once under the concurrency cap; the first
+        error is raised once they are all done"""
+        return self.run(self.gather(function(item) for item in items))
+
+    async def gather(self, coroutines):
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def repository(self):
+        return AsyncRepositoryService(self)
+
+    def __str__(self):
+        return str(self.communicator)
+
+
+class AsyncRepositoryService:
+    """ Access to the repository REST service over the asyncio engine.
+
+    Decoding a CI of a type not yet described fetches its descriptor with
+    the blocking communicator, once per type."""
+
+    def __init__(self, communicator=None):
+        self.communicator = communicator
+
+    def decode(self, stream):
+        return ConfigurationItem.from_stream(stream, self.communicator.communicator)
+
+    async def read(self, id):
+        return await self.communicator.do_get('repository/ci/{}'.format(id),
+                                              self.decode)
+
+    async def read_if_exists(self, id):
+        """ reads the CI in a single request, None if it does not exist"""
+        try:
+            return await self.communicator.do_get('repository/ci/{}'.format(id),
+                                                  self.decode)
+        except XLDeployException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    async def read_token(self, id):
+        try:
+            return await self.communicator.do_get('repository/ci/{}'.format(id),
+                                                  ConfigurationItem.token_from_stream)
+        except XLDeployException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    async def exists(self, id):
+        doc = await self.communicator.do_get('repository/exists/{}'.format(id))
+        return "true" in doc.text
+
+    def read_each(self, ids):
+        """ {id: CI or None}, the ids read all at once from synchronous code"""
+        ids = list(ids)
+        return dict(zip(ids, self.communicator.map(self.read_if_exists, ids)))
+
+    def exists_each(self, ids):
+        """ {id: bool}, the ids checked all at once from synchronous code"""
+        ids = list(ids)
+        return dict(zip(ids, self.communicator.map(self.exists, ids)))
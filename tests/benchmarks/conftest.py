@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+The benchmarks time whole module runs against a stub XL Deploy answering
+after a millisecond, the way a server on the local network would, so that
+saving requests shows in the wall time as it does in production.
+
+Each benchmark records in its extra_info the requests a task sends and the
+peak of the memory it allocates, measured by tracemalloc on one extra run
+outside of the timed rounds.
+"""
+
+import tracemalloc
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from xld_stub import XLDeployStub  # noqa: E402
+
+LATENCY = 0.001
+
+
+@pytest.fixture
+def stub():
+    with XLDeployStub(latency=LATENCY) as server:
+        yield server
+
+
+def measure_peak(function):
+    """ the result of function() and the peak of the memory it allocated"""
+    tracemalloc.start()
+    try:
+        return function(), tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture
+def peak_memory():
+    return measure_peak
+
+
+@pytest.fixture
+def measure(benchmark, stub):
+    """ benchmarks task(), setup() restoring the state of the stub before
+    each round, and returns the result of the last round"""
+    def run(task, setup=lambda: None, rounds=5):
+        def prepare():
+            setup()
+            del stub.log[:]
+        prepare()
+        _, peak = measure_peak(task)
+        prepare()
+        result = task()
+        benchmark.extra_info.update(requests=len(stub.log), peak_memory_kb=peak // 1024)
+        benchmark.pedantic(task, setup=prepare, rounds=rounds)
+        return result
+    return run
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Encoding and decoding of large CIs: a 10k-entry dictionary, a 5k-member
+environment, and the memory a 50k-member environment takes to decode.
+"""
+
+import io
+import xml.etree.ElementTree as ET
+
+from ansible.module_utils.xldeploy import ConfigurationItem, PropertyDiff
+
+
+def environment(count):
+    return ConfigurationItem('udm.Environment', 'Environments/env', dict(
+        members=['Infrastructure/h{}'.format(i) for i in range(count)]))
+
+
+def dictionary(count):
+    return ConfigurationItem('udm.Dictionary', 'Environments/dict', dict(
+        entries=dict(('key{}'.format(i), 'value & <{}>'.format(i)) for i in range(count))))
+
+
+def test_encode_dictionary(benchmark, types):
+    ci = dictionary(10000)
+    doc = benchmark(ConfigurationItem.to_xml, ci, types)
+    assert doc.count(b'<entry ') == 10000
+
+
+def test_decode_dictionary(benchmark, types):
+    doc = ConfigurationItem.to_xml(dictionary(10000), types)
+    ci = benchmark(lambda: ConfigurationItem.from_stream(io.BytesIO(doc), types))
+    assert ci.properties['entries']['key9999'] == 'value & <9999>'
+
+
+def test_encode_environment(benchmark, types):
+    ci = environment(5000)
+    doc = benchmark(ConfigurationItem.to_xml, ci, types)
+    assert doc.count(b'<ci ') == 5000
+
+
+def test_decode_environment(benchmark, types):
+    doc = ConfigurationItem.to_xml(environment(5000), types)
+    ci = benchmark(lambda: ConfigurationItem.from_stream(io.BytesIO(doc), types))
+    assert len(ci.properties['members']) == 5000
+
+
+def test_compare_environment(benchmark, types):
+    existing = environment(5000)
+    desired = environment(5000)
+    desired.properties['members'] = list(desired.properties['members']) + ['Infrastructure/new']
+    differ = PropertyDiff(types.type_descriptor('udm.Environment'))
+    changes = benchmark(differ.compare, existing, desired)
+    assert list(changes) == ['members']
+
+
+def test_decode_memory(benchmark, types, peak_memory):
+    # the members are decoded one by one off the stream and dropped from the
+    # tree: the peak is about the decoded set, a fraction of what parsing the
+    # whole document first takes
+    doc = ConfigurationItem.to_xml(environment(50000), types)
+
+    def decode():
+        ci = ConfigurationItem.from_stream(io.BytesIO(doc), types)
+        return len(ci.properties['members'])
+
+    def decode_tree():
+        return len(frozenset(e.get('ref') for e in ET.fromstring(doc)[0]))
+    members, peak = peak_memory(decode)
+    _, tree_peak = peak_memory(decode_tree)
+    benchmark.extra_info.update(document_kb=len(doc) // 1024, peak_memory_kb=peak // 1024,
+                                tree_peak_memory_kb=tree_peak // 1024)
+    benchmark.pedantic(decode, rounds=3)
+    assert members == 50000
+    assert peak < tree_peak / 2
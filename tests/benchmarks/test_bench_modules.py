@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Single CI, batch and large CI scenarios of xldeploy, xldeploy_role and
+xldeploy_permission. The caches of the modules are warm after the first run,
+as they are from the second task of a playbook on.
+"""
+
+import pytest
+
+HOSTS = 200
+MEMBERS = 5000
+ROLES = 100
+PRINCIPALS = 2000
+
+
+def host_ids(count):
+    return ['Infrastructure/h{}'.format(i) for i in range(count)]
+
+
+def reset_hosts(stub, count, os='WINDOWS'):
+    stub.repository.clear()
+    for id in host_ids(count):
+        stub.add('overthere.SshHost', id, os=os)
+
+
+# xldeploy
+
+@pytest.mark.parametrize('scenario', ['create', 'update', 'unchanged'])
+def test_xldeploy_single(measure, module, stub, scenario):
+    def setup():
+        stub.repository.clear()
+        if scenario != 'create':
+            stub.add('overthere.SshHost', 'Infrastructure/h1', os='WINDOWS')
+    os = 'WINDOWS' if scenario == 'unchanged' else 'UNIX'
+    result = measure(lambda: module('xldeploy.py', id='Infrastructure/h1',
+                                    type='overthere.SshHost', properties=dict(os=os)), setup)
+    assert result['changed'] == (scenario != 'unchanged')
+
+
+@pytest.mark.parametrize('concurrency', [1, 8])
+def test_xldeploy_batch(measure, module, stub, concurrency):
+    # half of the hosts exist, a quarter of them up to date
+    def setup():
+        reset_hosts(stub, HOSTS // 2)
+        for id in host_ids(HOSTS // 4):
+            stub.add('overthere.SshHost', id, os='UNIX')
+    items = [dict(id=id, properties=dict(os='UNIX')) for id in host_ids(HOSTS)]
+    result = measure(lambda: module('xldeploy.py', type='overthere.SshHost', items=items,
+                                    concurrency=concurrency), setup)
+    assert sum(r['changed'] for r in result['results']) == HOSTS * 3 // 4
+
+
+@pytest.mark.parametrize('update_mode', ['add', 'replace'])
+def test_xldeploy_large_ci(measure, module, stub, update_mode):
+    members = host_ids(MEMBERS)
+
+    def setup():
+        stub.repository.clear()
+        stub.add('udm.Environment', 'Environments/env', members=members)
+    desired = members[-1:] + ['Infrastructure/new'] if update_mode == 'add' \
+        else members + ['Infrastructure/new']
+    result = measure(lambda: module('xldeploy.py', id='Environments/env', type='udm.Environment',
+                                    update_mode=update_mode,
+                                    properties=dict(members=desired)), setup)
+    assert result['changed']
+
+
+# xldeploy_role
+
+def test_role_single(measure, module, stub):
+    def setup():
+        stub.roles = dict(deployers={'alice'})
+    result = measure(lambda: module('xldeploy_role.py', role='deployers', principal='bob'), setup)
+    assert result['changed']
+
+
+def test_role_batch(measure, module, stub):
+    roles = dict(('role{}'.format(i), ['user{}'.format(i), 'admin']) for i in range(ROLES))
+
+    def setup():
+        stub.roles = dict(('role{}'.format(i), {'admin'}) for i in range(0, ROLES, 2))
+    result = measure(lambda: module('xldeploy_role.py', roles=roles), setup)
+    assert result['changed']
+
+
+def test_role_large(measure, module, stub):
+    principals = ['user{}'.format(i) for i in range(PRINCIPALS)]
+
+    def setup():
+        stub.roles = dict(deployers=set(principals[1:]) | {'former'})
+    result = measure(lambda: module('xldeploy_role.py', role='deployers', principals=principals,
+                                    exclusive=True), setup)
+    assert result['added'] == ['user0'] and result['removed'] == ['former']
+
+
+# xldeploy_permission
+
+def test_permission_single(measure, module, stub):
+    def setup():
+        stub.permissions = set()
+    result = measure(lambda: module('xldeploy_permission.py', id='Environments/env',
+                                    role='deployers', permission='read'), setup)
+    assert result['changed']
+
+
+@pytest.mark.parametrize('concurrency', [1, 8])
+def test_permission_batch(measure, module, stub, concurrency):
+    ids = ['Environments/env{}'.format(i) for i in range(4)]
+    matrix = dict(('role{}'.format(i), dict((id, ['read', 'deploy#upgrade']) for id in ids))
+                  for i in range(ROLES // 2))
+
+    def setup():
+        stub.permissions = set(('read', role, id) for role in matrix for id in ids)
+    result = measure(lambda: module('xldeploy_permission.py', matrix=matrix,
+                                    concurrency=concurrency), setup)
+    assert result['granted'] == len(matrix) * len(ids)
+
+
+def test_permission_large(measure, module, stub):
+    ids = ['Environments/env{}'.format(i) for i in range(PRINCIPALS)]
+    matrix = dict(deployers=dict((id, ['read']) for id in ids))
+
+    def setup():
+        stub.permissions = set(('read', 'deployers', id) for id in ids[1:])
+    result = measure(lambda: module('xldeploy_permission.py', matrix=matrix), setup)
+    assert result['granted'] == 1
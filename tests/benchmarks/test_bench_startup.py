@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Start-up cost of a task: importing the shared client, and running the
+xldeploy module from a fresh interpreter the way Ansible runs it on a host.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PRELUDE = """
+import sys
+import ansible.module_utils
+ansible.module_utils.__path__.append({!r})
+""".format(os.path.join(ROOT, 'module_utils'))
+
+IMPORT = PRELUDE + """
+import ansible.module_utils.xldeploy
+print(','.join(sorted(name for name in ('xml.etree.ElementTree', 'ssl', 'http.client')
+                      if name in sys.modules)))
+"""
+
+RUN = PRELUDE + """
+import runpy
+runpy.run_path({!r}, run_name='__main__')
+""".format(os.path.join(ROOT, 'xldeploy.py'))
+
+
+def python(code, *args):
+    return subprocess.run([sys.executable, '-c', code] + list(args), check=True,
+                          stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def test_import(benchmark):
+    # the XML, HTTP and TLS libraries wait for the first request
+    assert python(IMPORT).strip() == ''
+    benchmark.pedantic(python, args=(IMPORT,), rounds=5)
+
+
+def test_module_run(benchmark, stub, tmp_path):
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='UNIX')
+    args = tmp_path / 'args.json'
+    args.write_text(json.dumps(dict(ANSIBLE_MODULE_ARGS=dict(
+        endpoint=stub.url, session_cache='', id='Infrastructure/h1',
+        type='overthere.SshHost', properties=dict(os='UNIX')))))
+    result = json.loads(python(RUN, str(args)))
+    assert not result['changed']
+    benchmark.extra_info.update(requests=result['xld_stats']['requests'])
+    benchmark.pedantic(python, args=(RUN, str(args)), rounds=5)
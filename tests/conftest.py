@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+The modules run in process against the stub XL Deploy of xld_stub, with
+module_utils/xldeploy.py found as ansible.module_utils.xldeploy the way
+Ansible finds it next to a playbook.
+"""
+
+import contextlib
+import io
+import json
+import os
+import runpy
+import shutil
+import subprocess
+
+import pytest
+
+ansible_module_utils = pytest.importorskip('ansible.module_utils')
+
+from xld_stub import TYPES, XLDeployStub  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.path.join(ROOT, 'module_utils') not in ansible_module_utils.__path__:
+    ansible_module_utils.__path__.append(os.path.join(ROOT, 'module_utils'))
+
+try:
+    from ansible.module_utils.testing import patch_module_args
+except ImportError:
+    from unittest import mock
+    from ansible.module_utils import basic
+
+    def patch_module_args(args):
+        return mock.patch.object(basic, '_ANSIBLE_ARGS', json.dumps(
+            dict(ANSIBLE_MODULE_ARGS=args)).encode())
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    """ the ~/.ansible/xldeploy caches of the modules, private to each test"""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def stub():
+    with XLDeployStub() as server:
+        yield server
+
+
+class OfflineTypes:
+    """ the type metadata of the stub, served without a server to the
+    codecs and PropertyDiff the way XLDeployCommunicator serves it"""
+
+    def __init__(self, types=TYPES):
+        self.types = types
+        self._codecs = {}
+
+    def type_descriptor(self, typename):
+        return dict((name, dict(name=name, kind=kind, password=str(password).lower()))
+                    for name, kind, password in self.types[typename])
+
+    def property_descriptors(self, typename):
+        return dict((name, kind) for name, kind, _ in self.types[typename])
+
+    def codec(self, typename):
+        from ansible.module_utils.xldeploy import TypeCodec
+        if typename not in self._codecs:
+            self._codecs[typename] = TypeCodec(typename, self.property_descriptors(typename))
+        return self._codecs[typename]
+
+
+@pytest.fixture
+def types():
+    return OfflineTypes()
+
+
+@pytest.fixture(scope='session')
+def certificate(tmp_path_factory):
+    """ a self-signed (certfile, keyfile) for 127.0.0.1"""
+    if shutil.which('openssl') is None:
+        pytest.skip("openssl is needed to make a test certificate")
+    path = tmp_path_factory.mktemp('tls')
+    certfile, keyfile = str(path / 'cert.pem'), str(path / 'key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=127.0.0.1', '-keyout', keyfile, '-out', certfile],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+@pytest.fixture
+def tls_stub(certificate):
+    with XLDeployStub(tls=certificate) as server:
+        yield server
+
+
+@pytest.fixture
+def communicator(stub):
+    """ builds XLDeployCommunicators against the stub, without session cache"""
+    from ansible.module_utils.xldeploy import XLDeployCommunicator
+    created = []
+
+    def build(**kwargs):
+        kwargs.setdefault('session_cache', '')
+        created.append(XLDeployCommunicator(stub.url, **kwargs))
+        return created[-1]
+    yield build
+    for instance in created:
+        instance.close()
+
+
+def run_module(name, args, check_mode=False, diff=False):
+    """ runs a module file of the repository and returns its result"""
+    args = dict(args, _ansible_check_mode=check_mode, _ansible_diff=diff)
+    out = io.StringIO()
+    with patch_module_args(args), contextlib.redirect_stdout(out):
+        try:
+            runpy.run_path(os.path.join(ROOT, name), run_name='__main__')
+        except SystemExit:
+            pass
+    output = out.getvalue()
+    return json.loads(output[output.index('{'):])
+
+
+@pytest.fixture
+def module(stub):
+    """ runs a module against the stub: module('xldeploy.py', id=..., ...)"""
+    def run(name, check_mode=False, diff=False, **args):
+        args.setdefault('endpoint', stub.url)
+        args.setdefault('session_cache', '')
+        return run_module(name, args, check_mode, diff)
+    return run
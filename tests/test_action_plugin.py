@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from ansible.errors import AnsibleError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLAYBOOK = """
+- hosts: all
+  gather_facts: false
+  tasks:
+    - xldeploy:
+        endpoint: {endpoint}
+        session_cache: ''
+        aggregate: true
+        id: "Infrastructure/{{{{ inventory_hostname }}}}"
+        type: overthere.SshHost
+        properties:
+          os: "{{{{ os_name }}}}"
+      run_once: true
+"""
+
+
+def load_action_plugin():
+    spec = importlib.util.spec_from_file_location(
+        'xldeploy_action', os.path.join(ROOT, 'action_plugins', 'xldeploy.py'))
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    return plugin
+
+
+plugin = load_action_plugin()
+
+
+def test_shared_cis_are_merged():
+    items, owners = plugin.merge_items([
+        ('web1', dict(id='Environments/env', type='udm.Environment',
+                      properties=dict(members=['Infrastructure/web1']))),
+        ('web1', dict(id='Infrastructure/web1', type='overthere.SshHost')),
+        ('web2', dict(id='Environments/env', type='udm.Environment',
+                      properties=dict(members=['Infrastructure/web2']))),
+    ])
+    assert [item['id'] for item in items] == ['Environments/env', 'Infrastructure/web1']
+    assert items[0]['properties']['members'] == ['Infrastructure/web1', 'Infrastructure/web2']
+    assert owners == dict(web1=[0, 1], web2=[0])
+
+
+def test_conflicting_definitions_fail():
+    with pytest.raises(AnsibleError):
+        plugin.merge_items([
+            ('web1', dict(id='Infrastructure/h', properties=dict(os='UNIX'))),
+            ('web2', dict(id='Infrastructure/h', properties=dict(os='WINDOWS'))),
+        ])
+    with pytest.raises(AnsibleError):
+        plugin.merge_items([
+            ('web1', dict(id='Infrastructure/h', type='overthere.SshHost')),
+            ('web2', dict(id='Infrastructure/h', type='overthere.SmbHost')),
+        ])
+
+
+class FakeTemplar(object):
+    """ a templar of the releases without copy_with_new_env"""
+
+    def __init__(self):
+        self.available_variables = dict(task='vars')
+
+    def template(self, data):
+        if self.available_variables.get('fail'):
+            raise AnsibleError('templating failed')
+        return dict(data, os=self.available_variables['os'])
+
+
+def test_templating_restores_the_task_variables():
+    action = plugin.ActionModule.__new__(plugin.ActionModule)
+    action._templar = FakeTemplar()
+    assert action._template(dict(id='h'), dict(os='UNIX')) == dict(id='h', os='UNIX')
+    assert action._templar.available_variables == dict(task='vars')
+    with pytest.raises(AnsibleError):
+        action._template(dict(id='h'), dict(fail=True))
+    assert action._templar.available_variables == dict(task='vars')
+
+
+def test_aggregate_playbook(stub, tmp_path):
+    if shutil.which('ansible-playbook') is None:
+        pytest.skip("ansible-playbook is not installed")
+    (tmp_path / 'inventory').write_text(
+        'web1 os_name=UNIX\nweb2 os_name=WINDOWS\n'
+        '[all:vars]\nansible_connection=local\nansible_python_interpreter={}\n'.format(
+            sys.executable))
+    (tmp_path / 'playbook.yml').write_text(PLAYBOOK.format(endpoint=stub.url))
+    # the modules in a library folder, as the README installs them
+    (tmp_path / 'library').mkdir()
+    shutil.copy(os.path.join(ROOT, 'xldeploy.py'), str(tmp_path / 'library'))
+    env = dict(os.environ, ANSIBLE_LIBRARY=str(tmp_path / 'library'),
+               ANSIBLE_ACTION_PLUGINS=os.path.join(ROOT, 'action_plugins'),
+               ANSIBLE_MODULE_UTILS=os.path.join(ROOT, 'module_utils'))
+    run = subprocess.run(['ansible-playbook', '-i', 'inventory', 'playbook.yml'],
+                         cwd=str(tmp_path), env=env, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, universal_newlines=True)
+    assert run.returncode == 0, run.stdout
+    assert stub.get('Infrastructure/web1') == dict(os='UNIX')
+    assert stub.get('Infrastructure/web2') == dict(os='WINDOWS')
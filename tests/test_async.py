@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import http.client
+
+import pytest
+
+from ansible.module_utils.xldeploy import (
+    AdaptiveLimiter, RepositoryService, XLDeployException, async_engine)
+from ansible.module_utils.xldeploy_async import AsyncLimiter
+
+
+def test_read_each(stub, communicator):
+    for i in range(0, 30, 3):
+        stub.add('overthere.SshHost', 'Infrastructure/h{}'.format(i), os='UNIX')
+    xld = communicator()
+    engine = async_engine(xld, 8)
+    ids = ['Infrastructure/h{}'.format(i) for i in range(30)]
+    existing = RepositoryService(xld).read_each(ids, engine)
+    assert sorted(id for id, ci in existing.items() if ci is not None) == sorted(ids[::3])
+    assert existing['Infrastructure/h3'].properties['os'] == 'UNIX'
+    assert RepositoryService(xld).exists_each(ids[:4], engine) == {
+        'Infrastructure/h0': True, 'Infrastructure/h1': False,
+        'Infrastructure/h2': False, 'Infrastructure/h3': True}
+    # each run opens at most concurrency connections of its own, and the type
+    # descriptor is read over the blocking communicator
+    assert xld.report()['connections']['created'] <= 8 + 4 + 1
+
+
+def test_retries_and_sessions_are_shared(stub, communicator):
+    xld = communicator()
+    xld.do_get('repository/exists/Infrastructure/h1')
+    stub.fail('repository/exists/', 503, times=3, retry_after=0)
+    engine = async_engine(xld, 4)
+    assert RepositoryService(xld).exists_each(['Infrastructure/h1'], engine) == {
+        'Infrastructure/h1': False}
+    assert stub.basic_auth == 1
+    assert xld.report()['xld_stats']['requests'] == 5
+
+
+def test_errors_are_raised(stub, communicator):
+    stub.fail('repository/ci/', 500, times=1)
+    engine = async_engine(communicator(), 4)
+    with pytest.raises(XLDeployException):
+        engine.repository().read_each(['Infrastructure/h1', 'Infrastructure/h2'])
+
+
+def test_processed_post_is_not_sent_again(stub, communicator):
+    engine = async_engine(communicator(), 4)
+    doc = '<list><overthere.SshHost id="Infrastructure/h1"><os>UNIX</os></overthere.SshHost></list>'
+
+    async def create():
+        await engine.do_get('repository/exists/Infrastructure/h1')
+        stub.reset('repository/cis', verb='POST', after=True)
+        await engine.do_post('repository/cis', doc)
+    with pytest.raises((http.client.HTTPException, OSError)):
+        engine.run(create())
+    assert len(stub.requests('POST')) == 1
+    assert 'Infrastructure/h1' in stub.repository
+
+
+def test_idempotent_request_is_sent_again(stub, communicator):
+    engine = async_engine(communicator(), 4)
+
+    async def exists():
+        await engine.do_get('repository/exists/Infrastructure/h1')
+        stub.reset('repository/exists/', after=True)
+        return await engine.repository().exists('Infrastructure/h1')
+    assert engine.run(exists()) is False
+    assert len(stub.requests('GET')) == 3
+
+
+def test_cap_follows_the_limiter():
+    limiter = AdaptiveLimiter(4)
+    cap = AsyncLimiter(limiter, 16)
+
+    async def overloaded():
+        await cap.acquire()
+        cap.release(True)
+    asyncio.run(overloaded())
+    assert (limiter.limit, cap.cap()) == (2, 8)
+    limiter.adjust(True)
+    assert cap.cap() == 4
+
+
+def test_overload_shrinks_the_shared_limit(stub, communicator):
+    stub.fail('repository/exists/', 503, times=100)
+    xld = communicator(retries=0)
+    engine = async_engine(xld, 16)
+    with pytest.raises(XLDeployException):
+        RepositoryService(xld).exists_each(
+            ['Infrastructure/h{}'.format(i) for i in range(16)], engine)
+    assert xld.limiter.limit == xld.limiter.minimum
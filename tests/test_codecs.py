@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import io
+
+import pytest
+
+from ansible.module_utils.xldeploy import (
+    ConfigurationItem, MergedMap, MergedSet, MergedList, Properties)
+
+
+def encode(ci, types):
+    return ConfigurationItem.to_xml(ci, types)
+
+
+def decode(doc, types):
+    return ConfigurationItem.from_stream(io.BytesIO(doc), types)
+
+
+def test_round_trip(types):
+    ci = ConfigurationItem('udm.Environment', 'Environments/env', dict(
+        members=['Infrastructure/h1', 'Infrastructure/h2'],
+        dictionaries=['Environments/d2', 'Environments/d1']))
+    decoded = decode(encode(ci, types), types)
+    assert decoded.id == 'Environments/env'
+    assert decoded.properties['members'] == frozenset(['Infrastructure/h1', 'Infrastructure/h2'])
+    assert decoded.properties['dictionaries'] == ('Environments/d2', 'Environments/d1')
+
+
+def test_text_is_escaped(types):
+    ci = ConfigurationItem('udm.Dictionary', 'Environments/a&b', dict(
+        entries={'k<1>': 'v & "w"'}))
+    decoded = decode(encode(ci, types), types)
+    assert decoded.id == 'Environments/a&b'
+    assert decoded.properties['entries'] == {'k<1>': 'v & "w"'}
+
+
+def test_strings_are_escaped_one_by_one(types):
+    ci = ConfigurationItem('overthere.SshHost', 'Infrastructure/h1', dict(
+        os='UNIX', tags=['<a>', 'b&c']))
+    decoded = decode(encode(ci, types), types)
+    assert decoded.properties['tags'] == frozenset(['<a>', 'b&c'])
+
+
+def test_empty_collections(types):
+    ci = ConfigurationItem('udm.Environment', 'Environments/env', dict(members=[], dictionaries=()))
+    decoded = decode(encode(ci, types), types)
+    assert decoded.properties['members'] == frozenset()
+    assert decoded.properties['dictionaries'] == ()
+
+
+def test_collections_are_built_when_accessed(types):
+    doc = encode(ConfigurationItem('udm.Environment', 'Environments/env', dict(
+        members=['Infrastructure/h1'])), types)
+    properties = decode(doc, types).properties
+    assert list(properties.raw_items()) == [('members', ['Infrastructure/h1'])]
+    assert properties['members'] == frozenset(['Infrastructure/h1'])
+
+
+def test_decoded_ci_encodes_without_building_its_collections(types):
+    members = ['Infrastructure/h{}'.format(i) for i in range(10)]
+    doc = encode(ConfigurationItem('udm.Environment', 'Environments/env',
+                                   dict(members=members)), types)
+    assert encode(decode(doc, types), types) == doc
+
+
+def test_list_of_cis(types):
+    cis = [ConfigurationItem('tomcat.Server', 'Infrastructure/h1/tc{}'.format(i),
+                             dict(home='/opt/tc')) for i in range(3)]
+    stream = io.BytesIO(ConfigurationItem.list_to_xml(cis, types))
+    decoded = list(ConfigurationItem.iter_stream(stream, types, 2))
+    assert [ci.id for ci in decoded] == [ci.id for ci in cis]
+    assert decoded[2].properties['home'] == '/opt/tc'
+
+
+def test_token_is_read_from_the_start_tag():
+    doc = b'<overthere.SshHost id="Infrastructure/h1" token="t1">' + b'<tags>' * 1000
+    assert ConfigurationItem.token_from_stream(io.BytesIO(doc)) == 't1'
+
+
+def test_properties_assignment_drops_the_raw_items():
+    properties = Properties()
+    properties.set_raw('tags', frozenset, ['a'])
+    properties['tags'] = frozenset(['b'])
+    assert dict(properties) == dict(tags=frozenset(['b']))
+    assert list(properties.raw_items()) == [('tags', frozenset(['b']))]
+
+
+def test_merged_views_share_their_base():
+    base = frozenset(['a', 'b'])
+    merged = MergedSet(base, ['c'])
+    assert merged.base is base
+    assert merged == frozenset(['a', 'b', 'c'])
+    assert 'c' in merged and len(merged) == 3
+
+    assert list(MergedList(('a', 'b'), ('c',))) == ['a', 'b', 'c']
+
+    mapping = MergedMap(dict(a='1', b='2'), dict(b='3', c='4'))
+    assert dict(mapping) == dict(a='1', b='3', c='4')
+    assert len(mapping) == 3
+
+
+def test_merged_list_indexes():
+    merged = MergedList((1, 2), (3,))
+    assert [merged[i] for i in range(-3, 3)] == [1, 2, 3, 1, 2, 3]
+    assert merged[1:] == (2, 3) and merged[::-1] == (3, 2, 1)
+    assert merged.index(3) == 2 and 3 in merged
+    for index in (3, -4):
+        with pytest.raises(IndexError):
+            merged[index]
+
+
+def test_strings_holding_nul_stay_one_member(types):
+    for tags in (['a\0b', 'c'], ['a\0<b>', 'c']):
+        ci = ConfigurationItem('overthere.SshHost', 'Infrastructure/h1', dict(tags=tags))
+        assert encode(ci, types).count(b'<value>') == 2
+    ci = ConfigurationItem('udm.Environment', 'Environments/env', dict(members=['h\0', 'h2']))
+    assert encode(ci, types).count(b'<ci ') == 2
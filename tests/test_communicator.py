@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import http.client
+import json
+import socket
+import ssl
+import threading
+import time
+
+import pytest
+
+from ansible.module_utils.xldeploy import (
+    MetadataCache, RepositoryService, XLDeployCommunicator, XLDeployException)
+
+
+def test_keep_alive_connection_is_reused(stub, communicator):
+    xld = communicator()
+    for _ in range(5):
+        xld.do_get('repository/exists/Infrastructure/h1')
+    report = xld.report()
+    assert report['connections'] == dict(created=1, reused=4, discarded=0)
+    assert stub.connections == 1
+
+
+def test_basic_auth_opens_a_session(stub, communicator):
+    xld = communicator()
+    for _ in range(3):
+        xld.do_get('repository/exists/Infrastructure/h1')
+    assert stub.basic_auth == 1
+    assert xld.report()['xld_stats']['basic_auth'] == 1
+
+
+def test_expired_session_is_replayed_with_basic_auth(stub, communicator):
+    xld = communicator()
+    xld.do_get('repository/exists/Infrastructure/h1')
+    stub.expire_sessions()
+    assert xld.do_get('repository/exists/Infrastructure/h1').text == 'false'
+    assert stub.basic_auth == 2
+    assert len(stub.requests('GET')) == 3
+
+
+def test_session_is_shared_through_the_cache(stub, home):
+    cache = str(home / 'sessions')
+    first = XLDeployCommunicator(stub.url, session_cache=cache)
+    first.do_get('repository/exists/Infrastructure/h1')
+    first.close()
+    second = XLDeployCommunicator(stub.url, session_cache=cache)
+    second.do_get('repository/exists/Infrastructure/h1')
+    second.close()
+    assert stub.basic_auth == 1
+
+
+def test_overload_is_retried_for_idempotent_requests(stub, communicator):
+    stub.fail('repository/exists/', 503, times=2, retry_after=0)
+    xld = communicator()
+    assert xld.do_get('repository/exists/Infrastructure/h1').text == 'false'
+    assert len(stub.requests('GET')) == 3
+
+
+def test_retries_are_bounded(stub, communicator):
+    stub.fail('repository/exists/', 503, times=5, retry_after=0)
+    with pytest.raises(XLDeployException) as error:
+        communicator(retries=2).do_get('repository/exists/Infrastructure/h1')
+    assert error.value.status == 503
+    assert len(stub.requests('GET')) == 3
+
+
+def test_non_idempotent_requests_are_not_retried(stub, communicator):
+    stub.fail('repository/cis', 503, retry_after=0, verb='POST')
+    with pytest.raises(XLDeployException):
+        communicator().do_post('repository/cis', '<list/>')
+    assert len(stub.requests('POST')) == 1
+
+
+def test_stale_connection_is_replaced(stub, communicator):
+    xld = communicator()
+    xld.do_get('repository/exists/Infrastructure/h1')
+    stub.reset('repository/exists/')
+    assert xld.do_get('repository/exists/Infrastructure/h1').text == 'false'
+    assert xld.report()['connections']['discarded'] == 1
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'deflate'])
+def test_compressed_responses_are_decoded(stub, communicator, compression):
+    stub.compression = compression
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='UNIX', tags=['a', 'b'])
+    ci = RepositoryService(communicator()).read('Infrastructure/h1')
+    assert ci.properties['tags'] == frozenset(['a', 'b'])
+
+
+def test_request_bodies_are_compressed(stub, communicator):
+    xld = communicator(compress_requests=10)
+    repository = RepositoryService(xld)
+    ids = ['Infrastructure/h{}'.format(i) for i in range(50)]
+    for id in ids:
+        stub.add('overthere.SshHost', id, os='UNIX')
+    assert [ci.id for ci in repository.read_many(ids)] == ids
+    stats = xld.report()['xld_stats']
+    assert stats['bytes_out'] < stats['content_out']
+
+
+def test_tls(tls_stub, home):
+    xld = XLDeployCommunicator(tls_stub.url, validate_certs=False, session_cache='')
+    assert xld.do_get('repository/exists/Infrastructure/h1').text == 'false'
+    xld.close()
+    xld = XLDeployCommunicator(tls_stub.url, validate_certs=True, session_cache='')
+    with pytest.raises(ssl.SSLError):
+        xld.do_get('repository/exists/Infrastructure/h1')
+    # the certificate is not checked again, nor taken for an overload
+    assert xld.pool.created == 1
+    assert xld.limiter.limit == xld.limiter.maximum
+    xld.close()
+
+
+def test_refused_connections_are_not_an_overload(home):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    xld = XLDeployCommunicator('http://127.0.0.1:{}'.format(port), session_cache='',
+                               retries=2)
+    xld.backoff = 0.001
+    with pytest.raises(socket.error):
+        xld.do_get('repository/exists/Infrastructure/h1')
+    assert xld.limiter.limit == xld.limiter.maximum
+    xld.close()
+
+
+def test_trace_file(stub, home):
+    trace = home / 'trace.jsonl'
+    xld = XLDeployCommunicator(stub.url, session_cache='', trace_file=str(trace))
+    xld.do_get('repository/exists/Infrastructure/h1')
+    xld.close()
+    records = [json.loads(line) for line in trace.read_text().splitlines()]
+    assert [(r['verb'], r['path'], r['status']) for r in records] == [
+        ('GET', 'repository/exists/{id}', 200)]
+
+
+def test_type_descriptors_are_cached(stub, communicator, home):
+    xld = communicator(metadata_cache=MetadataCache(stub.url, str(home / 'metadata')))
+    xld.type_descriptor('overthere.SshHost')
+    xld.type_descriptor('overthere.SshHost')
+    other = communicator(metadata_cache=MetadataCache(stub.url, str(home / 'metadata')))
+    assert other.type_descriptor('overthere.SshHost')['password']['password'] == 'true'
+    assert len(stub.requests('GET', 'metadata/type/')) == 1
+
+
+def test_nested_request_after_overload(stub, communicator):
+    # decoding the CIs read fetches the descriptor of their type while the
+    # read holds its slot, once overload brought the limit down to one
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='UNIX')
+    stub.fail('repository/cis/read', 503, times=3, retry_after=0)
+    repository = RepositoryService(communicator())
+    result = []
+    thread = threading.Thread(target=lambda: result.extend(
+        repository.read_many(['Infrastructure/h1'])))
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert [ci.id for ci in result] == ['Infrastructure/h1']
+
+
+def host_list(*ids):
+    return ''.join(['<list>'] + ['<overthere.SshHost id="{}"><os>UNIX</os></overthere.SshHost>'.format(id)
+                                 for id in ids] + ['</list>'])
+
+
+def test_processed_post_is_not_sent_again(stub, communicator):
+    xld = communicator()
+    xld.do_get('repository/exists/Infrastructure/h1')
+    stub.reset('repository/cis', verb='POST', after=True)
+    with pytest.raises((http.client.HTTPException, OSError)):
+        xld.do_post('repository/cis', host_list('Infrastructure/h1'))
+    assert len(stub.requests('POST')) == 1
+    assert 'Infrastructure/h1' in stub.repository
+
+
+def test_idempotent_post_is_sent_again(stub, communicator):
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='UNIX')
+    xld = communicator()
+    xld.do_get('repository/exists/Infrastructure/h1')
+    stub.reset('repository/cis/read', after=True)
+    assert [ci.id for ci in RepositoryService(xld).read_many(['Infrastructure/h1'])] == [
+        'Infrastructure/h1']
+    assert len(stub.requests('POST')) == 2
+
+
+def test_connection_closed_by_the_server_is_not_reused(stub, communicator):
+    xld = communicator()
+    xld.do_get('repository/exists/Infrastructure/h1')
+    stub.drop_connections()
+    time.sleep(0.05)
+    xld.do_post('repository/cis', host_list('Infrastructure/h1'))
+    assert len(stub.requests('POST')) == 1
+    assert xld.report()['connections'] == dict(created=2, reused=0, discarded=1)
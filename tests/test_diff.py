@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+from ansible.module_utils.xldeploy import ConfigurationItem, PropertyDiff, reconcile
+
+
+def host(**properties):
+    return ConfigurationItem('overthere.SshHost', 'Infrastructure/h1', properties)
+
+
+def environment(**properties):
+    return ConfigurationItem('udm.Environment', 'Environments/env', properties)
+
+
+def differ(types, type, update_mode='replace', update_password='always'):
+    return PropertyDiff(types.type_descriptor(type), update_mode, update_password)
+
+
+def test_values_are_normalized_per_kind(types):
+    existing = host(os='UNIX', port='22', tags=frozenset(['b', 'a']))
+    desired = host(os='UNIX', port=22, tags=['a', 'b'])
+    assert differ(types, 'overthere.SshHost').compare(existing, desired) == {}
+
+
+def test_replace_mode_reports_the_differences(types):
+    existing = host(os='UNIX', tags=frozenset(['a', 'b']))
+    desired = host(os='WINDOWS', tags=['a'])
+    assert differ(types, 'overthere.SshHost').compare(existing, desired) == dict(
+        os=('UNIX', 'WINDOWS'), tags=(frozenset(['a', 'b']), frozenset(['a'])))
+
+
+def test_lists_are_ordered(types):
+    existing = environment(dictionaries=('d1', 'd2'))
+    desired = environment(dictionaries=['d2', 'd1'])
+    assert 'dictionaries' in differ(types, 'udm.Environment').compare(existing, desired)
+
+
+def test_add_mode_only_needs_the_desired_members(types):
+    existing = environment(members=frozenset(['h1', 'h2']), dictionaries=('d1', 'd2'))
+    desired = environment(members=['h2'], dictionaries=['d2'])
+    assert differ(types, 'udm.Environment', 'add').compare(existing, desired) == {}
+
+
+def test_add_mode_extends_the_existing_collections(types):
+    existing = environment(members=frozenset(['h1']), dictionaries=('d1',))
+    desired = environment(members=['h1', 'h2'], dictionaries=['d2', 'd1', 'd2'])
+    changes = differ(types, 'udm.Environment', 'add').compare(existing, desired)
+    assert changes['members'][1] == frozenset(['h1', 'h2'])
+    assert list(changes['dictionaries'][1]) == ['d1', 'd2']
+
+
+def test_encrypted_passwords(types):
+    existing = host(password='{b64}eA==')
+    desired = host(password='x')
+    assert 'password' in differ(types, 'overthere.SshHost').compare(existing, desired)
+    assert differ(types, 'overthere.SshHost', update_password='on_create').compare(
+        existing, desired) == {}
+
+
+def test_diff_masks_passwords(types):
+    diff = differ(types, 'overthere.SshHost')
+    shown = diff.as_diff('Infrastructure/h1', diff.compare(host(password='a', os='UNIX'),
+                                                           host(password='b', os='WINDOWS')))
+    assert shown['before'] == dict(password='********', os='UNIX')
+    assert shown['after'] == dict(password='********', os='WINDOWS')
+
+
+def test_reconcile(types):
+    assert reconcile(host(os='UNIX'), None, 'present', 'replace', types)[0] == 'create'
+    assert reconcile(host(os='UNIX'), host(os='UNIX'), 'present', 'replace', types)[0] is None
+    assert reconcile(host(), host(), 'absent', 'replace', types)[0] == 'delete'
+    assert reconcile(host(), None, 'absent', 'replace', types)[0] is None
+
+
+def test_reconcile_add_mode_updates_the_existing_ci(types):
+    existing = environment(members=frozenset(['h1']), dictionaries=('d1',))
+    action, target, msg, diff = reconcile(environment(members=['h2']), existing,
+                                          'present', 'add', types)
+    assert action == 'update' and target is existing
+    assert target.properties['members'] == frozenset(['h1', 'h2'])
+    assert target.properties['dictionaries'] == ('d1',)
+    assert diff['after'] == dict(members=['h1', 'h2'])
+
+
+def test_reconcile_replace_keeps_the_passwords_set_on_creation(types):
+    desired = host(os='WINDOWS', password='plain')
+    action, target, _, _ = reconcile(desired, host(os='UNIX', password='{b64}eA=='), 'present',
+                                     'replace', types, 'on_create')
+    assert action == 'update'
+    assert dict(target.properties) == dict(os='WINDOWS', password='{b64}eA==')
+    assert desired.properties['password'] == 'plain'
+
+    _, target, _, _ = reconcile(desired, host(os='UNIX', password='{b64}eA=='), 'present',
+                                'replace', types, 'always')
+    assert target.properties['password'] == 'plain'
+
+
+def test_replace_mode_resets_the_omitted_properties(types):
+    descriptors = types.type_descriptor('overthere.SshHost')
+    descriptors['port'] = dict(descriptors['port'], default='22')
+    diff = PropertyDiff(descriptors, 'replace')
+    existing = host(os='UNIX', address='h1', port='22', tags=frozenset(), username='')
+    assert diff.compare(existing, host(os='UNIX')) == dict(address=('h1', ''))
+    assert diff.compare(host(os='UNIX', port='2222'), host(os='UNIX')) == dict(
+        port=('2222', '22'))
+    assert PropertyDiff(descriptors, 'add').compare(existing, host(os='UNIX')) == {}
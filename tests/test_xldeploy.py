@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+HOST = dict(id='Infrastructure/h1', type='overthere.SshHost')
+
+
+def test_create_then_unchanged(module, stub):
+    result = module('xldeploy.py', properties=dict(os='UNIX', tags=['a']), **HOST)
+    assert result['changed']
+    assert stub.get('Infrastructure/h1') == dict(os='UNIX', tags=['a'])
+
+    result = module('xldeploy.py', properties=dict(os='UNIX', tags=['a']), **HOST)
+    assert not result['changed']
+    assert not stub.requests('PUT')
+
+
+def test_unchanged_since_last_applied_reads_the_token_only(module, stub):
+    module('xldeploy.py', properties=dict(os='UNIX'), **HOST)
+    module('xldeploy.py', properties=dict(os='UNIX'), **HOST)
+    result = module('xldeploy.py', properties=dict(os='UNIX'), **HOST)
+    assert 'unchanged since last applied' in result['msg']
+    assert result['xld_stats']['requests'] == 1
+
+
+def test_replace(module, stub):
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='UNIX', address='h1', tags=['a'])
+    result = module('xldeploy.py', properties=dict(os='UNIX', tags=['b']), **HOST)
+    assert result['changed']
+    assert stub.get('Infrastructure/h1') == dict(os='UNIX', tags=['b'])
+
+
+def test_add_mode(module, stub):
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='UNIX', address='h1', tags=['a'])
+    result = module('xldeploy.py', update_mode='add', properties=dict(tags=['b']), **HOST)
+    assert result['changed']
+    stored = stub.get('Infrastructure/h1')
+    assert stored['address'] == 'h1' and sorted(stored['tags']) == ['a', 'b']
+
+    result = module('xldeploy.py', update_mode='add', properties=dict(tags=['b']), **HOST)
+    assert not result['changed']
+
+
+def test_check_mode_and_diff(module, stub):
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='UNIX')
+    result = module('xldeploy.py', check_mode=True, diff=True,
+                    properties=dict(os='WINDOWS'), **HOST)
+    assert result['changed']
+    assert result['diff']['before'] == dict(os='UNIX')
+    assert result['diff']['after'] == dict(os='WINDOWS')
+    assert stub.get('Infrastructure/h1') == dict(os='UNIX')
+
+
+def test_absent(module, stub):
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='UNIX')
+    result = module('xldeploy.py', state='absent', **HOST)
+    assert result['changed']
+    assert stub.get('Infrastructure/h1') is None
+
+
+def test_unknown_property_fails(module, stub):
+    result = module('xldeploy.py', properties=dict(colour='blue'), **HOST)
+    assert result['failed']
+    assert stub.get('Infrastructure/h1') is None
+
+
+def hosts(count, **properties):
+    return [dict(id='Infrastructure/h{}'.format(i), properties=dict(properties))
+            for i in range(count)]
+
+
+def test_batch(module, stub):
+    stub.add('overthere.SshHost', 'Infrastructure/h0', os='UNIX')
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='WINDOWS')
+    stub.add('overthere.SshHost', 'Infrastructure/old', os='UNIX')
+    items = hosts(3, os='UNIX') + [dict(id='Infrastructure/old', state='absent')]
+    result = module('xldeploy.py', type='overthere.SshHost', items=items)
+    assert [(r['id'], r['changed']) for r in result['results']] == [
+        ('Infrastructure/h0', False), ('Infrastructure/h1', True),
+        ('Infrastructure/h2', True), ('Infrastructure/old', True)]
+    assert stub.get('Infrastructure/h1') == dict(os='UNIX')
+    assert stub.get('Infrastructure/old') is None
+    # one read, one create, one update and one delete
+    assert len(stub.requests(pattern='repository/')) == 4
+
+
+def test_batch_creates_parents_first(module, stub):
+    items = [dict(id='Infrastructure/h1/tc', type='tomcat.Server', properties=dict(home='/opt')),
+             dict(id='Infrastructure/h1', type='overthere.SshHost', properties=dict(os='UNIX'))]
+    result = module('xldeploy.py', items=items)
+    assert not result.get('failed')
+    assert stub.get('Infrastructure/h1/tc') == dict(home='/opt')
+
+
+def test_batch_reports_the_failed_items(module, stub):
+    items = hosts(2, os='UNIX') + [dict(id='Infrastructure/h0', properties=dict(os='UNIX'))]
+    result = module('xldeploy.py', type='overthere.SshHost', items=items)
+    assert result['failed']
+    assert [r['failed'] for r in result['results']] == [False, False, True]
+
+
+def test_batch_concurrency(module, stub):
+    for i in range(0, 20, 2):
+        stub.add('overthere.SshHost', 'Infrastructure/h{}'.format(i), os='WINDOWS')
+    result = module('xldeploy.py', type='overthere.SshHost', concurrency=4,
+                    items=hosts(20, os='UNIX'))
+    assert all(r['changed'] for r in result['results'])
+    assert all(stub.get('Infrastructure/h{}'.format(i)) == dict(os='UNIX') for i in range(20))
+
+
+def test_password_set_on_creation_is_not_sent_again(module, stub):
+    module('xldeploy.py', properties=dict(os='UNIX', password='first'), **HOST)
+    encrypted = stub.get('Infrastructure/h1')['password']
+    result = module('xldeploy.py', update_password='on_create',
+                    properties=dict(os='WINDOWS', password='second'), **HOST)
+    assert result['changed']
+    assert stub.get('Infrastructure/h1') == dict(os='WINDOWS', password=encrypted)
+
+
+def test_rejected_batch_is_applied_item_by_item(module, stub):
+    items = hosts(3, os='UNIX')
+    items.insert(1, dict(id='Infrastructure/missing/h', properties=dict(os='UNIX')))
+    result = module('xldeploy.py', type='overthere.SshHost', items=items)
+    assert result['failed']
+    assert [(r['id'], r['failed'], r['changed']) for r in result['results']] == [
+        ('Infrastructure/h0', False, True), ('Infrastructure/missing/h', True, False),
+        ('Infrastructure/h1', False, True), ('Infrastructure/h2', False, True)]
+    assert sorted(stub.repository) == ['Infrastructure/h0', 'Infrastructure/h1', 'Infrastructure/h2']
+    assert result['xld_stats']['errors'] == 2
+    assert 'connections' in result
+
+
+def test_replace_clears_the_omitted_properties(module, stub):
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='UNIX', address='h1')
+    result = module('xldeploy.py', properties=dict(os='UNIX'), **HOST)
+    assert result['changed']
+    assert stub.get('Infrastructure/h1') == dict(os='UNIX')
+
+
+def test_batch_reads_one_by_one_without_the_multi_ci_endpoint(module, stub):
+    stub.add('overthere.SshHost', 'Infrastructure/h0', os='UNIX')
+    stub.fail('repository/cis/read', 404, times=1)
+    result = module('xldeploy.py', type='overthere.SshHost', items=hosts(2, os='UNIX'))
+    assert [r['changed'] for r in result['results']] == [False, True]
+    assert len(stub.requests('GET', 'repository/ci/')) == 2
+
+
+def test_batch_fails_at_once_on_other_read_errors(module, stub):
+    result = module('xldeploy.py', type='overthere.SshHost', password='wrong',
+                    items=hosts(5, os='UNIX'))
+    assert result['failed']
+    assert len(stub.requests()) == 1
+
+
+def test_password_is_not_rewritten_while_unchanged_since_last_applied(module, stub):
+    args = dict(properties=dict(os='UNIX', password='first'), **HOST)
+    module('xldeploy.py', **args)
+    result = module('xldeploy.py', **args)
+    assert 'unchanged since last applied' in result['msg']
+    assert not stub.requests('PUT')
+
+    stub.add('overthere.SshHost', 'Infrastructure/h1', os='WINDOWS')
+    assert module('xldeploy.py', **args)['changed']
+    args['properties']['password'] = 'second'
+    assert module('xldeploy.py', **args)['changed']
+    assert len(stub.requests('PUT')) == 2
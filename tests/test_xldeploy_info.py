@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+
+def test_query(module, stub):
+    stub.add('core.Directory', 'Infrastructure/dc')
+    for i in range(5):
+        stub.add('overthere.SshHost', 'Infrastructure/dc/h{}'.format(i), os='UNIX')
+    result = module('xldeploy_info.py', parent='Infrastructure/dc', page_size=2)
+    assert not result['changed']
+    assert [ci['id'] for ci in result['cis']] == ['Infrastructure/dc/h{}'.format(i) for i in range(5)]
+    assert len(stub.requests('GET', 'repository/query')) == 3
+
+
+def test_full_and_limit(module, stub):
+    for i in range(5):
+        stub.add('overthere.SshHost', 'Infrastructure/h{}'.format(i), os='UNIX', tags=['a'])
+    result = module('xldeploy_info.py', type='overthere.SshHost', full=True, limit=3)
+    assert result['cis'][0] == dict(id='Infrastructure/h0', type='overthere.SshHost',
+                                    properties=dict(os='UNIX', tags=['a']))
+    assert len(result['cis']) == 3
+    assert len(stub.requests('POST', 'repository/cis/read')) == 1
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+
+def test_permission(module, stub):
+    args = dict(id='Environments/env', role='deployers', permission='deploy#initial')
+    assert module('xldeploy_permission.py', **args)['changed']
+    assert stub.permissions == {('deploy#initial', 'deployers', 'Environments/env')}
+    assert not module('xldeploy_permission.py', **args)['changed']
+
+    assert module('xldeploy_permission.py', state='revoke', **args)['changed']
+    assert stub.permissions == set()
+
+
+def test_lists(module, stub):
+    result = module('xldeploy_permission.py', id='Environments/env',
+                    roles=['deployers', 'admins'], permissions=['read', 'deploy#upgrade'])
+    assert result['granted'] == 4
+    assert len(stub.permissions) == 4
+    assert not module('xldeploy_permission.py', id='Environments/env',
+                      roles=['deployers', 'admins'], permissions=['read'])['changed']
+
+
+def test_matrix(module, stub):
+    stub.permissions = {('read', 'deployers', 'Environments/env'),
+                        ('repo#edit', 'deployers', 'Environments/env')}
+    matrix = dict(deployers={'Environments/env': ['read', 'deploy#initial']},
+                  viewers={'Environments/env': ['read'], 'Applications/app': ['read']})
+    result = module('xldeploy_permission.py', matrix=matrix, exclusive=True)
+    assert (result['granted'], result['revoked']) == (3, 1)
+    assert stub.permissions == {
+        ('read', 'deployers', 'Environments/env'), ('deploy#initial', 'deployers', 'Environments/env'),
+        ('read', 'viewers', 'Environments/env'), ('read', 'viewers', 'Applications/app')}
+    assert not module('xldeploy_permission.py', matrix=matrix, exclusive=True)['changed']
+
+
+def test_matrix_reads_one_document_per_role(module, stub):
+    matrix = dict(('role{}'.format(i), {'Environments/env': ['read']}) for i in range(20))
+    stub.permissions = set(('read', role, 'Environments/env') for role in matrix)
+    for concurrency in (1, 8):
+        del stub.log[:]
+        result = module('xldeploy_permission.py', matrix=matrix, concurrency=concurrency)
+        assert not result['changed']
+        assert len(stub.requests('GET')) == 20
+
+
+def test_empty_permissions_list(module, stub):
+    stub.permissions = {('read', 'deployers', 'Environments/env'),
+                        ('read', 'deployers', 'Environments/other')}
+    args = dict(id='Environments/env', roles=['deployers'], permissions=[])
+    assert not module('xldeploy_permission.py', **args)['changed']
+    result = module('xldeploy_permission.py', exclusive=True, **args)
+    assert result['revoked'] == 1
+    assert stub.permissions == {('read', 'deployers', 'Environments/other')}
+
+
+def test_missing_permission_fails_before_any_request(module, stub):
+    stub.permissions = {('read', 'deployers', 'Environments/env')}
+    result = module('xldeploy_permission.py', id='Environments/env', roles=['deployers'],
+                    permissions=['deploy#initial', ''], exclusive=True)
+    assert result['failed'] and 'Missing' in result['msg']
+    assert not stub.requests()
+    assert stub.permissions == {('read', 'deployers', 'Environments/env')}
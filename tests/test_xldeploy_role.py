@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+
+def test_role(module, stub):
+    result = module('xldeploy_role.py', role='deployers')
+    assert result['changed']
+    assert stub.roles == dict(deployers=set())
+    assert not module('xldeploy_role.py', role='deployers')['changed']
+
+    assert module('xldeploy_role.py', role='deployers', state='absent')['changed']
+    assert stub.roles == {}
+
+
+def test_principal(module, stub):
+    result = module('xldeploy_role.py', role='deployers', principal='alice')
+    assert result['changed']
+    assert stub.roles == dict(deployers={'alice'})
+    assert not module('xldeploy_role.py', role='deployers', principal='alice')['changed']
+
+
+def test_principals(module, stub):
+    stub.roles = dict(deployers={'alice', 'bob'})
+    result = module('xldeploy_role.py', role='deployers', principals=['bob', 'carol'],
+                    exclusive=True)
+    assert result['changed']
+    assert result['added'] == ['carol'] and result['removed'] == ['alice']
+    assert stub.roles == dict(deployers={'bob', 'carol'})
+    assert not module('xldeploy_role.py', role='deployers', principals=['bob', 'carol'])['changed']
+
+
+def test_roles(module, stub):
+    stub.roles = dict(deployers={'alice'}, admins={'root'})
+    result = module('xldeploy_role.py', roles=dict(deployers=['bob'], viewers=['carol']))
+    assert result['changed']
+    assert result['created'] == ['viewers']
+    assert stub.roles == dict(deployers={'alice', 'bob'}, admins={'root'}, viewers={'carol'})
+    # one read and one write, whatever the number of roles
+    assert len(stub.requests(pattern='security/')) == 2
+
+    result = module('xldeploy_role.py', roles=dict(deployers=['bob'], viewers=['carol']))
+    assert not result['changed']
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+ITEMS = [
+    dict(id='Infrastructure/dc/h1', type='overthere.SshHost', properties=dict(os='UNIX')),
+    dict(id='Infrastructure/dc/h1/tc', type='tomcat.Server', properties=dict(home='/opt/tc')),
+    dict(id='Infrastructure/dc/h2', type='overthere.SshHost', properties=dict(os='UNIX')),
+]
+
+
+def test_converge(module, stub):
+    stub.add('core.Directory', 'Infrastructure/dc')
+    stub.add('overthere.SshHost', 'Infrastructure/dc/h1', os='WINDOWS')
+    stub.add('overthere.SshHost', 'Infrastructure/dc/old', os='UNIX')
+    stub.add('tomcat.Server', 'Infrastructure/dc/old/tc', home='/opt/tc')
+    result = module('xldeploy_tree.py', root='Infrastructure/dc', items=ITEMS, prune=True)
+    assert result['changed']
+    assert result['created'] == ['Infrastructure/dc/h1/tc', 'Infrastructure/dc/h2']
+    assert result['updated'] == ['Infrastructure/dc/h1']
+    assert result['deleted'] == ['Infrastructure/dc/old', 'Infrastructure/dc/old/tc']
+    assert sorted(stub.repository) == ['Infrastructure/dc', 'Infrastructure/dc/h1',
+                                       'Infrastructure/dc/h1/tc', 'Infrastructure/dc/h2']
+
+    result = module('xldeploy_tree.py', root='Infrastructure/dc', items=ITEMS, prune=True)
+    assert not result['changed']
+
+
+def test_intermediate_directories_are_kept(module, stub):
+    stub.add('core.Directory', 'Infrastructure/dc')
+    stub.add('core.Directory', 'Infrastructure/dc/rack')
+    items = [dict(id='Infrastructure/dc/rack/h1', type='overthere.SshHost',
+                  properties=dict(os='UNIX'))]
+    result = module('xldeploy_tree.py', root='Infrastructure/dc', items=items, prune=True)
+    assert result['deleted'] == []
+    assert 'Infrastructure/dc/rack' in stub.repository
+
+
+def test_check_mode(module, stub):
+    stub.add('core.Directory', 'Infrastructure/dc')
+    stub.add('overthere.SshHost', 'Infrastructure/dc/old', os='UNIX')
+    result = module('xldeploy_tree.py', check_mode=True, diff=True,
+                    root='Infrastructure/dc', items=ITEMS, prune=True)
+    assert result['changed']
+    assert result['deleted'] == ['Infrastructure/dc/old']
+    assert len(result['diff']) == 4
+    assert sorted(stub.repository) == ['Infrastructure/dc', 'Infrastructure/dc/old']
+
+
+def test_items_outside_of_the_root_fail(module, stub):
+    items = [dict(id='Infrastructure/other', type='overthere.SshHost', properties=dict(os='UNIX'))]
+    result = module('xldeploy_tree.py', root='Infrastructure/dc', items=items)
+    assert result['failed']
+    assert result['failed_items'][0]['id'] == 'Infrastructure/other'
+
+
+def test_no_items_does_not_prune_the_subtree(module, stub):
+    stub.add('core.Directory', 'Infrastructure/dc')
+    stub.add('overthere.SshHost', 'Infrastructure/dc/h1', os='UNIX')
+    result = module('xldeploy_tree.py', root='Infrastructure/dc', items=[])
+    assert result['failed'] and 'prune_all' in result['msg']
+    assert 'Infrastructure/dc/h1' in stub.repository
+    assert not stub.requests()
+
+    assert module('xldeploy_tree.py', root='Infrastructure/dc')['failed']
+
+    result = module('xldeploy_tree.py', root='Infrastructure/dc', items=[], prune_all=True)
+    assert result['deleted'] == ['Infrastructure/dc/h1']
+    assert sorted(stub.repository) == ['Infrastructure/dc']
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+"""
+In-process stub of the XL Deploy REST API used by the xldeploy modules.
+
+It keeps a repository, roles and permissions in memory and serves the
+repository/ci, repository/cis, repository/exists, repository/query,
+metadata/type, security/role and security/permission endpoints, with Basic
+auth opening cookie sessions like the real server. Latency, TLS, gzip or
+deflate responses and faults (error statuses, connections reset before or
+after the request is processed) can be configured per test.
+"""
+
+import base64
+import gzip
+import re
+import socket
+import ssl
+import threading
+import time
+import zlib
+import xml.etree.ElementTree as ET
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+TYPES = {
+    'core.Directory': [],
+    'overthere.SshHost': [('os', 'ENUM', False), ('address', 'STRING', False),
+                          ('username', 'STRING', False), ('password', 'STRING', True),
+                          ('port', 'INTEGER', False), ('tags', 'SET_OF_STRING', False)],
+    'tomcat.Server': [('home', 'STRING', False), ('startWaitTime', 'INTEGER', False)],
+    'udm.Environment': [('members', 'SET_OF_CI', False), ('dictionaries', 'LIST_OF_CI', False)],
+    'udm.Dictionary': [('entries', 'MAP_STRING_STRING', False)],
+}
+
+ROOTS = ('Applications', 'Environments', 'Infrastructure', 'Configuration')
+
+
+class Fault:
+    """ Fails the requests matching verb and path: with status, or by closing
+    the connection before (or, with after, once) the request is processed"""
+
+    def __init__(self, pattern, status=None, times=1, retry_after=None,
+                 verb=None, reset=False, after=False):
+        self.pattern = re.compile(pattern)
+        self.status = status
+        self.times = times
+        self.retry_after = retry_after
+        self.verb = verb
+        self.reset = reset
+        self.after = after
+
+    def matches(self, verb, path):
+        return self.times > 0 and (self.verb is None or self.verb == verb) \
+            and self.pattern.match(path) is not None
+
+
+class XLDeployStub:
+    """ The state and the HTTP server of a stub XL Deploy"""
+
+    def __init__(self, types=None, latency=0.0, tls=None, username='admin',
+                 password='admin'):
+        self.types = dict(TYPES, **(types or {}))
+        self.latency = latency
+        self.tls = tls
+        self.credentials = (username, password)
+        self.compression = None
+        self.repository = {}
+        self.roles = {}
+        self.permissions = set()
+        self.faults = []
+        self.log = []
+        self.connections = 0
+        self.basic_auth = 0
+        self.sessions = set()
+        self._sockets = set()
+        self._token = 0
+        self._lock = threading.Lock()
+        self.server = None
+
+    # configuration
+
+    def fail(self, pattern, status=503, times=1, retry_after=None, verb=None):
+        self.faults.append(Fault(pattern, status, times, retry_after, verb))
+
+    def reset(self, pattern, times=1, verb=None, after=False):
+        self.faults.append(Fault(pattern, None, times, None, verb, True, after))
+
+    def expire_sessions(self):
+        self.sessions.clear()
+
+    def drop_connections(self):
+        """ closes the open connections, as a server does on keep-alive timeout"""
+        with self._lock:
+            sockets = list(self._sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def add(self, type, id, **properties):
+        """ stores a CI, the collections given as lists and the maps as dicts"""
+        ci = ET.Element(type, id=id)
+        for key, value in properties.items():
+            prop = ET.SubElement(ci, key)
+            kind = self.kind(type, key)
+            if kind in ('SET_OF_CI', 'LIST_OF_CI'):
+                for ref in value:
+                    ET.SubElement(prop, 'ci', ref=ref)
+            elif kind in ('SET_OF_STRING', 'LIST_OF_STRING'):
+                for text in value:
+                    ET.SubElement(prop, 'value').text = text
+            elif kind == 'MAP_STRING_STRING':
+                for k, v in value.items():
+                    ET.SubElement(prop, 'entry', key=k).text = v
+            else:
+                prop.text = str(value)
+        self.store(ci)
+        return ci
+
+    def kind(self, type, key):
+        for name, kind, _ in self.types.get(type, []):
+            if name == key:
+                return kind
+        return None
+
+    def get(self, id):
+        """ the properties of a stored CI, collections as lists, None if it does not exist"""
+        ci = self.repository.get(id)
+        if ci is None:
+            return None
+        properties = {}
+        for prop in ci:
+            kind = self.kind(ci.tag, prop.tag)
+            if kind in ('SET_OF_CI', 'LIST_OF_CI'):
+                properties[prop.tag] = [e.get('ref') for e in prop]
+            elif kind in ('SET_OF_STRING', 'LIST_OF_STRING'):
+                properties[prop.tag] = [e.text for e in prop]
+            elif kind == 'MAP_STRING_STRING':
+                properties[prop.tag] = dict((e.get('key'), e.text) for e in prop)
+            else:
+                properties[prop.tag] = prop.text
+        return properties
+
+    def store(self, ci):
+        """ keeps the CI with a new token, its passwords encrypted as XL Deploy does"""
+        passwords = set(name for name, _, password in self.types.get(ci.tag, []) if password)
+        for prop in ci:
+            if prop.tag in passwords and prop.text and not prop.text.startswith('{b64}'):
+                prop.text = '{b64}' + base64.b64encode(prop.text.encode()).decode()
+        with self._lock:
+            self._token += 1
+            ci.set('token', 'token-{}'.format(self._token))
+            self.repository[ci.get('id')] = ci
+
+    def requests(self, verb=None, pattern=None):
+        """ the (verb, path) of the requests received, optionally filtered"""
+        return [(v, p) for v, p in self.log
+                if (verb is None or v == verb) and (pattern is None or re.match(pattern, p))]
+
+    # server
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return '{}://{}:{}'.format('https' if self.tls else 'http', host, port)
+
+    def start(self):
+        stub = self
+
+        class Handler(StubHandler):
+            pass
+        Handler.stub = stub
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        if self.tls:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*self.tls)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def descriptor(type, properties):
+    root = ET.Element('descriptor', type=type)
+    descriptors = ET.SubElement(root, 'property-descriptors')
+    for name, kind, password in properties:
+        ET.SubElement(descriptors, 'property-descriptor', name=name, kind=kind,
+                      password=str(password).lower())
+    return ET.tostring(root)
+
+
+def boolean(value):
+    return '<boolean>{}</boolean>'.format(str(bool(value)).lower())
+
+
+def listing(tag, elements):
+    root = ET.Element(tag)
+    root.extend(elements)
+    return ET.tostring(root)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stub = None
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # the response head and body go out as two writes, which Nagle's
+        # algorithm would hold back until the client acknowledges the first
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.stub._lock:
+            self.stub.connections += 1
+            self.stub._sockets.add(self.request)
+
+    def finish(self):
+        with self.stub._lock:
+            self.stub._sockets.discard(self.request)
+        BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def reply(self, status, body=b'', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        headers = dict(headers or {})
+        compression = self.stub.compression
+        if compression and body and compression in (self.headers.get('Accept-Encoding') or ''):
+            if compression == 'gzip':
+                body = gzip.compress(body)
+            else:
+                body = zlib.compress(body)
+            headers['Content-Encoding'] = compression
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def authenticate(self):
+        """ the Set-Cookie header opening a session, None when the request
+        already belongs to one, False when it is refused"""
+        stub = self.stub
+        cookies = dict(c.strip().split('=', 1) for c in (self.headers.get('Cookie') or '').split(';')
+                       if '=' in c)
+        if cookies.get('JSESSIONID') in stub.sessions:
+            return None
+        authorization = self.headers.get('Authorization') or ''
+        if not authorization.startswith('Basic '):
+            return False
+        username, _, password = base64.b64decode(authorization[6:]).decode().partition(':')
+        if (username, password) != stub.credentials:
+            return False
+        with stub._lock:
+            stub.basic_auth += 1
+            session = 'session-{}'.format(stub.basic_auth)
+            stub.sessions.add(session)
+        return 'JSESSIONID={}; Path=/deployit; HttpOnly'.format(session)
+
+    def handle_request(self, verb):
+        stub = self.stub
+        url = urlparse(self.path)
+        path = unquote(url.path)[len('/deployit/'):]
+        body = self.read_body()
+        stub.log.append((verb, path))
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        fault = None
+        with stub._lock:
+            for candidate in stub.faults:
+                if candidate.matches(verb, path):
+                    candidate.times -= 1
+                    fault = candidate
+                    break
+        if fault is not None and fault.reset and not fault.after:
+            self.close_connection = True
+            self.request.shutdown(socket.SHUT_RDWR)
+            return
+
+        session = self.authenticate()
+        if session is False:
+            return self.reply(401)
+        headers = {'Set-Cookie': session} if session else {}
+        if fault is not None and not fault.reset:
+            if fault.retry_after is not None:
+                headers['Retry-After'] = str(fault.retry_after)
+            return self.reply(fault.status, b'', headers)
+
+        status, response = self.dispatch(verb, path, parse_qs(url.query), body)
+        if fault is not None:
+            # processed, but the response never makes it back
+            self.close_connection = True
+            self.request.shutdown(socket.SHUT_RDWR)
+            return
+        self.reply(status, response, headers)
+
+    def dispatch(self, verb, path, query, body):
+        stub = self.stub
+        match = re.match(r'repository/ci/(.+)$', path)
+        if match:
+            return self.ci(verb, match.group(1), body)
+        match = re.match(r'repository/exists/(.+)$', path)
+        if match:
+            return 200, boolean(match.group(1) in stub.repository)
+        match = re.match(r'metadata/type/(.+)$', path)
+        if match:
+            if match.group(1) not in stub.types:
+                return 404, ''
+            return 200, descriptor(match.group(1), stub.types[match.group(1)])
+        if path == 'repository/cis/read':
+            ids = [ref.get('ref') for ref in ET.fromstring(body)]
+            return 200, listing('list', [stub.repository[id] for id in ids if id in stub.repository])
+        if path == 'repository/cis' and verb in ('POST', 'PUT'):
+            cis = list(ET.fromstring(body))
+            for ci in cis:
+                exists = ci.get('id') in stub.repository
+                if exists != (verb == 'PUT'):
+                    return (404 if verb == 'PUT' else 409), ''
+                if verb == 'POST' and not self.parent_exists(ci.get('id'), cis):
+                    return 400, 'the parent of {} does not exist'.format(ci.get('id'))
+            for ci in cis:
+                stub.store(ci)
+            return 200, listing('list', cis)
+        if path == 'repository/cis/delete':
+            for ref in ET.fromstring(body):
+                self.delete(ref.get('ref'))
+            return 204, ''
+        if path == 'repository/query':
+            return 200, self.query(query)
+        return self.security(verb, path, body)
+
+    def parent_exists(self, id, batch=()):
+        parent = id.rsplit('/', 1)[0]
+        return '/' not in id or parent in ROOTS or parent in self.stub.repository \
+            or any(ci.get('id') == parent for ci in batch)
+
+    def ci(self, verb, id, body):
+        stub = self.stub
+        if verb == 'GET':
+            if id not in stub.repository:
+                return 404, 'Repository entity {} not found'.format(id)
+            return 200, ET.tostring(stub.repository[id])
+        if verb == 'DELETE':
+            self.delete(id)
+            return 204, ''
+        ci = ET.fromstring(body)
+        if verb == 'POST' and id in stub.repository:
+            return 409, 'Repository entity {} already exists'.format(id)
+        if verb == 'PUT' and id not in stub.repository:
+            return 404, 'Repository entity {} not found'.format(id)
+        if verb == 'POST' and not self.parent_exists(id):
+            return 400, 'the parent of {} does not exist'.format(id)
+        stub.store(ci)
+        return 200, ET.tostring(ci)
+
+    def delete(self, id):
+        repository = self.stub.repository
+        for key in list(repository):
+            if key == id or key.startswith(id + '/'):
+                del repository[key]
+
+    def query(self, query):
+        repository = self.stub.repository
+        ids = sorted(repository)
+        if 'parent' in query:
+            ids = [id for id in ids if id.rsplit('/', 1)[0] == query['parent'][0]]
+        if 'ancestor' in query:
+            ids = [id for id in ids if id.startswith(query['ancestor'][0] + '/')]
+        if 'type' in query:
+            ids = [id for id in ids if repository[id].tag == query['type'][0]]
+        if 'namePattern' in query:
+            pattern = re.compile(re.escape(query['namePattern'][0]).replace('%', '.*') + '$')
+            ids = [id for id in ids if pattern.match(id.rsplit('/', 1)[-1])]
+        page = int(query.get('page', ['0'])[0])
+        size = int(query.get('resultsPerPage', ['-1'])[0])
+        if size > 0:
+            ids = ids[page * size:(page + 1) * size]
+        return listing('list', [ET.Element('ci', ref=id, type=repository[id].tag) for id in ids])
+
+    def security(self, verb, path, body):
+        stub = self.stub
+        path = path.rstrip('/')
+        if path == 'security/role':
+            return 200, listing('list', [text_element('string', role) for role in sorted(stub.roles)])
+        match = re.match(r'security/role/roles/(.+)$', path)
+        if match:
+            return 200, listing('list', [text_element('string', role)
+                                         for role, principals in sorted(stub.roles.items())
+                                         if match.group(1) in principals])
+        if path == 'security/role/principals':
+            if verb == 'GET':
+                elements = []
+                for role, principals in sorted(stub.roles.items()):
+                    element = ET.Element('rolePrincipals')
+                    ET.SubElement(element, 'role', name=role, id='-1')
+                    element.extend(text_element('principals', p) for p in sorted(principals))
+                    elements.append(element)
+                return 200, listing('list', elements)
+            stub.roles = dict((element.find('role').get('name'),
+                               set(p.text for p in element.findall('principals')))
+                              for element in ET.fromstring(body))
+            return 204, ''
+        match = re.match(r'security/role/([^/]+)(?:/(.+))?$', path)
+        if match:
+            role, principal = match.groups()
+            if verb == 'PUT':
+                stub.roles.setdefault(role, set())
+                if principal:
+                    stub.roles[role].add(principal)
+            elif verb == 'DELETE':
+                if principal:
+                    stub.roles.get(role, set()).discard(principal)
+                else:
+                    stub.roles.pop(role, None)
+            return 204, ''
+        match = re.match(r'security/granted-permissions/([^/]+)$', path)
+        if match:
+            by_id = {}
+            for permission, role, id in stub.permissions:
+                if role == match.group(1):
+                    by_id.setdefault(id, []).append(permission)
+            entries = []
+            for id, permissions in sorted(by_id.items()):
+                entry = ET.Element('entry', key=id)
+                granted = ET.SubElement(entry, 'list')
+                granted.extend(text_element('string', p) for p in sorted(permissions))
+                entries.append(entry)
+            return 200, listing('map', entries)
+        match = re.match(r'security/permission/([^/]+)/([^/]+)/(.*)$', path)
+        if match:
+            key = match.groups()
+            if verb == 'GET':
+                return 200, boolean(key in stub.permissions)
+            if verb == 'PUT':
+                stub.permissions.add(key)
+            elif verb == 'DELETE':
+                stub.permissions.discard(key)
+            return 204, ''
+        return 404, 'unknown path {}'.format(path)
+
+
+def text_element(tag, text):
+    element = ET.Element(tag)
+    element.text = text
+    return element
@@ -1,336 +1,191 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import itertools
-import base64
-import ssl
-import xml.etree.ElementTree as ET
-from xml.dom.minidom import Document
+import traceback
 
-from ansible.module_utils.basic import *
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.xldeploy import (
+    ConfigurationItem, FingerprintStore, MetadataCache, RepositoryService,
+    XLDeployCommunicator, XLDeployException, apply_planned, async_engine, chunks,
+    reconcile, xldeploy_argument_spec)
 
-# python 2 workaround
-try:
-    from http.client import HTTPConnection, HTTPSConnection
-    from urllib.parse import urlparse
-except ImportError:
-    from httplib import HTTPConnection, HTTPSConnection
-    from urlparse import urlparse
-
-class XLDeployCommunicator:
-    """ XL Deploy Communicator using http & XML"""
-
-    # TODO Manage 'context'
-
-    def __init__(self,
-                 endpoint='http://localhost:4516',
-                 username='admin',
-                 password='admin',
-                 validate_certs=True,
-                 context='deployit'):
-        self.endpoint = endpoint
-        self.username = username
-        self.password = password
-        self.validate_certs = validate_certs
-        self.context = context
-
-    def do_get(self, path):
-        return self.do_it("GET", path, "")
-
-    def do_put(self, path, doc):
-        return self.do_it("PUT", path, doc)
-
-    def do_post(self, path, doc):
-        return self.do_it("POST", path, doc)
-
-    def do_delete(self, path):
-        return self.do_it("DELETE", path, "", False)
-
-    def do_it(self, verb, path, doc, parse_response=True):
-        # print "DO {} {} on {} ".format(verb, path, self.endpoint)
-
-        ssl_context = None
-        if not self.validate_certs:
-            ssl_context = ssl._create_unverified_context()
-
-        parsed_url = urlparse(self.endpoint)
-        if parsed_url.scheme == "https":
-            conn = HTTPSConnection(
-                parsed_url.hostname, parsed_url.port, context=ssl_context)
-        else:
-            conn = HTTPConnection(parsed_url.hostname, parsed_url.port)
 
+def read_existing(repository, ids, engine=None):
+    """ reads the existing CIs in one request, one by one if the server has
+    no repository/cis/read endpoint"""
+    try:
+        return dict((ci.id, ci) for ci in repository.read_many(ids))
+    except XLDeployException as e:
+        if e.status not in (400, 404, 405):
+            raise
+        existing = repository.read_each(ids, engine)
+        return dict((id, ci) for id, ci in existing.items() if ci is not None)
+
+
+def run_batch(module, repository):
+    """ reconciles the 'items' list through the multi-CI repository endpoints"""
+    params = module.params
+    results = []
+    cis = []
+    for item in params.get('items'):
+        ci = ConfigurationItem(item.get('type', params.get('type')),
+                               item.get('id'), item.get('properties') or {})
+        cis.append((ci, item.get('state', params.get('state')),
+                    item.get('update_mode', params.get('update_mode'))))
+        results.append(dict(id=ci.id, changed=False, failed=False, msg=""))
+
+    engine = None
+    if params.get('concurrency') > 1:
+        engine = async_engine(repository.communicator, params.get('concurrency'))
+    existing = {}
+    for ids in chunks([ci.id for ci, _, _ in cis], params.get('batch_size')):
+        existing.update(read_existing(repository, ids, engine))
+
+    planned = dict(create=[], update=[], delete=[])
+    seen = {}
+    for index, (ci, state, update_mode) in enumerate(cis):
+        if ci.id in seen:
+            results[index].update(failed=True, msg="{} is already defined by item {}".format(
+                ci.id, seen[ci.id]))
+            continue
+        seen[ci.id] = index
         try:
-            auth = base64.encodestring(('{}:{}'.format(self.username,
-                                                  self.password)).encode()).decode().replace('\n', '')
-            headers = {
-                "Content-type": "application/xml",
-                "Accept": "application/xml",
-                "Authorization": "Basic {}".format(auth)
-            }
-
-            conn.request(verb, "/deployit/{}".format(path), doc, headers)
-            response = conn.getresponse()
-            # print response.status, response.reason
-            if response.status != 200 and response.status != 204:
-                raise Exception(
-                    "Error when requesting XL Deploy Server [{}]:{}".format(response.status, response.reason))
-
-            if parse_response:
-                xml = ET.fromstring(response.read().decode())
-                return xml
-
-            return None
-        finally:
-            conn.close()
-
-    def property_descriptors(self, typename):
-        doc = self.do_get("metadata/type/{}".format(typename))
-        return dict((pd.attrib['name'], pd.attrib['kind'])
-                    for pd in doc.getiterator('property-descriptor'))
-
-    def __str__(self):
-        return "[endpoint={}, username={}]".format(self.endpoint, self.username)
-
-
-class RepositoryService:
-    """ Access to the repository REST service"""
-
-    def __init__(self, communicator=None):
-        self.communicator = communicator
-
-    def read(self, id):
-        doc = self.communicator.do_get('repository/ci/{}'.format(id))
-        return ConfigurationItem.from_xlm(doc, self.communicator)
-
-    def exists(self, id):
-        doc = self.communicator.do_get('repository/exists/{}'.format(id))
-        return "true" in doc.text
-
-    def update(self, ci):
-        doc = ConfigurationItem.to_xml(ci, self.communicator)
-        updated = self.communicator.do_put('repository/ci/{}'.format(ci.id), doc)
-        return ConfigurationItem.from_xlm(updated, self.communicator)
-
-    def create(self, ci):
-        doc = ConfigurationItem.to_xml(ci, self.communicator)
-        updated = self.communicator.do_post('repository/ci/{}'.format(ci.id), doc)
-        return ConfigurationItem.from_xlm(updated, self.communicator)
-
-    def delete(self, id):
-        self.communicator.do_delete("repository/ci/{}".format(id))
-
-
-class ConfigurationItem:
-    """ an XL Deploy Configuration item"""
-
-    def __init__(self, type, id, properties):
-        self.id = id
-        self.type = type
-        self.properties = properties
-
-    def __str__(self):
-        return "{} {} {}".format(
-            self.id, self.type,
-            dict(
-                map(lambda t: (t[0], "********") if t[0] == "password" else t,
-                    self.properties.items())))
-
-    def __eq__(self, other):
-        return self.id == other.id and self.type == other.type and self.properties == other.properties
-
-    def __contains__(self, item):
-        print("###################################################### {} ".format(item))
-        # TODO: use DictDiffer https://github.com/hughdbrown/dictdiffer/blob/master/dictdiffer/__init__.py
-        # TODO: manage Password
-
-        if not self.id == item.id:
-            return False
-        if not self.type == item.type:
-            return False
-        # if not len(self.properties) == len(item.properties):
-        #    return False
-
-        for k, v in item.properties.items():
-            if k not in self.properties:
-                return False
-
-            # python 2 workaround
-            try:
-                if type(self.properties[k]) is itertools.imap:
-                    self.properties[k] = list(self.properties[k])
-            except AttributeError:
-                pass
-
-            if type(self.properties[k]) is str:
-                if not str(self.properties[k]) == str(v):
-                    return False
-            elif type(self.properties[k]) is list:
-                if not set(v).issubset(set(self.properties[k])):
-                    return False
-            elif type(self.properties[k]) is dict:
-                for item_k, item_v in v.items():
-                    if item_k not in self.properties[k].keys() or str(
-                            self.properties[k][item_k]) != str(item_v):
-                        return False
-        return True
-
-    def properties(self):
-        return self.properties
-
-    def update_with(self, other):
-        for k, v in other.properties.items():
-            if k in self.properties:
-                if isinstance(self.properties[k], list):
-                    self.properties[k] = list(set(self.properties[k] + v))
-                elif isinstance(self.properties[k], dict):
-                    self.properties[k].update(v)
-                else:
-                    self.properties[k] = v
+            action, target, msg, diff = reconcile(
+                ci, existing.get(ci.id), state, update_mode,
+                repository.communicator, params.get('update_password'),
+                module._diff)
+            if action in ('create', 'update'):
+                ConfigurationItem.check(target, repository.communicator)
+        except Exception as e:
+            results[index].update(failed=True, msg=str(e))
+            continue
+        results[index]['msg'] = msg
+        if diff is not None and module._diff:
+            results[index]['diff'] = diff
+        if action is not None:
+            planned[action].append((index, target))
+
+    if module.check_mode:
+        for action in ('create', 'update', 'delete'):
+            for index, _ in planned[action]:
+                results[index]['changed'] = True
+        return results
+
+    errors = apply_planned(repository, planned, params.get('batch_size'),
+                           params.get('concurrency'))
+    for action in ('create', 'update', 'delete'):
+        for index, _ in planned[action]:
+            if index in errors:
+                results[index].update(failed=True, msg="{}: {}".format(
+                    results[index]['msg'], errors[index]))
             else:
-                self.properties[k] = v
-
-    @staticmethod
-    def from_xlm(doc, communicator):
-        descriptors = communicator.property_descriptors(doc.tag)
-
-        def collection_of_string(xml):
-            return map(lambda e: e.text, xml)
-
-        def collection_of_ci(xml):
-            return map(lambda e: e.attrib['ref'], xml)
-
-        def map_string_string(xml):
-            return dict((child.attrib['key'], child.text) for child in xml)
-
-        def ci(xml):
-            return xml.attrib['ref']
-
-        def default(xml):
-            return xml.text
-
-        properties = dict((xml.tag, {
-            'SET_OF_STRING': collection_of_string,
-            'LIST_OF_STRING': collection_of_string,
-            'SET_OF_CI': collection_of_ci,
-            'LIST_OF_CI': collection_of_ci,
-            'MAP_STRING_STRING': map_string_string,
-            'CI': ci
-        }.get(descriptors[xml.tag], default)(xml)) for xml in doc)
-
-        return ConfigurationItem(doc.tag, doc.attrib['id'], properties)
-
-    @staticmethod
-    def to_xml(item, communicator):
-        descriptors = communicator.property_descriptors(item.type)
-        doc = Document()
-        base = doc.createElement(item.type)
-        base.attributes['id'] = item.id
-        doc.appendChild(base)
-
-        def collection_of_string(doc, key, value):
-            node = doc.createElement(key)
-            for s in value:
-                value = doc.createElement('value')
-                value.appendChild(doc.createTextNode(s))
-                node.appendChild(value)
-            return node
-
-        def collection_of_ci(doc, key, value):
-            node = doc.createElement(key)
-            for ci in value:
-                cinode = doc.createElement('ci')
-                cinode.attributes['ref'] = ci
-                node.appendChild(cinode)
-            return node
-
-        def map_string_string(doc, key, value):
-            node = doc.createElement(key)
-            for k, v in value.items():
-                entry = doc.createElement('entry')
-                entry.attributes['key'] = k
-                entry.appendChild(doc.createTextNode(v))
-                node.appendChild(entry)
-            return node
-
-        def ci(doc, key, value):
-            node = doc.createElement(key)
-            node.attributes['ref'] = value
-            return node
-
-        def default(doc, key, value):
-            node = doc.createElement(key)
-            node.appendChild(doc.createTextNode(str(value)))
-            return node
-
-        for key, value in item.properties.items():
-            if not key in descriptors:
-                raise Exception("'{}' is not a property of '{}'".format(key,
-                                                                    item.type))
-
-            base.appendChild({
-                'SET_OF_STRING': collection_of_string,
-                'LIST_OF_STRING': collection_of_string,
-                'SET_OF_CI': collection_of_ci,
-                'LIST_OF_CI': collection_of_ci,
-                'MAP_STRING_STRING': map_string_string,
-                'CI': ci
-            }.get(descriptors[key], default)(doc, key, value))
-
-        return doc.toxml()
+                results[index]['changed'] = True
+    return results
 
 
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            username=dict(default='admin'),
-            password=dict(default='admin', no_log=True),
-            endpoint=dict(default='http://localhost:4516'),
-            validate_certs=dict(required=False, type='bool', default=True),
+        argument_spec=xldeploy_argument_spec(
             id=dict(),
             type=dict(),
             properties=dict(type='dict', default={}),
+            items=dict(type='list'),
+            batch_size=dict(type='int', default=100),
+            concurrency=dict(type='int', default=1),
             state=dict(default='present', choices=['present', 'absent']),
             update_mode=dict(default='replace', choices=['add', 'replace']),
-        ))
+            update_password=dict(default='always', choices=['always', 'on_create'], no_log=False),
+            metadata_cache=dict(type='path', default='~/.ansible/xldeploy/metadata'),
+            metadata_cache_ttl=dict(type='int', default=86400),
+            flush_metadata_cache=dict(type='bool', default=False),
+            fingerprint_cache=dict(type='path', default='~/.ansible/xldeploy/fingerprints'),
+        ),
+        mutually_exclusive=[['id', 'items']],
+        supports_check_mode=True)
+
+    metadata_cache = MetadataCache(module.params.get('endpoint'),
+                                   module.params.get('metadata_cache'),
+                                   module.params.get('metadata_cache_ttl'))
+    if module.params.get('flush_metadata_cache'):
+        metadata_cache.invalidate()
 
     communicator = XLDeployCommunicator(
         module.params.get('endpoint'), module.params.get('username'),
         module.params.get('password'), module.params.get('validate_certs'),
-        module.params.get('context'))
+        module.params.get('context'), metadata_cache,
+        module.params.get('retries'),
+        trace_file=module.params.get('trace_file'),
+        hooks=module.params.get('stats_hooks'),
+        session_cache=module.params.get('session_cache'),
+        compress_requests=module.params.get('compress_requests'))
 
     repository = RepositoryService(communicator)
+
+    if module.params.get('items') is not None:
+        try:
+            results = run_batch(module, repository)
+        except Exception as e:
+            module.fail_json(
+                msg="Failed to update XLD {} on {}:  {}".format(
+                    e, communicator, traceback.format_exc()),
+                **communicator.report())
+        changed = any(result['changed'] for result in results)
+        failed = [result for result in results if result['failed']]
+        if failed:
+            module.fail_json(
+                msg="Failed to update {} of {} XLD CIs on {}".format(
+                    len(failed), len(results), communicator),
+                changed=changed, results=results, **communicator.report())
+        diffs = [result.pop('diff') for result in results if 'diff' in result]
+        module.exit_json(changed=changed, results=results, diff=diffs,
+                         **communicator.report())
+
     ci_id = module.params.get('id')
     ci = ConfigurationItem(
         module.params.get('type'), ci_id, module.params.get('properties'))
+    fingerprints = FingerprintStore(module.params.get('endpoint'),
+                                    module.params.get('fingerprint_cache'))
 
     msg = ""
     try:
         state = module.params.get('state')
         if state == 'absent':
             msg = "Delete {}".format(ci)
-            repository.delete(ci.id)
-        elif state == 'present':
-            if repository.exists(ci_id):
-                existing_ci = repository.read(ci_id)
-                update_mode = module.params.get('update_mode')
-                if update_mode == 'replace':
-                    msg = "[REPLACE] Update {}, previous {}".format(
-                        ci, existing_ci)
-                    repository.update(ci)
-                else:
-                    if ci in existing_ci:
-                        module.exit_json(changed=False)
-                    else:
-                        msg = "[ADD] Update {}, previous {}".format(ci,
-                                                                existing_ci)
-                    existing_ci.update_with(ci)
-                    repository.update(existing_ci)
+            if not module.check_mode:
+                repository.delete(ci.id)
+                fingerprints.invalidate(ci.id)
+            module.exit_json(changed=True, msg=msg,
+                             **communicator.report())
+
+        # the CI is left as it was when the same properties were last applied
+        fingerprint = FingerprintStore.fingerprint(
+            ci.type, dict(ci.properties), module.params.get('update_mode'),
+            module.params.get('update_password'))
+        stored = fingerprints.get(ci_id)
+        if stored is not None and stored[0] == fingerprint:
+            token = repository.read_token(ci_id)
+            if token is not None and token == stored[1]:
+                module.exit_json(changed=False, msg="{} unchanged since last applied".format(ci_id),
+                                 **communicator.report())
+
+        # the descriptors are needed anyway, having them first keeps the read on a single connection
+        communicator.type_descriptor(ci.type)
+        existing_ci = repository.read_if_exists(ci_id)
+        action, target, msg, diff = reconcile(
+            ci, existing_ci, state, module.params.get('update_mode'),
+            communicator, module.params.get('update_password'), module._diff)
+        if action is None:
+            fingerprints.put(ci_id, fingerprint, existing_ci.token)
+            module.exit_json(changed=False, msg=msg,
+                             **communicator.report())
+        if not module.check_mode:
+            if action == 'create':
+                applied = repository.create(target)
             else:
-                msg = "Create {}".format(ci)
-                repository.create(ci)
-
-        module.exit_json(changed=True, msg=msg)
+                applied = repository.update(target)
+            fingerprints.put(ci_id, fingerprint, applied and applied.token)
+        module.exit_json(changed=True, msg=msg, diff=diff or {},
+                         **communicator.report())
     except Exception as e:
         # exc_type, exc_value, exc_traceback = sys.exc_info()
         module.fail_json(
@@ -338,4 +193,5 @@ def main():
                 e, communicator, ci, traceback.format_exc()))
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.0',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: xldeploy_info
+
+short_description: Module to query the XLDeploy from Xebialabs repository through its API
+
+version_added: "2.4"
+
+description:
+    - "The module uses the API described under https://docs.xebialabs.com/generated/xl-deploy/7.6.x/rest-api/com.xebialabs.deployit.engine.api.RepositoryService.html"
+    - "It uses GET to list the matching CIs page by page with /repository/query"
+    - "It uses POST to read the full CIs by batches with /repository/cis/read"
+
+options:
+    type:
+        description:
+            - Only return the CIs of this type
+        required: false
+    parent:
+        description:
+            - Only return the direct children of this CI
+        required: false
+    ancestor:
+        description:
+            - Only return the CIs below this CI
+        required: false
+    name_pattern:
+        description:
+            - Only return the CIs whose name matches this pattern, '%' matching any characters
+        required: false
+    full:
+        description:
+            - Also read the properties of the matching CIs
+        required: false
+        default: false
+    limit:
+        description:
+            - The maximum number of CIs to return
+        required: false
+    page_size:
+        description:
+            - The number of CIs listed per query request
+        required: false
+        default: 100
+    batch_size:
+        description:
+            - The number of CIs read per request when full is set
+        required: false
+        default: 100
+    endpoint:
+        description:
+            - The name of the enpoint
+        required: false
+        default: http://localhost:4516
+    username:
+        description:
+            - The name of the user for the endpoint
+        required: false
+        default: admin
+    password:
+        description:
+            - The password of the user for the endpoint
+        required: false
+        default: admin
+    validate_certs:
+        description:
+            - SSL/TLS Certificate Validation Flag
+        required: false
+        default: true
+
+extends_documentation_fragment:
+    - xldeploy
+'''
+
+EXAMPLES = '''
+# List the hosts under Infrastructure/datacenter1
+- name: List Hosts
+    xldeploy_info:
+      ancestor: Infrastructure/datacenter1
+      type: overthere.SshHost
+      endpoint: http://localhost:4516
+      username: admin
+      password: password
+    register: hosts
+
+# Read the environments whose name starts with tomcat
+- name: Read Environments
+    xldeploy_info:
+      parent: Environments/others
+      type: udm.Environment
+      name_pattern: tomcat%
+      full: True
+      endpoint: http://localhost:4516
+      username: admin
+      password: password
+    register: environments
+'''
+
+RETURN = '''
+cis:
+    description: The matching CIs, with their properties when full is set
+    type: list
+    returned: always
+    sample: [{"id": "Environments/others/tomcat-test", "type": "udm.Environment"}]
+connections:
+    description: Keep-alive connection usage against the XL Deploy server
+    type: dict
+    returned: success
+    sample: {"created": 1, "reused": 1, "discarded": 0}
+xld_stats:
+    description: Requests sent to the XL Deploy server, their sizes and where their time went, per verb and path
+    type: dict
+    returned: success
+    sample: {"requests": 3, "errors": 0, "reused": 2, "hook_errors": 0, "basic_auth": 1, "bytes_in": 2961, "bytes_out": 138,
+             "content_in": 9874, "content_out": 138,
+             "time": {"dns": 0.0012, "connect": 0.0004, "tls": 0.0, "server": 0.0623, "transfer": 0.0041, "total": 0.0685},
+             "paths": {"GET repository/query": {"count": 1, "errors": 0, "time": 0.0188, "max_time": 0.0188,
+                                                "bytes_in": 412, "bytes_out": 0},
+                       "GET metadata/type/{type}": {"count": 1, "errors": 0, "time": 0.0153, "max_time": 0.0153,
+                                                    "bytes_in": 1184, "bytes_out": 0},
+                       "POST repository/cis/read": {"count": 1, "errors": 0, "time": 0.0344, "max_time": 0.0344,
+                                                    "bytes_in": 1365, "bytes_out": 138}}}
+'''
+
+import itertools
+import traceback
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.xldeploy import (
+    MetadataCache, RepositoryService, XLDeployCommunicator,
+    xldeploy_argument_spec)
+
+
+def query(repository, params):
+    """ yields the matching CIs as dicts"""
+    refs = repository.query(params.get('type'), params.get('parent'),
+                            params.get('ancestor'), params.get('name_pattern'),
+                            params.get('page_size'))
+    refs = itertools.islice(refs, params.get('limit'))
+    if not params.get('full'):
+        return (dict(id=id, type=type) for id, type in refs)
+    return (ci.to_dict() for ci in
+            repository.read_all((id for id, _ in refs), params.get('batch_size')))
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=xldeploy_argument_spec(
+            type=dict(type='str', required=False),
+            parent=dict(type='str', required=False),
+            ancestor=dict(type='str', required=False),
+            name_pattern=dict(type='str', required=False),
+            full=dict(type='bool', default=False),
+            limit=dict(type='int', required=False),
+            page_size=dict(type='int', default=100),
+            batch_size=dict(type='int', default=100),
+            metadata_cache=dict(type='path', default='~/.ansible/xldeploy/metadata'),
+            metadata_cache_ttl=dict(type='int', default=86400)),
+        supports_check_mode=True)
+
+    metadata_cache = MetadataCache(module.params.get('endpoint'),
+                                   module.params.get('metadata_cache'),
+                                   module.params.get('metadata_cache_ttl'))
+    communicator = XLDeployCommunicator(
+        module.params.get('endpoint'), module.params.get('username'),
+        module.params.get('password'), module.params.get('validate_certs'),
+        module.params.get('context'), metadata_cache,
+        module.params.get('retries'),
+        trace_file=module.params.get('trace_file'),
+        hooks=module.params.get('stats_hooks'),
+        session_cache=module.params.get('session_cache'),
+        compress_requests=module.params.get('compress_requests'))
+
+    try:
+        cis = list(query(RepositoryService(communicator), module.params))
+    except Exception as e:
+        module.fail_json(
+            msg="Failed to query XLD %s on %s:  %s" % (
+                e, communicator, traceback.format_exc()))
+    module.exit_json(changed=False, cis=cis,
+                     **communicator.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -20,20 +20,47 @@ description:
     - "It uses PUT to Grants Permissions with /security/permission/{permission}/{role}/{id:.*}"
     - "It uses DELETE to Revoke Permissions with /security/permission/{permission}/{role}/{id:.+}"
     - "It uses GET to maintain the idempotency and checks the current status with /security/permission/{permission}/{role}/{id:.+}"
+    - "With matrix, permissions or roles, it reads the permissions of each role once with GET /security/granted-permissions/{role}, concurrently"
 
 options:
     id:
         description:
             - The path of the CI to grant/revoke the permission on.
-        required: true
+            - Required with permission or permissions.
+        required: false
     role:
         description:
             - The role to which the permission should be granted/revoked.
-        required: true
+            - Either role or roles is required with permission or permissions.
+        required: false
+    roles:
+        description:
+            - The roles to which the permissions should be granted/revoked.
+        required: false
     permission:
         description:
             - The name of the permission to grant/revoke.
-        required: true
+            - Either permission, permissions or matrix is required.
+        required: false
+    permissions:
+        description:
+            - The names of the permissions to grant/revoke to each role on the CI.
+            - An empty list changes nothing, or with exclusive revokes all the permissions of the roles on the CI.
+        required: false
+    matrix:
+        description:
+            - Mapping of role names to a mapping of CI paths to the list of permissions to grant/revoke.
+        required: false
+    exclusive:
+        description:
+            - With matrix, permissions or roles and state grant, also revoke the permissions that are not listed on the listed CIs.
+        required: false
+        default: false
+    concurrency:
+        description:
+            - With matrix, permissions or roles, the number of roles whose permissions are read at once, over asyncio where the python of the target has it
+        required: false
+        default: 8
     endpoint:
         description:
             - The name of the enpoint
@@ -80,6 +107,31 @@ EXAMPLES = '''
       validate_certs: False
       state: revoke
 
+# Converge the permissions of several roles on several folders
+- name: Permission Matrix
+    xldeploy_permission:
+      matrix:
+        deployers:
+          Environments/DEV: [read, deploy#initial, deploy#upgrade, deploy#undeploy]
+          Applications: [read]
+        viewers:
+          Environments/DEV: [read]
+      exclusive: True
+      endpoint: http://localhost:4516
+      username: admin
+      password: password
+      validate_certs: False
+
+# Grant the deployment permissions to several roles on an environment
+- name: Deployment Permissions
+    xldeploy_permission:
+      id: Environments/DEV
+      roles: [deployers, release-managers, ops]
+      permissions: [read, deploy#initial, deploy#upgrade, import#initial]
+      endpoint: http://localhost:4516
+      username: admin
+      password: password
+
 # Grant read permission for admins under Environments/DEV/ANSIBLE
 - name: Grant Permissions
     xldeploy_permission:
@@ -98,86 +150,40 @@ msg:
     type: str
     returned: always
     sample: "Already Revoked [permission] for role *role* on *id*"
+granted:
+    description: The number of permissions granted, with matrix, permissions or roles
+    type: int
+    returned: success
+    sample: 12
+revoked:
+    description: The number of permissions revoked, with matrix, permissions or roles
+    type: int
+    returned: success
+    sample: 2
+connections:
+    description: Keep-alive connection usage against the XL Deploy server
+    type: dict
+    returned: success
+    sample: {"created": 1, "reused": 1, "discarded": 0}
+xld_stats:
+    description: Requests sent to the XL Deploy server, their sizes and where their time went, per verb and path
+    type: dict
+    returned: success
+    sample: {"requests": 6, "errors": 0, "reused": 5, "hook_errors": 0, "basic_auth": 1, "bytes_in": 1630, "bytes_out": 0,
+             "content_in": 1630, "content_out": 0,
+             "time": {"dns": 0.0012, "connect": 0.0004, "tls": 0.0, "server": 0.0912, "transfer": 0.0003, "total": 0.0931},
+             "paths": {"GET security/granted-permissions/{role}": {"count": 2, "errors": 0, "time": 0.0382,
+                                                                   "max_time": 0.0207, "bytes_in": 1630, "bytes_out": 0},
+                       "PUT security/permission/{permission}/{role}/{id}": {"count": 4, "errors": 0, "time": 0.0549,
+                                                                            "max_time": 0.0151, "bytes_in": 0,
+                                                                            "bytes_out": 0}}}
 '''
 
-import itertools
-import base64
-import httplib
-from urllib2 import quote
-import ssl
-from urlparse import urlparse
-import xml.etree.ElementTree as ET
-from xml.dom.minidom import Document
+import traceback
 
-from ansible.module_utils.basic import *
-
-
-class XLDeployCommunicator:
-    """ XL Deploy Communicator using http & XML"""
-
-    def __init__(self,
-                 endpoint='http://localhost:4516',
-                 username='admin',
-                 password='admin',
-                 validate_certs=True,
-                 context='deployit'):
-        self.endpoint = endpoint
-        self.username = username
-        self.password = password
-        self.validate_certs = validate_certs
-        self.context = context
-
-    def do_get(self, path):
-        return self.do_it("GET", path, True)
-
-    def do_put(self, path):
-        return self.do_it("PUT", path, False)
-
-    def do_delete(self, path):
-        return self.do_it("DELETE", path, False)
-
-    def do_it(self, verb, path, parse_response=True):
-
-        ssl_context = None
-        if not self.validate_certs:
-            ssl_context = ssl._create_unverified_context()
-
-        parsed_url = urlparse(self.endpoint)
-        if parsed_url.scheme == "https":
-            conn = httplib.HTTPSConnection(
-                parsed_url.hostname, parsed_url.port, context=ssl_context)
-        else:
-            conn = httplib.HTTPConnection(parsed_url.hostname, parsed_url.port)
-
-        try:
-            auth = base64.encodestring('%s:%s' % (self.username,
-                                                  self.password)).replace(
-                                                      '\n', '')
-            headers = {
-                "Content-type": "application/xml",
-                "Accept": "application/xml",
-                "Authorization": "Basic %s" % auth
-            }
-
-            conn.request(verb, "/deployit/%s" % path, headers=headers)
-            response = conn.getresponse()
-
-            # print response.status, response.reason, response.read()
-            if response.status != 200 and response.status != 204:
-                raise Exception(
-                    "Error when requesting XL Deploy Server [%s]:%s" %
-                    (response.status, response.reason))
-
-            if parse_response:
-                xml = ET.fromstring(str(response.read()))
-                return xml.text
-
-            return None
-        finally:
-            conn.close()
-
-    def __str__(self):
-        return "[endpoint=%s, username=%s]" % (self.endpoint, self.username)
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.xldeploy import (
+    XLDeployCommunicator, async_engine, quote, xldeploy_argument_spec)
 
 
 class PermissionService:
@@ -188,7 +194,7 @@ class PermissionService:
 
     def read(self, id):
         doc = self.communicator.do_get('security/permission/%s' % id)
-        return "true" in doc
+        return "true" in doc.text
 
     def grant(self, id):
         self.communicator.do_put('security/permission/%s' % id)
@@ -196,29 +202,144 @@ class PermissionService:
     def revoke(self, id):
         self.communicator.do_delete("security/permission/%s" % id)
 
+    def read_role(self, role):
+        """ all the permissions granted to a role, by CI id, in a single request"""
+        return granted_permissions(
+            self.communicator.do_get('security/granted-permissions/%s' % role))
+
+    def read_roles(self, roles, engine=None):
+        """ {role: read_role(role)}, all the roles read at once over the
+        asyncio engine when one is given"""
+        if engine is None:
+            return dict((role, self.read_role(role)) for role in roles)
+        roles = list(roles)
+        docs = engine.map(
+            lambda role: engine.do_get('security/granted-permissions/%s' % role), roles)
+        return dict((role, granted_permissions(doc)) for role, doc in zip(roles, docs))
+
+
+def granted_permissions(doc):
+    """ the permissions of a granted-permissions document, by CI id"""
+    granted = {}
+    for entry in doc:
+        children = list(entry)
+        if 'key' in entry.attrib:
+            id = entry.attrib['key']
+        else:
+            id, children = children[0].text, children[1:]
+        permissions = set()
+        for child in children:
+            permissions.update(e.text for e in child.iter() if len(e) == 0 and e.text)
+        granted[id or ''] = permissions
+    return granted
+
+
+def permission_path(permission, role, id):
+    return "%s/%s/%s" % (quote(permission), role, id)
+
+
+def reconcile_matrix(granted, matrix, state, exclusive):
+    """ returns the (grants, revokes) lists of (permission, role, id) needed by the matrix"""
+    grants = []
+    revokes = []
+    for role in sorted(matrix):
+        current = granted.get(role, {})
+        for id in sorted(matrix[role] or {}):
+            wanted = set(matrix[role][id] or [])
+            existing = current.get(id, set())
+            if state == 'revoke':
+                to_grant, to_revoke = set(), wanted & existing
+            else:
+                to_grant = wanted - existing
+                to_revoke = existing - wanted if exclusive else set()
+            grants.extend((perm, role, id) for perm in sorted(to_grant))
+            revokes.extend((perm, role, id) for perm in sorted(to_revoke))
+    return grants, revokes
+
+
+def list_matrix(params):
+    """ the matrix of the 'permissions' of each of the 'roles' on the CI 'id'"""
+    permissions = params.get('permissions')
+    if permissions is None:
+        permissions = [params.get('permission')]
+    roles = params.get('roles')
+    if roles is None:
+        roles = [params.get('role')]
+    return dict((role, {params.get('id'): permissions}) for role in roles)
+
+
+def run_matrix(module, repository, matrix):
+    """ reconciles the matrix with one read per role and only the needed changes"""
+    for role, ids in matrix.items():
+        for id, permissions in (ids or {}).items():
+            if not role or not id or not all(permissions or []):
+                module.fail_json(msg="Missing role, CI id or permission for role %s on %s" % (
+                    role, id))
+    engine = None
+    if module.params.get('concurrency') > 1 and len(matrix) > 1:
+        engine = async_engine(repository.communicator, module.params.get('concurrency'))
+    granted = repository.read_roles(matrix, engine)
+    grants, revokes = reconcile_matrix(granted, matrix,
+                                       module.params.get('state'),
+                                       module.params.get('exclusive'))
+    for permission, role, id in revokes:
+        repository.revoke(permission_path(permission, role, id))
+    for permission, role, id in grants:
+        repository.grant(permission_path(permission, role, id))
+    msg = "Granted %s and revoked %s permissions for %s roles" % (
+        len(grants), len(revokes), len(matrix))
+    module.exit_json(changed=bool(grants or revokes), msg=msg,
+                     granted=len(grants), revoked=len(revokes),
+                     **repository.communicator.report())
+
 
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            username=dict(default='admin'),
-            password=dict(default='admin', no_log=True),
-            endpoint=dict(default='http://localhost:4516'),
-            validate_certs=dict(required=False, type='bool', default=True),
-            id=dict(type='str', required=True),
-            role=dict(type='str', required=True),
-            permission=dict(type='str', required=True),
-            state=dict(default='grant', choices=['revoke', 'grant'])))
+        argument_spec=xldeploy_argument_spec(
+            id=dict(type='str', required=False),
+            role=dict(type='str', required=False),
+            roles=dict(type='list', required=False),
+            permission=dict(type='str', required=False),
+            permissions=dict(type='list', required=False),
+            matrix=dict(type='dict', required=False),
+            exclusive=dict(type='bool', default=False),
+            concurrency=dict(type='int', default=8),
+            state=dict(default='grant', choices=['revoke', 'grant'])),
+        required_one_of=[['permission', 'permissions', 'matrix']],
+        mutually_exclusive=[['permission', 'permissions', 'matrix'], ['role', 'roles']])
+    if module.params.get('matrix') is None and not (
+            module.params.get('id') and (module.params.get('role') or module.params.get('roles'))):
+        module.fail_json(msg="id and role or roles are required with permission or permissions")
 
     communicator = XLDeployCommunicator(
         module.params.get('endpoint'), module.params.get('username'),
         module.params.get('password'), module.params.get('validate_certs'),
-        module.params.get('context'))
+        module.params.get('context'), retries=module.params.get('retries'),
+        trace_file=module.params.get('trace_file'),
+        hooks=module.params.get('stats_hooks'),
+        session_cache=module.params.get('session_cache'),
+        compress_requests=module.params.get('compress_requests'))
 
     repository = PermissionService(communicator)
+    if module.params.get('matrix') is not None:
+        try:
+            run_matrix(module, repository, module.params.get('matrix'))
+        except Exception as e:
+            module.fail_json(
+                msg="Failed to update XLD %s on %s, about the permission matrix:  %s" % (
+                    e, communicator, traceback.format_exc()))
+    if module.params.get('permissions') is not None or module.params.get('roles') is not None:
+        try:
+            run_matrix(module, repository, list_matrix(module.params))
+        except Exception as e:
+            module.fail_json(
+                msg="Failed to update XLD %s on %s, about the permissions on %s:  %s" % (
+                    e, communicator, module.params.get('id'), traceback.format_exc()))
+
     sec_id = module.params.get('id')
     sec_role = module.params.get('role')
     sec_perm = module.params.get('permission')
-    sec = "%s/%s/%s" % (quote(sec_perm), sec_role, sec_id)
+    sec = permission_path(sec_perm, sec_role, sec_id)
 
     msg = ""
     try:
@@ -229,24 +350,28 @@ def main():
                 msg = "Revoking [%s] for role %s on %s" % (sec_perm, sec_role,
                                                            sec_id)
                 repository.revoke(sec)
-                module.exit_json(changed=True, msg=msg)
+                module.exit_json(changed=True, msg=msg,
+                                     **communicator.report())
             else:
                 msg = "Already Revoked [%s] for role %s on %s" % (sec_perm,
                                                                   sec_role,
                                                                   sec_id)
-                module.exit_json(changed=False, msg=msg)
+                module.exit_json(changed=False, msg=msg,
+                                     **communicator.report())
         elif state == 'grant':
             existing_sec = repository.read(sec)
             if existing_sec == False:
                 msg = "Granting [%s] for role %s on %s" % (sec_perm, sec_role,
                                                            sec_id)
                 repository.grant(sec)
-                module.exit_json(changed=True, msg=msg)
+                module.exit_json(changed=True, msg=msg,
+                                     **communicator.report())
             else:
                 msg = "Already Granted [%s] for role %s on %s" % (sec_perm,
                                                                   sec_role,
                                                                   sec_id)
-                module.exit_json(changed=False, msg=msg)
+                module.exit_json(changed=False, msg=msg,
+                                     **communicator.report())
         else:
             module.exit_json(changed=False)
     except Exception as e:
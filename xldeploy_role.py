@@ -20,16 +20,33 @@ description:
     - "It uses PUT to Grants Permissions with /security/role/{role}/{principal} or /security/role/{role}"
     - "It uses DELETE to Revoke Permissions with /security/role/{role}/{principal} or /security/role/{role}"
     - "It uses GET to maintain the idempotency and checks the current status with /security/role/ or /security/role/roles/{username}"
+    - "With roles, it reads all the assignments once with GET /security/role/principals and writes the result back with PUT /security/role/principals"
+    - "With principals, it reads all the assignments once with GET /security/role/principals and only assigns or removes the principals that differ"
 
 options:
     role:
         description:
             - The role to be created/deleted
-        required: true
+            - Either role or roles is required
+        required: false
     principal:
         description:
             - The name of the user or group  to assign/remove the role to
         required: false
+    principals:
+        description:
+            - The names of the users or groups to assign/remove the role to
+        required: false
+    roles:
+        description:
+            - Mapping of role names to the list of users or groups to assign/remove them to
+            - Roles missing on the server are created
+        required: false
+    exclusive:
+        description:
+            - With roles or principals and state present, also remove the principals that are not listed from the listed roles
+        required: false
+        default: false
     endpoint:
         description:
             - The name of the enpoint
@@ -95,6 +112,30 @@ EXAMPLES = '''
       password: password
       validate_certs: False
 
+# Assign LDAP groups to several roles at once, removing the other members of these roles
+- name: Assign Roles
+    xldeploy_role:
+      roles:
+        admins: [admin, ldap-xld-admins]
+        deployers: [ldap-xld-deployers, ldap-release-team]
+        viewers: []
+      exclusive: True
+      endpoint: http://localhost:4516
+      username: admin
+      password: password
+      validate_certs: False
+
+# Make the LDAP groups the only members of the deployers role
+- name: Deployers Members
+    xldeploy_role:
+      role: deployers
+      principals: [ldap-xld-deployers, ldap-release-team]
+      exclusive: True
+      endpoint: http://localhost:4516
+      username: admin
+      password: password
+      validate_certs: False
+
 # Add admins role only (No Principals associated)
 - name: Create Only Role
     xldeploy_role:
@@ -111,89 +152,41 @@ msg:
     type: str
     returned: always
     sample: "Role [role] already present for principal *principal*"
+added:
+    description: The principals assigned to each role with roles, or to the role with principals (a list)
+    type: raw
+    returned: success
+    sample: {"admins": ["ldap-xld-admins"]}
+removed:
+    description: The principals removed from each role with roles, or from the role with principals (a list)
+    type: raw
+    returned: success
+    sample: {"deployers": ["john"]}
+created:
+    description: The roles created, with roles or principals
+    type: list
+    returned: success
+    sample: ["viewers"]
+connections:
+    description: Keep-alive connection usage against the XL Deploy server
+    type: dict
+    returned: success
+    sample: {"created": 1, "reused": 1, "discarded": 0}
+xld_stats:
+    description: Requests sent to the XL Deploy server, their sizes and where their time went, per verb and path
+    type: dict
+    returned: success
+    sample: {"requests": 2, "errors": 0, "reused": 1, "hook_errors": 0, "basic_auth": 1, "bytes_in": 812, "bytes_out": 0,
+             "content_in": 3407, "content_out": 0,
+             "time": {"dns": 0.0012, "connect": 0.0004, "tls": 0.0, "server": 0.0311, "transfer": 0.0002, "total": 0.0335},
+             "paths": {"GET security/role/{role}": {"count": 1, "errors": 0, "time": 0.0171, "max_time": 0.0171,
+                                                    "bytes_in": 406, "bytes_out": 0}}}
 '''
 
-import itertools
-import base64
-import httplib
-import ssl
-from urlparse import urlparse
-import xml.etree.ElementTree as ET
-from xml.dom.minidom import Document
+import traceback
 
-from ansible.module_utils.basic import *
-
-
-class XLDeployCommunicator:
-    """ XL Deploy Communicator using http & XML"""
-
-    def __init__(self,
-                 endpoint='http://localhost:4516',
-                 username='admin',
-                 password='admin',
-                 validate_certs=True,
-                 context='deployit'):
-        self.endpoint = endpoint
-        self.username = username
-        self.password = password
-        self.validate_certs = validate_certs
-        self.context = context
-
-    def do_get(self, path):
-        return self.do_it("GET", path, True)
-
-    def do_put(self, path):
-        return self.do_it("PUT", path, False)
-
-    def do_delete(self, path):
-        return self.do_it("DELETE", path, False)
-
-    def do_it(self, verb, path, parse_response=True):
-
-        ssl_context = None
-        if not self.validate_certs:
-            ssl_context = ssl._create_unverified_context()
-
-        parsed_url = urlparse(self.endpoint)
-        if parsed_url.scheme == "https":
-            conn = httplib.HTTPSConnection(
-                parsed_url.hostname, parsed_url.port, context=ssl_context)
-        else:
-            conn = httplib.HTTPConnection(parsed_url.hostname, parsed_url.port)
-
-        try:
-            auth = base64.encodestring('%s:%s' % (self.username,
-                                                  self.password)).replace(
-                                                      '\n', '')
-            headers = {
-                "Content-type": "application/xml",
-                "Accept": "application/xml",
-                "Authorization": "Basic %s" % auth
-            }
-
-            conn.request(verb, "/deployit/%s" % path, headers=headers)
-            response = conn.getresponse()
-
-            # print response.status, response.reason, response.read()
-            if response.status != 200 and response.status != 204:
-                raise Exception(
-                    "Error when requesting XL Deploy Server [%s]:%s" %
-                    (response.status, response.reason))
-
-            if parse_response:
-                xml = ET.fromstring(str(response.read()))
-                xmlchild = xml.getchildren()
-                children = []
-                for content in xmlchild:
-                    children.append(content.text)
-                return children
-
-            return None
-        finally:
-            conn.close()
-
-    def __str__(self):
-        return "[endpoint=%s, username=%s]" % (self.endpoint, self.username)
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.xldeploy import ET, XLDeployCommunicator, xldeploy_argument_spec
 
 
 class RoleService:
@@ -204,7 +197,7 @@ class RoleService:
 
     def read(self, id):
         doc = self.communicator.do_get('security/role/%s' % id)
-        return doc
+        return [content.text for content in doc]
 
     def create(self, id):
         self.communicator.do_put('security/role/%s' % id)
@@ -212,24 +205,129 @@ class RoleService:
     def delete(self, id):
         self.communicator.do_delete("security/role/%s" % id)
 
+    def read_assignments(self):
+        """ all the roles with their principals, in a single request"""
+        doc = self.communicator.do_get('security/role/principals')
+        assignments = {}
+        for role_principals in doc:
+            role = role_principals.find('role').attrib['name']
+            assignments[role] = set(principal.text for principal in
+                                    role_principals.findall('principals'))
+        return assignments
+
+    def write_assignments(self, assignments):
+        """ replaces all the role assignments on the server"""
+        doc = ET.Element('list')
+        for role in sorted(assignments):
+            role_principals = ET.SubElement(doc, 'rolePrincipals')
+            ET.SubElement(role_principals, 'role', name=role)
+            for principal in sorted(assignments[role]):
+                ET.SubElement(role_principals, 'principals').text = principal
+        self.communicator.do_put('security/role/principals', ET.tostring(doc))
+
+
+def reconcile_roles(assignments, roles, state, exclusive):
+    """ returns the (wanted assignments, added, removed) for the desired roles mapping"""
+    wanted = dict((role, set(principals)) for role, principals in assignments.items())
+    added = {}
+    removed = {}
+    for role, principals in roles.items():
+        principals = set(principals or [])
+        current = wanted.get(role, set())
+        if state == 'absent':
+            target = current - principals
+        elif exclusive:
+            target = principals
+        else:
+            target = current | principals
+        if target - current:
+            added[role] = sorted(target - current)
+        if current - target:
+            removed[role] = sorted(current - target)
+        if role in wanted or state == 'present':
+            wanted[role] = target
+    return wanted, added, removed
+
+
+def run_roles(module, repository):
+    """ reconciles the 'roles' mapping with one read and at most one bulk write"""
+    state = module.params.get('state')
+    assignments = repository.read_assignments()
+    wanted, added, removed = reconcile_roles(
+        assignments, module.params.get('roles'), state,
+        module.params.get('exclusive'))
+    created = sorted(set(wanted) - set(assignments))
+    changed = bool(added or removed or created)
+    if changed:
+        repository.write_assignments(wanted)
+    msg = "Added %s principals and removed %s principals on %s roles" % (
+        sum(len(p) for p in added.values()),
+        sum(len(p) for p in removed.values()), len(set(added) | set(removed)))
+    module.exit_json(changed=changed, msg=msg, added=added, removed=removed,
+                     created=created,
+                     **repository.communicator.report())
+
+
+def run_principals(module, repository):
+    """ reconciles the 'principals' of 'role' with one read and one request per change"""
+    role = module.params.get('role')
+    state = module.params.get('state')
+    assignments = repository.read_assignments()
+    _, added, removed = reconcile_roles(
+        assignments, {role: module.params.get('principals')}, state,
+        module.params.get('exclusive'))
+    added, removed = added.get(role, []), removed.get(role, [])
+    created = [role] if role not in assignments and state == 'present' else []
+    for principal in removed:
+        repository.delete("%s/%s" % (role, principal))
+    for principal in added:
+        repository.create("%s/%s" % (role, principal))
+    if created and not added:
+        repository.create(role)
+    msg = "Added %s principals and removed %s principals on role [%s]" % (
+        len(added), len(removed), role)
+    module.exit_json(changed=bool(added or removed or created), msg=msg,
+                     added=added, removed=removed, created=created,
+                     **repository.communicator.report())
+
 
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            username=dict(default='admin'),
-            password=dict(default='admin', no_log=True),
-            endpoint=dict(default='http://localhost:4516'),
-            validate_certs=dict(required=False, type='bool', default=True),
-            role=dict(type='str', required=True),
+        argument_spec=xldeploy_argument_spec(
+            role=dict(type='str', required=False),
             principal=dict(type='str', required=False),
-            state=dict(default='present', choices=['present', 'absent'])))
+            principals=dict(type='list', required=False),
+            roles=dict(type='dict', required=False),
+            exclusive=dict(type='bool', default=False),
+            state=dict(default='present', choices=['present', 'absent'])),
+        required_one_of=[['role', 'roles']],
+        mutually_exclusive=[['role', 'roles'], ['principal', 'principals', 'roles']])
 
     communicator = XLDeployCommunicator(
         module.params.get('endpoint'), module.params.get('username'),
         module.params.get('password'), module.params.get('validate_certs'),
-        module.params.get('context'))
+        module.params.get('context'), retries=module.params.get('retries'),
+        trace_file=module.params.get('trace_file'),
+        hooks=module.params.get('stats_hooks'),
+        session_cache=module.params.get('session_cache'),
+        compress_requests=module.params.get('compress_requests'))
 
     repository = RoleService(communicator)
+    if module.params.get('roles') is not None:
+        try:
+            run_roles(module, repository)
+        except Exception as e:
+            module.fail_json(
+                msg="Failed to update XLD %s on %s, about roles:  %s" % (
+                    e, communicator, traceback.format_exc()))
+    if module.params.get('principals') is not None:
+        try:
+            run_principals(module, repository)
+        except Exception as e:
+            module.fail_json(
+                msg="Failed to update XLD %s on %s, about the principals of role [%s]:  %s" % (
+                    e, communicator, module.params.get('role'), traceback.format_exc()))
+
     role = module.params.get('role')
     prin = module.params.get('principal')
     if prin is None:
@@ -248,41 +346,49 @@ def main():
             if prin is None:
                 if role in existing_item:
                     msg = "Role [%s] already present" % (role)
-                    module.exit_json(changed=False, msg=msg)
+                    module.exit_json(changed=False, msg=msg,
+                                     **communicator.report())
                 else:
                     msg = "Creating role [%s]" % (role)
                     repository.create(srvc)
-                    module.exit_json(changed=True, msg=msg)
+                    module.exit_json(changed=True, msg=msg,
+                                     **communicator.report())
             else:
                 if role in existing_item:
                     msg = "Role [%s] already present for principal %s" % (role,
                                                                           prin)
-                    module.exit_json(changed=False, msg=msg)
+                    module.exit_json(changed=False, msg=msg,
+                                     **communicator.report())
                 else:
                     msg = "Creating principal %s under role [%s]" % (prin,
                                                                      role)
                     repository.create(srvc)
-                    module.exit_json(changed=True, msg=msg)
+                    module.exit_json(changed=True, msg=msg,
+                                     **communicator.report())
         elif state == 'absent':
             existing_item = repository.read(srvc_get)
             if prin is None:
                 if role in existing_item:
                     msg = "Deleting role [%s]" % (role)
                     repository.delete(srvc)
-                    module.exit_json(changed=True, msg=msg)
+                    module.exit_json(changed=True, msg=msg,
+                                     **communicator.report())
                 else:
                     msg = "Role [%s] already deleted" % (role)
-                    module.exit_json(changed=False, msg=msg)
+                    module.exit_json(changed=False, msg=msg,
+                                     **communicator.report())
             else:
                 if role in existing_item:
                     msg = "Deleting principal %s under role [%s]" % (prin,
                                                                      role)
                     repository.delete(srvc)
-                    module.exit_json(changed=True, msg=msg)
+                    module.exit_json(changed=True, msg=msg,
+                                     **communicator.report())
                 else:
                     msg = "Role [%s] already delete for principal %s" % (role,
                                                                          prin)
-                    module.exit_json(changed=False, msg=msg)
+                    module.exit_json(changed=False, msg=msg,
+                                     **communicator.report())
         else:
             module.exit_json(changed=False)
     except Exception as e:
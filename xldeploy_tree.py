@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.0',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: xldeploy_tree
+
+short_description: Module to converge a whole subtree of the XLDeploy from Xebialabs repository through its API
+
+version_added: "2.4"
+
+description:
+    - "The module uses the API described under https://docs.xebialabs.com/generated/xl-deploy/7.6.x/rest-api/com.xebialabs.deployit.engine.api.RepositoryService.html"
+    - "It uses GET to list the CIs below the root with /repository/query"
+    - "It uses POST to read the desired CIs that already exist by batches with /repository/cis/read"
+    - "It uses POST and PUT to create and update the CIs by batches with /repository/cis"
+    - "It uses POST to delete the CIs below the root that are not desired with /repository/cis/delete, children first"
+
+options:
+    root:
+        description:
+            - The id of the CI whose descendants are managed, e.g. Infrastructure/datacenter1
+        required: true
+    items:
+        description:
+            - The desired CIs below the root, each with an id and, unless the default one applies, a type, its properties and an update_mode
+        required: true
+    type:
+        description:
+            - The type of the items which do not set one
+        required: false
+    update_mode:
+        description:
+            - Replace the properties of the existing CIs, or only add the given values to their collections and maps
+        required: false
+        default: replace
+        choices: [add, replace]
+    update_password:
+        description:
+            - Always set the password properties, or only when the CI is created
+        required: false
+        default: always
+        choices: [always, on_create]
+    prune:
+        description:
+            - Delete the CIs below the root that are neither desired nor the parent of a desired CI
+        required: false
+        default: true
+    prune_all:
+        description:
+            - Let prune delete every CI below the root when items is empty; without it an empty items list fails the task
+        required: false
+        default: false
+    page_size:
+        description:
+            - The number of CIs listed per query request
+        required: false
+        default: 1000
+    batch_size:
+        description:
+            - The number of CIs read, created, updated or deleted per request
+        required: false
+        default: 100
+    concurrency:
+        description:
+            - The number of CIs created, updated or deleted in parallel, one per request, when greater than 1
+        required: false
+        default: 1
+    endpoint:
+        description:
+            - The name of the enpoint
+        required: false
+        default: http://localhost:4516
+    username:
+        description:
+            - The name of the user for the endpoint
+        required: false
+        default: admin
+    password:
+        description:
+            - The password of the user for the endpoint
+        required: false
+        default: admin
+    validate_certs:
+        description:
+            - SSL/TLS Certificate Validation Flag
+        required: false
+        default: true
+
+extends_documentation_fragment:
+    - xldeploy
+'''
+
+EXAMPLES = '''
+# Converge the hosts of a datacenter, deleting the ones no longer listed
+- name: Datacenter1
+    xldeploy_tree:
+      root: Infrastructure/datacenter1
+      type: overthere.SshHost
+      items:
+        - id: Infrastructure/datacenter1/host1
+          properties:
+            os: UNIX
+            address: host1
+        - id: Infrastructure/datacenter1/host1/tomcat
+          type: tomcat.Server
+          properties:
+            home: /opt/tomcat
+      endpoint: http://localhost:4516
+      username: admin
+      password: password
+'''
+
+RETURN = '''
+created:
+    description: The ids of the CIs created
+    type: list
+    returned: success
+    sample: ["Infrastructure/datacenter1/host1"]
+updated:
+    description: The ids of the CIs updated
+    type: list
+    returned: success
+    sample: ["Infrastructure/datacenter1/host1/tomcat"]
+deleted:
+    description: The ids of the CIs deleted
+    type: list
+    returned: success
+    sample: ["Infrastructure/datacenter1/host2"]
+failed_items:
+    description: The CIs which could not be converged, with the reason
+    type: list
+    returned: failure
+    sample: [{"id": "Infrastructure/datacenter1/host3", "msg": "'port' is not a property of 'overthere.SshHost'"}]
+connections:
+    description: Keep-alive connection usage against the XL Deploy server
+    type: dict
+    returned: success
+    sample: {"created": 1, "reused": 1, "discarded": 0}
+xld_stats:
+    description: Requests sent to the XL Deploy server, their sizes and where their time went, per verb and path
+    type: dict
+    returned: success
+    sample: {"requests": 2, "errors": 0, "reused": 1, "hook_errors": 0, "basic_auth": 1, "bytes_in": 812, "bytes_out": 0,
+             "content_in": 3407, "content_out": 0,
+             "time": {"dns": 0.0012, "connect": 0.0004, "tls": 0.0, "server": 0.0311, "transfer": 0.0002, "total": 0.0335},
+             "paths": {"GET repository/query": {"count": 1, "errors": 0, "time": 0.0171, "max_time": 0.0171,
+                                                "bytes_in": 406, "bytes_out": 0}}}
+'''
+
+import traceback
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.xldeploy import (
+    ConfigurationItem, MetadataCache, RepositoryService, XLDeployCommunicator,
+    apply_planned, reconcile, xldeploy_argument_spec)
+
+
+def ancestors(id, root):
+    """ the ids between root, excluded, and id, excluded"""
+    parts = id[len(root) + 1:].split('/')[:-1]
+    return ['/'.join([root] + parts[:i + 1]) for i in range(len(parts))]
+
+
+def plan_tree(module, repository):
+    """ returns the planned changes and the items which can not be converged"""
+    params = module.params
+    root = params.get('root').rstrip('/')
+    desired = {}
+    failed = []
+    for item in params.get('items'):
+        ci = ConfigurationItem(item.get('type', params.get('type')),
+                               item.get('id'), item.get('properties') or {})
+        if not (ci.id or '').startswith(root + '/'):
+            failed.append(dict(id=ci.id, msg="{} is not below {}".format(ci.id, root)))
+        elif ci.id in desired:
+            failed.append(dict(id=ci.id, msg="{} is defined twice".format(ci.id)))
+        else:
+            desired[ci.id] = (ci, item.get('update_mode', params.get('update_mode')))
+
+    live = dict(repository.query(ancestor=root, page_size=params.get('page_size')))
+    existing = dict((ci.id, ci) for ci in repository.read_all(
+        [id for id in desired if id in live], params.get('batch_size')))
+
+    planned = dict(create=[], update=[], delete=[])
+    diffs = {}
+    for id, (ci, update_mode) in desired.items():
+        try:
+            action, target, _, diff = reconcile(
+                ci, existing.get(id), 'present', update_mode,
+                repository.communicator, params.get('update_password'),
+                module._diff)
+            if action is not None:
+                ConfigurationItem.check(target, repository.communicator)
+        except Exception as e:
+            failed.append(dict(id=id, msg=str(e)))
+            continue
+        if action is not None:
+            planned[action].append((id, target))
+            diffs[id] = diff
+
+    if params.get('prune'):
+        kept = set(desired)
+        for id in desired:
+            kept.update(ancestors(id, root))
+        for id, type in live.items():
+            if id not in kept:
+                planned['delete'].append((id, ConfigurationItem(type, id, {})))
+                diffs[id] = dict(before_header=id, after_header=id,
+                                 before=dict(type=type), after={})
+    return planned, diffs, failed
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=xldeploy_argument_spec(
+            root=dict(type='str', required=True),
+            items=dict(type='list', required=True),
+            type=dict(type='str', required=False),
+            update_mode=dict(default='replace', choices=['add', 'replace']),
+            update_password=dict(default='always', choices=['always', 'on_create'], no_log=False),
+            prune=dict(type='bool', default=True),
+            prune_all=dict(type='bool', default=False),
+            page_size=dict(type='int', default=1000),
+            batch_size=dict(type='int', default=100),
+            concurrency=dict(type='int', default=1),
+            metadata_cache=dict(type='path', default='~/.ansible/xldeploy/metadata'),
+            metadata_cache_ttl=dict(type='int', default=86400)),
+        supports_check_mode=True)
+    if module.params.get('prune') and not module.params.get('items') \
+            and not module.params.get('prune_all'):
+        module.fail_json(msg="No items: pruning would delete every CI below {}, set prune_all "
+                             "to do so".format(module.params.get('root')))
+
+    metadata_cache = MetadataCache(module.params.get('endpoint'),
+                                   module.params.get('metadata_cache'),
+                                   module.params.get('metadata_cache_ttl'))
+    communicator = XLDeployCommunicator(
+        module.params.get('endpoint'), module.params.get('username'),
+        module.params.get('password'), module.params.get('validate_certs'),
+        module.params.get('context'), metadata_cache,
+        module.params.get('retries'),
+        trace_file=module.params.get('trace_file'),
+        hooks=module.params.get('stats_hooks'),
+        session_cache=module.params.get('session_cache'),
+        compress_requests=module.params.get('compress_requests'))
+    repository = RepositoryService(communicator)
+
+    try:
+        planned, diffs, failed = plan_tree(module, repository)
+        errors = {}
+        if not module.check_mode:
+            errors = apply_planned(repository, planned, module.params.get('batch_size'),
+                                   module.params.get('concurrency'))
+    except Exception as e:
+        module.fail_json(
+            msg="Failed to converge XLD {} on {}:  {}".format(
+                e, communicator, traceback.format_exc()))
+
+    failed.extend(dict(id=id, msg=str(error)) for id, error in errors.items())
+    applied = dict((action, sorted(id for id, _ in planned[action] if id not in errors))
+                   for action in ('create', 'update', 'delete'))
+    changed = any(applied.values())
+    result = dict(changed=changed, created=applied['create'],
+                  updated=applied['update'], deleted=applied['delete'])
+    if module._diff:
+        result['diff'] = [diffs[id] for action in ('create', 'update', 'delete')
+                          for id in applied[action]]
+    result.update(communicator.report())
+    if failed:
+        module.fail_json(
+            msg="Failed to converge {} CIs below {} on {}".format(
+                len(failed), module.params.get('root'), communicator),
+            failed_items=failed, **result)
+    module.exit_json(
+        msg="Created {}, updated {} and deleted {} CIs below {}".format(
+            len(applied['create']), len(applied['update']), len(applied['delete']),
+            module.params.get('root')),
+        **result)
+
+
+if __name__ == '__main__':
+    main()